@@ -5,8 +5,8 @@
 # Get date and time in the format YYYYMMDD_HHMM
 DATE=$(date +"%Y%m%d_%H%M")
 
-# Setup a directory for the data to be registered
-DATA_DIRECTORY=../resampled_data/whole_brain
+# Setup a directory for the data to be registered (can be overridden from the environment, e.g. with a view built by asymmetrize.py)
+DATA_DIRECTORY=${DATA_DIRECTORY:-../resampled_data/whole_brain}
 
 # Setup a identifier (with wildcards) for the images to be registered (e.g. synA647_*.nii.gz)
 ID=synA647_*.nrrd
@@ -83,10 +83,10 @@ cp obiroi_cns_mtc_$DATE/affine/affine_template0.nii.gz obiroi_cns_mtc_$DATE/affi
 # let the user know that the affine template has been copied
 echo "Affine template copied to the current directory"
 
-# check if there is a diff folder in the resampled_data directory
-if [ -d "../resampled_data/whole_brain/diff" ]; then
-    # Copy the diff data from ../resampled_data/diff to the current directory ./
-    cp ../resampled_data/whole_brain/diff/$ID ./
+# check if there is a diff folder in the data directory (the diff group of a view)
+if [ -d "$DATA_DIRECTORY/diff" ]; then
+    # Copy the diff data from $DATA_DIRECTORY/diff to the current directory ./
+    cp $DATA_DIRECTORY/diff/$ID ./
     # let the user know that the diff data has been copied
     echo "Diff data copied to the current directory"
 fi
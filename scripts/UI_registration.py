@@ -10,8 +10,12 @@
 #   - checkbox to use histogram matching (Row 5) Default is unchecked
 #   - checkbox for quality_check (use the same random seed) (Row 5) Default is checked
 #   - checkbox for whether to flip the brain before registration (Row 5) Default is unchecked
-#   - button to run the registration (Row 6)
+#   - button to run the registration, button to cancel it and optional wall time and CPU time limits in hours
+#     (Label + Textbox) (Row 6); a cancelled registration is stopped with everything ANTs started
 #   - text terminal to display the progress of the registration (Row 7)
+#   - batch inputs (Label + Textbox + Browse/Clear buttons) with the number of parallel registrations and the
+#     memory budget (Label + Textbox) (Row 2b) Optional; if set, all the batch inputs are registered with the same
+#     settings using batch_registration.py instead of the input file
 
 # The GUI should be able to handle the following errors:
 #   - template file or input file or output directory is not specified
@@ -24,7 +28,12 @@ import sys
 import os
 import glob
 from PyQt5 import QtWidgets, QtCore, QtGui
-import time
+import datetime # batch summary names
+import threading # cancelling registrations
+from batch_registration import check_parameters, run_registration, run_batch, OUTPUT_SUFFIXES # single and batch registration
+from command_runner import CommandStopped # cancelled registrations
+from UI_warp import MainWindow as WarpWindow, TransformStore # warping gui opened after a registration
+from job_scheduler import parse_memory # memory budget of a batch
 
 about_message ="""
 Welcome to the Kronauer Lab Template Registration Toolkit!
@@ -76,6 +85,32 @@ class MainWindow(QtWidgets.QMainWindow):
         self.input_row.addWidget(self.input_browse)
         self.main_layout.addLayout(self.input_row)
 
+        # create the batch inputs row
+        self.batch_files = []
+        self.batch_row = QtWidgets.QHBoxLayout()
+        self.batch_label = QtWidgets.QLabel("Batch Inputs:")
+        self.batch_textbox = QtWidgets.QLineEdit()
+        self.batch_textbox.setReadOnly(True)
+        self.batch_browse = QtWidgets.QPushButton("Browse")
+        self.batch_browse.clicked.connect(self.browse_batch)
+        self.batch_clear = QtWidgets.QPushButton("Clear")
+        self.batch_clear.clicked.connect(self.clear_batch)
+        self.num_workers_label = QtWidgets.QLabel("Parallel Jobs:")
+        self.num_workers_textbox = QtWidgets.QLineEdit()
+        self.num_workers_textbox.setText("1")
+        self.mem_budget_label = QtWidgets.QLabel("Memory Budget:")
+        self.mem_budget_textbox = QtWidgets.QLineEdit()
+        self.mem_budget_textbox.setText("auto")
+        self.batch_row.addWidget(self.batch_label)
+        self.batch_row.addWidget(self.batch_textbox)
+        self.batch_row.addWidget(self.batch_browse)
+        self.batch_row.addWidget(self.batch_clear)
+        self.batch_row.addWidget(self.num_workers_label)
+        self.batch_row.addWidget(self.num_workers_textbox)
+        self.batch_row.addWidget(self.mem_budget_label)
+        self.batch_row.addWidget(self.mem_budget_textbox)
+        self.main_layout.addLayout(self.batch_row)
+
         # create the output directory row
         self.output_row = QtWidgets.QHBoxLayout()
         self.output_label = QtWidgets.QLabel("Output Directory:")
@@ -207,10 +242,35 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.main_layout.addLayout(self.last_row)
 
-        # create the run button
+        # create the run row (run and cancel buttons, time limits)
+        self.run_row = QtWidgets.QHBoxLayout()
         self.run_button = QtWidgets.QPushButton("Run Registration")
         self.run_button.clicked.connect(self.run_registration)
-        self.main_layout.addWidget(self.run_button)
+        self.cancel_button = QtWidgets.QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel_registration)
+        self.cancel_button.setEnabled(False)
+        self.wall_time_label = QtWidgets.QLabel("Time Limit (h):")
+        self.wall_time_textbox = QtWidgets.QLineEdit()
+        self.wall_time_textbox.setPlaceholderText("none")
+        self.cpu_time_label = QtWidgets.QLabel("CPU Time Limit (h):")
+        self.cpu_time_textbox = QtWidgets.QLineEdit()
+        self.cpu_time_textbox.setPlaceholderText("none")
+        self.run_row.addWidget(self.run_button)
+        self.run_row.addWidget(self.cancel_button)
+        self.run_row.addWidget(self.wall_time_label)
+        self.run_row.addWidget(self.wall_time_textbox)
+        self.run_row.addWidget(self.cpu_time_label)
+        self.run_row.addWidget(self.cpu_time_textbox)
+        self.main_layout.addLayout(self.run_row)
+
+        # the cancel event of a single registration and the cancel file of a batch
+        self.cancel_event = threading.Event()
+        self.registration_succeeded = False
+        self.cancel_file = ""
+
+        # the warping windows opened from this window and the transforms they share
+        self.warp_windows = []
+        self.transform_store = TransformStore()
 
         # create the terminal
         self.terminal = QtWidgets.QTextEdit()
@@ -257,6 +317,24 @@ class MainWindow(QtWidgets.QMainWindow):
         # set the textbox to the filename
         self.input_textbox.setText(filename)
 
+    # function to browse for the batch input files
+    def browse_batch(self):
+        # open a file dialog
+        open_folder = os.getcwd() if len(self.batch_files) == 0 else os.path.dirname(self.batch_files[0])
+        filenames = QtWidgets.QFileDialog.getOpenFileNames(self, 'Open Input Files', open_folder, 'Image Files (*.nii.gz *.nrrd)')[0]
+        # make sure there are no spaces in the filenames and alert the user to change them if there are
+        for filename in filenames:
+            if self.verify_no_spaces(filename) is False:
+                return
+        # add the files to the batch
+        self.batch_files += [filename for filename in filenames if filename not in self.batch_files]
+        self.batch_textbox.setText("{} files".format(len(self.batch_files)) if len(self.batch_files) > 0 else "")
+
+    # function to clear the batch input files
+    def clear_batch(self):
+        self.batch_files = []
+        self.batch_textbox.setText("")
+
     # function to browse for the output directory
     def browse_output(self):
         # open a file dialog
@@ -319,6 +397,71 @@ class MainWindow(QtWidgets.QMainWindow):
             QtWidgets.QMessageBox.warning(self, "Warning", "Number of iterations must be a series of positive integers separated by x.")
             return
 
+    # function to enable or disable the controls while a registration is running
+    def set_controls_enabled(self, enabled):
+        self.run_button.setEnabled(enabled)
+        self.cancel_button.setEnabled(not enabled)
+        self.wall_time_textbox.setEnabled(enabled)
+        self.cpu_time_textbox.setEnabled(enabled)
+        self.template_browse.setEnabled(enabled)
+        self.input_browse.setEnabled(enabled)
+        self.output_browse.setEnabled(enabled)
+        self.batch_browse.setEnabled(enabled)
+        self.batch_clear.setEnabled(enabled)
+        self.num_workers_textbox.setEnabled(enabled)
+        self.mem_budget_textbox.setEnabled(enabled)
+        self.registration_type_RA.setEnabled(enabled)
+        self.registration_type_RI.setEnabled(enabled)
+        self.registration_type_SY.setEnabled(enabled)
+        self.registration_type_S2.setEnabled(enabled)
+        self.registration_type_GR.setEnabled(enabled)
+        self.registration_type_EX.setEnabled(enabled)
+        self.registration_type_DD.setEnabled(enabled)
+        self.registration_type_EL.setEnabled(enabled)
+        self.num_iterations_textbox.setEnabled(enabled)
+        self.n4_bias_field_checkbox.setEnabled(enabled)
+        self.quality_check_checkbox.setEnabled(enabled)
+        self.flip_brain_checkbox.setEnabled(enabled)
+        self.similarity_metric_CC.setEnabled(enabled)
+        self.similarity_metric_MI.setEnabled(enabled)
+        self.similarity_metric_MSQ.setEnabled(enabled)
+        self.similarity_metric_PR.setEnabled(enabled)
+        self.low_memory_checkbox.setEnabled(enabled)
+
+    # function to get the registration parameters
+    def get_parameters(self):
+        return {
+            'num_iterations': self.num_iterations_textbox.text(),
+            'registration_type': self.registration_type,
+            'similarity_metric': self.similarity_metric,
+            'n4_bias_field': self.n4_bias_field_checkbox.isChecked(),
+            'quality_check': self.quality_check_checkbox.isChecked(),
+            'low_memory': self.low_memory_checkbox.isChecked(),
+            'flip_brain': self.flip_brain_checkbox.isChecked(),
+            'debug_mode': self.debug_mode_checkbox.isChecked(),
+        }
+
+    # function to get the time limits in seconds
+    def get_time_limits(self):
+        try:
+            wall_time = float(self.wall_time_textbox.text() or 0) * 3600
+            cpu_time = float(self.cpu_time_textbox.text() or 0) * 3600
+            assert wall_time >= 0 and cpu_time >= 0
+        except (ValueError, AssertionError):
+            QtWidgets.QMessageBox.warning(self, "Warning", "Time limits must be positive numbers of hours (or empty for no limit).")
+            return None
+        return wall_time, cpu_time
+
+    # function to cancel the running registration
+    def cancel_registration(self):
+        self.cancel_button.setEnabled(False)
+        self.update_terminal("Cancelling...")
+        self.cancel_event.set()
+        if self.cancel_file != "":
+            # the registrations of a batch run in other processes and check for this file
+            with open(self.cancel_file, "w") as f:
+                f.write("cancelled")
+
     # function to run the registration using ANTs
     def run_registration(self):
         # get the template file
@@ -330,6 +473,11 @@ class MainWindow(QtWidgets.QMainWindow):
         # get the output directory
         output_directory = self.output_textbox.text()
 
+        # register the batch inputs instead of the input file if there are any
+        if len(self.batch_files) > 0:
+            self.run_batch_registration()
+            return
+
         # check if the template file, input file, or output directory is not specified
         if template_file == "" or input_file == "" or output_directory == "":
             QtWidgets.QMessageBox.warning(self, "Warning", "Template file, input file, and output directory must be specified.")
@@ -338,108 +486,34 @@ class MainWindow(QtWidgets.QMainWindow):
         # if the output directory does not end with a slash, add a slash
         if not output_directory.endswith("/"):
             output_directory += "/"
-        
-        # setup output directory
-        input_filename = os.path.basename(input_file)
-        output_prefix = os.path.splitext(input_filename)[0]+"_"
-        output_prefix = os.path.join(output_directory, output_prefix)
 
         # check number of threads
         self.check_num_iterations()
 
-        # get the number of threads
-        num_iterations = self.num_iterations_textbox.text()
-
-        # get the registration type
-        registration_type = self.registration_type
-
-        # get the similarity metric
-        similarity_metric = self.similarity_metric
-
-        # get the histogram matching option
-        n4_bias_field = "1" if self.n4_bias_field_checkbox.isChecked() else "0"
-
-        # get the quality_check option
-        quality_check = "1" if self.quality_check_checkbox.isChecked() else "0"
-
-        # get the flip brain option
-        flip_brain = self.flip_brain_checkbox.isChecked()
-
-        # get the low memory option
-        low_memory_flip = "1" if self.low_memory_checkbox.isChecked() else "0"
-
-        # get the debug mode option
-        debug_mode = self.debug_mode_checkbox.isChecked()
-
-        # create a list of intermediate files
-        intermediate_files = []
-
-        # create a list of flip brain commands
-        flip_brain_commands = []
-
-        # create the flip brain command
-        if flip_brain:
-            # define flipped command
-            flipped_input_file = output_directory + os.path.splitext(input_filename)[0]+"_flipped"+os.path.splitext(input_filename)[1]
-            mirror_file = output_directory + ((input_filename[:-5] if input_filename.endswith(".nrrd") else input_filename[:-7]) + '.mat')
-            flip_brain_commands.append("ImageMath 3 {} ReflectionMatrix {} 0 >{}_out.log 2>{}_err.log".format(mirror_file, input_file, mirror_file[:-4], mirror_file[:-4]))
-            flip_brain_commands.append("antsApplyTransforms -d 3 -i {} -o {} -t {} -r {} --float {} >{}_out.log 2>{}_err.log".format(input_file, flipped_input_file, mirror_file, input_file, low_memory_flip, flipped_input_file[:-5], flipped_input_file[:-5]))
-            # create a file that be a reminder that the brain was flipped using cat
-            flip_marker_file = output_directory + os.path.splitext(input_filename)[0]+"_flipped.txt"
-            with open(flip_marker_file, "w") as f:
-                f.write("This file is a reminder that the brain was flipped before registration.")
-            # set the input file to the flipped input file
-            input_file = flipped_input_file
-
-            # add the intermediate files to the list (log files included)
-            intermediate_files.append(flipped_input_file)
-            intermediate_files.append(mirror_file[:-4]+"_out.log")
-            intermediate_files.append(mirror_file[:-4]+"_err.log")
-            intermediate_files.append(flipped_input_file[:-5]+"_out.log")
-            intermediate_files.append(flipped_input_file[:-5]+"_err.log")
-        
-        # create the registration command
-        registration_command = "antsIntroduction.sh -d 3 -r "+template_file+" -i "+input_file+" -o "+output_prefix+" -m "+num_iterations+" -t "+registration_type+" -n "+n4_bias_field+" -q "+quality_check+" -s "+similarity_metric+" >"+output_prefix+"out.log 2>"+output_prefix+"err.log"
-
-        # add the intermediate files to the list (log files included)
-        intermediate_files.append(output_prefix+"out.log")
-        intermediate_files.append(output_prefix+"err.log")
-
-        if debug_mode:
-            intermediate_files = []
+        # check the registration parameters
+        try:
+            parameters = check_parameters(self.get_parameters())
+        except AssertionError as error:
+            QtWidgets.QMessageBox.warning(self, "Warning", str(error))
+            return
 
-        # get output directory
-        output_directory = os.path.dirname(output_prefix)
+        # check the time limits
+        time_limits = self.get_time_limits()
+        if time_limits is None:
+            return
+        self.cancel_event.clear()
+        self.registration_succeeded = False
+        self.cancel_file = ""
 
         # disable all the buttons
-        self.run_button.setEnabled(False)
-        self.template_browse.setEnabled(False)
-        self.input_browse.setEnabled(False)
-        self.output_browse.setEnabled(False)
-        self.registration_type_RA.setEnabled(False)
-        self.registration_type_RI.setEnabled(False)
-        self.registration_type_SY.setEnabled(False)
-        self.registration_type_S2.setEnabled(False)
-        self.registration_type_GR.setEnabled(False)
-        self.registration_type_EX.setEnabled(False)
-        self.registration_type_DD.setEnabled(False)
-        self.registration_type_EL.setEnabled(False)
-        self.num_iterations_textbox.setEnabled(False)
-        self.n4_bias_field_checkbox.setEnabled(False)
-        self.quality_check_checkbox.setEnabled(False)
-        self.flip_brain_checkbox.setEnabled(False)
-        self.similarity_metric_CC.setEnabled(False)
-        self.similarity_metric_MI.setEnabled(False)
-        self.similarity_metric_MSQ.setEnabled(False)
-        self.similarity_metric_PR.setEnabled(False)
-        self.low_memory_checkbox.setEnabled(False)
-
+        self.set_controls_enabled(False)
 
         # create a new thread to run the registration command
         self.registration_thread = QtCore.QThread()
-        self.registration_worker = RegistrationWorker(registration_command, flip_brain_commands, output_directory, intermediate_files)
+        self.registration_worker = RegistrationWorker(template_file, input_file, output_directory, parameters, self.cancel_event, *time_limits)
         self.registration_worker.moveToThread(self.registration_thread)
         self.registration_thread.started.connect(self.registration_worker.run_registration)
+        self.registration_worker.finished.connect(self.set_registration_status)
         self.registration_worker.finished.connect(self.registration_thread.quit)
         self.registration_worker.finished.connect(self.registration_worker.deleteLater)
         self.registration_thread.finished.connect(self.registration_thread.deleteLater)
@@ -449,30 +523,83 @@ class MainWindow(QtWidgets.QMainWindow):
         # when the thread is finished, print a message and enable the run button
         self.registration_thread.finished.connect(self.registration_finished)
 
+    # function to register all the batch inputs
+    def run_batch_registration(self):
+        # get the template file
+        template_file = self.template_textbox.text()
+
+        # get the output directory
+        output_directory = self.output_textbox.text()
+
+        # check if the template file or output directory is not specified
+        if template_file == "" or output_directory == "":
+            QtWidgets.QMessageBox.warning(self, "Warning", "Template file and output directory must be specified.")
+            return
+
+        # check the number of parallel jobs and the memory budget
+        try:
+            num_workers = int(self.num_workers_textbox.text())
+            assert num_workers >= 0
+            mem_budget = parse_memory(self.mem_budget_textbox.text())
+        except (ValueError, AssertionError):
+            QtWidgets.QMessageBox.warning(self, "Warning", "Parallel jobs must be a positive integer (0 for one per CPU) and the memory budget a size like 64G, 0 (no limit) or auto.")
+            return
+
+        # check the time limits
+        time_limits = self.get_time_limits()
+        if time_limits is None:
+            return
+
+        # the batch is cancelled by creating the cancel file next to its summary
+        summary_file = os.path.join(output_directory, "batch_registration_{}.json".format(datetime.datetime.now().strftime('%Y%m%d_%H%M%S')))
+        self.cancel_event.clear()
+        self.cancel_file = os.path.splitext(summary_file)[0] + ".cancel"
+
+        # check number of threads
+        self.check_num_iterations()
+
+        # disable all the buttons
+        self.set_controls_enabled(False)
+
+        # create a new thread to run the batch
+        self.registration_thread = QtCore.QThread()
+        self.registration_worker = BatchRegistrationWorker(template_file, list(self.batch_files), output_directory, self.get_parameters(), num_workers, mem_budget, summary_file, *time_limits)
+        self.registration_worker.moveToThread(self.registration_thread)
+        self.registration_thread.started.connect(self.registration_worker.run_batch)
+        self.registration_worker.finished.connect(self.registration_thread.quit)
+        self.registration_worker.finished.connect(self.registration_worker.deleteLater)
+        self.registration_thread.finished.connect(self.registration_thread.deleteLater)
+        self.registration_worker.progress.connect(self.update_terminal)
+        self.registration_worker.summary.connect(self.batch_finished)
+        self.registration_thread.start()
+
+    # function to print a message when a batch is finished
+    def batch_finished(self, message):
+        # enable all the buttons
+        self.set_controls_enabled(True)
+        self.cancel_file = ""
+
+        # pop up a message box
+        QtWidgets.QMessageBox.information(self, "Batch Registration Finished", message)
+
+    # function to remember if the registration succeeded
+    def set_registration_status(self, success):
+        self.registration_succeeded = success
+
     # function to print a message when the registration is finished
     def registration_finished(self):
         # enable all the buttons
-        self.run_button.setEnabled(True)
-        self.template_browse.setEnabled(True)
-        self.input_browse.setEnabled(True)
-        self.output_browse.setEnabled(True)
-        self.registration_type_RA.setEnabled(True)
-        self.registration_type_RI.setEnabled(True)
-        self.registration_type_SY.setEnabled(True)
-        self.registration_type_S2.setEnabled(True)
-        self.registration_type_GR.setEnabled(True)
-        self.registration_type_EX.setEnabled(True)
-        self.registration_type_DD.setEnabled(True)
-        self.registration_type_EL.setEnabled(True)
-        self.num_iterations_textbox.setEnabled(True)
-        self.n4_bias_field_checkbox.setEnabled(True)
-        self.quality_check_checkbox.setEnabled(True)
-        self.flip_brain_checkbox.setEnabled(True)
-        self.similarity_metric_CC.setEnabled(True)
-        self.similarity_metric_MI.setEnabled(True)
-        self.similarity_metric_MSQ.setEnabled(True)
-        self.similarity_metric_PR.setEnabled(True)
-        self.low_memory_checkbox.setEnabled(True)
+        self.set_controls_enabled(True)
+
+        # nothing to warp if the registration was cancelled
+        if self.cancel_event.is_set():
+            QtWidgets.QMessageBox.information(self, "Registration Cancelled", "Registration was cancelled.")
+            return
+
+        # nothing to warp if the registration failed or was stopped by a time limit
+        if not self.registration_succeeded:
+            QtWidgets.QMessageBox.warning(self, "Registration Failed", "Registration failed, check the terminal and the log files in the output directory.")
+            return
 
         # pop up a message box
         QtWidgets.QMessageBox.information(self, "Registration Finished", "Registration finished check the output directory for the registered file: {}_deformed.nii.gz".format(os.path.splitext(os.path.basename(self.input_textbox.text()))[0]))
@@ -480,140 +607,97 @@ class MainWindow(QtWidgets.QMainWindow):
         # ask the user if they want to warp other channels
         reply = QtWidgets.QMessageBox.question(self, "Warp Other Channels", "Do you want to warp other channels?", QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No, QtWidgets.QMessageBox.Yes)
         if reply == QtWidgets.QMessageBox.Yes:
-            # create a list with the files to send to warping gui
-            output_directory = os.path.dirname(self.output_textbox.text()+"/")
-            target_file = os.path.join(output_directory, os.path.splitext(os.path.basename(self.input_textbox.text()))[0]+"_deformed.nii.gz")
-            warp_file = os.path.join(output_directory, os.path.splitext(os.path.basename(self.input_textbox.text()))[0]+"_Warp.nii.gz")
-            inverse_warp_file = os.path.join(output_directory, os.path.splitext(os.path.basename(self.input_textbox.text()))[0]+"_InverseWarp.nii.gz")
-            affine_file = os.path.join(output_directory, os.path.splitext(os.path.basename(self.input_textbox.text()))[0]+"_Affine.txt")
-            was_flipped = "flipped" if self.flip_brain_checkbox.isChecked() else "not_flipped"
-            print(output_directory, target_file, warp_file, inverse_warp_file, affine_file, was_flipped)
-            # make sure the files exist
-            if not os.path.exists(target_file) or not os.path.exists(warp_file) or not os.path.exists(inverse_warp_file) or not os.path.exists(affine_file):
-                QtWidgets.QMessageBox.warning(self, "Warning", "Some files are missing. Please check the output directory.")
-                target_file = "MISSING" if not os.path.exists(target_file) else target_file
-                warp_file = "MISSING" if not os.path.exists(warp_file) else warp_file
-                inverse_warp_file = "MISSING" if not os.path.exists(inverse_warp_file) else inverse_warp_file
-                affine_file = "MISSING" if not os.path.exists(affine_file) else affine_file
-            # use os.system to run the warping gui
-            os.system("poetry run python scripts/UI_warp.py "+output_directory+" "+target_file+" "+warp_file+" "+inverse_warp_file+" "+affine_file+" "+was_flipped)
-        else:
-            return
-        
+            self.open_warping_window()
+
+    # function to open the warping gui for the last registration in this application
+    def open_warping_window(self):
+        # get the files of the registration
+        output_directory = os.path.dirname(self.output_textbox.text()+"/")
+        output_prefix = os.path.join(output_directory, os.path.splitext(os.path.basename(self.input_textbox.text()))[0]+"_")
+        target_file = output_prefix+"deformed.nii.gz"
+        warp_file = output_prefix+"Warp.nii.gz"
+        inverse_warp_file = output_prefix+"InverseWarp.nii.gz"
+        affine_file = output_prefix+"Affine.txt"
+        was_flipped = self.flip_brain_checkbox.isChecked()
+        # make sure the files exist
+        if not os.path.exists(target_file) or not os.path.exists(warp_file) or not os.path.exists(inverse_warp_file) or not os.path.exists(affine_file):
+            QtWidgets.QMessageBox.warning(self, "Warning", "Some files are missing. Please check the output directory.")
+            target_file = "" if not os.path.exists(target_file) else target_file
+            warp_file = "" if not os.path.exists(warp_file) else warp_file
+            inverse_warp_file = "" if not os.path.exists(inverse_warp_file) else inverse_warp_file
+            affine_file = "" if not os.path.exists(affine_file) else affine_file
+        # the header of the registered brain is read now and kept with the transforms the warping window loads
+        if target_file != "":
+            self.transform_store.get_geometry(target_file)
+        # open the warping gui as a second window (this window stays usable)
+        warp_window = WarpWindow(output_directory, target_file, warp_file, inverse_warp_file, affine_file, was_flipped, transform_store=self.transform_store, show_about=False)
+        warp_window.setAttribute(QtCore.Qt.WA_DeleteOnClose)
+        warp_window.destroyed.connect(lambda: self.warp_windows.remove(warp_window))
+        self.warp_windows.append(warp_window)
+
     # function to update the terminal
     def update_terminal(self, text):
         self.terminal.append(text)
 
 # create a worker class to run the registration command
 class RegistrationWorker(QtCore.QObject):
-    finished = QtCore.pyqtSignal()
+    # True if the registration succeeded
+    finished = QtCore.pyqtSignal(bool)
     progress = QtCore.pyqtSignal(str)
 
-    def __init__(self, registration_command, flip_brain_commands, output_directory, intermediate_files):
+    def __init__(self, template_file, input_file, output_directory, parameters, cancel_event, wall_time=0, cpu_time=0):
         super().__init__()
-        self.registration_command = registration_command
-        self.flip_brain_commands = flip_brain_commands
+        self.template_file = template_file
+        self.input_file = input_file
         self.output_directory = output_directory
-        self.intermediate_files = intermediate_files
+        self.parameters = parameters
+        self.cancel_event = cancel_event
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
 
     def run_registration(self):
-        if len(self.flip_brain_commands) > 0:
-            self.progress.emit("Flipping the brain...")
-            self.progress.emit("")
-            # run the flip brain command
-            for command in self.flip_brain_commands:
-                self.progress.emit(command)
-                os.system(command)
-                self.progress.emit("")
-        # run the registration command
-        self.progress.emit("Running registration...")
+        # run the registration in its own scratch directory and move the results to the output directory
+        success = False
+        try:
+            returncode, output_prefix = run_registration(self.template_file, self.input_file, self.output_directory, self.parameters, log=self.progress.emit, cancel=self.cancel_event.is_set, wall_time=self.wall_time, cpu_time=self.cpu_time)
+            success = returncode == 0 and os.path.isfile(output_prefix + OUTPUT_SUFFIXES['deformed'])
+            if not success:
+                self.progress.emit("Registration failed with exit code {} (see {}err.log).".format(returncode, output_prefix))
+        except CommandStopped as reason:
+            self.progress.emit("Registration stopped: {}.".format(reason))
+        except Exception as error:
+            self.progress.emit("Registration failed: {}".format(error))
+        # emit the finished signal
+        self.finished.emit(success)
+
+# create a worker class to register a batch of brains
+class BatchRegistrationWorker(QtCore.QObject):
+    finished = QtCore.pyqtSignal()
+    progress = QtCore.pyqtSignal(str)
+    summary = QtCore.pyqtSignal(str)
+
+    def __init__(self, template_file, input_files, output_directory, parameters, num_workers, mem_budget, summary_file, wall_time=0, cpu_time=0):
+        super().__init__()
+        self.template_file = template_file
+        self.input_files = input_files
+        self.output_directory = output_directory
+        self.parameters = parameters
+        self.num_workers = num_workers
+        self.mem_budget = mem_budget
+        self.summary_file = summary_file
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+
+    def run_batch(self):
+        self.progress.emit("Registering {} brains...".format(len(self.input_files)))
         self.progress.emit("")
-        self.progress.emit(self.registration_command)
-        current_time = time.time()
-        os.system(self.registration_command)
-        # move tmp files
-        self.progress.emit("Move temporary files...")
-        cwd = os.getcwd()
-        tmp_folder = filter(lambda x: os.path.isdir(x) and x.startswith("tmp"), os.listdir(cwd))
-        # get the time of the tmp folder creation
-        tmp_folder = filter(lambda x: os.stat(x).st_ctime > current_time, tmp_folder)
-        # sort the tmp folders by creation time (earliest first)
-        tmp_folder = sorted(tmp_folder, key=lambda x: os.stat(x).st_ctime)
-        # get the first tmp folder
-        if len(tmp_folder) > 0:
-            tmp_folder = tmp_folder[0]
-            self.progress.emit("mv "+tmp_folder+" "+self.output_directory)
-            os.system("mv "+tmp_folder+" "+self.output_directory)
-            if len(self.intermediate_files) > 0:
-                self.intermediate_files.append(os.path.join(self.output_directory, tmp_folder))
-            self.progress.emit("")
-        # move the additional output files to the output directory
-        self.progress.emit("Moving additional output files...")
-        cwd = os.getcwd()
-        # get .cfg and .nii.gz files
-        cfg_files = filter(lambda x: os.path.isfile(x) and x.endswith(".cfg"), os.listdir(cwd))
-        nii_files = filter(lambda x: os.path.isfile(x) and x.endswith(".nii.gz"), os.listdir(cwd))
-        # sort the files by creation time (earliest first)
-        cfg_files = filter(lambda x: os.stat(x).st_ctime > current_time, cfg_files)
-        cfg_files = sorted(cfg_files, key=lambda x: os.stat(x).st_ctime)
-        nii_files = filter(lambda x: os.stat(x).st_ctime > current_time, nii_files)
-        nii_files = sorted(nii_files, key=lambda x: os.stat(x).st_ctime)
-        # get the first file
-        if len(cfg_files) > 0:
-            cfg_files = cfg_files[0]
-            # move the files
-            self.progress.emit("mv "+cfg_files+" "+self.output_directory)
-            os.system("mv "+cfg_files+" "+self.output_directory)
-            if len(self.intermediate_files) > 0:
-                self.intermediate_files.append(os.path.join(self.output_directory, cfg_files))
-            self.progress.emit("")
-        if len(nii_files) > 0:
-            nii_files = nii_files[0]
-            # move the files
-            self.progress.emit("mv "+nii_files+" "+self.output_directory)
-            os.system("mv "+nii_files+" "+self.output_directory)
-            if len(self.intermediate_files) > 0:
-                self.intermediate_files.append(os.path.join(self.output_directory, nii_files))
-            self.progress.emit("")
-
-        # remove the intermediate files
-        if len(self.intermediate_files) > 0:
-            self.progress.emit("Removing intermediate files...")
-            for file in self.intermediate_files:
-                # check if log or error file
-                if file.endswith("_out.log") or file.endswith("_err.log"):
-                    # check if file exists, if not, continue
-                    if not os.path.exists(file):
-                        continue
-                    # convert to error file
-                    error_file = file[:-8]+"_err.log"
-                    # check if error file exists, if not, continue
-                    if not os.path.exists(error_file):
-                        continue
-                    # check if empty
-                    if os.stat(error_file).st_size == 0:
-                        # remove the log file and the error file
-                        if os.path.exists(file[:-8]+"_out.log"):
-                            self.progress.emit("Removing "+file[:-8]+"_out.log")
-                            os.remove(file[:-8]+"_out.log")
-                            self.progress.emit("")
-                        self.progress.emit("Removing "+error_file)
-                        os.remove(error_file)
-                        self.progress.emit("")
-                else:
-                    # check if directory
-                    if os.path.isdir(file):
-                        # remove the directory
-                        self.progress.emit("Removing "+file)
-                        os.system("rm -rf "+file)
-                        self.progress.emit("")
-                    else:
-                        # remove the file
-                        self.progress.emit("Removing "+file)
-                        os.remove(file)
-                        self.progress.emit("")
-
-        self.progress.emit("Registration finished.")
+        try:
+            summary = run_batch(self.template_file, self.input_files, self.output_directory, self.parameters, self.num_workers, self.mem_budget, summary_file=self.summary_file, wall_time=self.wall_time, cpu_time=self.cpu_time, log=self.progress.emit)
+            message = "Registered {} of {} brains ({} failed, {} cancelled). See the batch summary in the output directory.".format(summary['finished'] - summary['failed'] - summary['cancelled'], summary['total'], summary['failed'], summary['cancelled'])
+        except Exception as error:
+            message = "Batch registration failed: {}".format(error)
+        self.progress.emit(message)
+        self.summary.emit(message)
         # emit the finished signal
         self.finished.emit()
 
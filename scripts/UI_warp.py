@@ -4,24 +4,22 @@
 # import the necessary packages
 import sys
 import os
+import re # transform paths in commands
 import glob
+import tempfile # decompression cache
+import threading # cancelling warping
 from PyQt5 import QtWidgets, QtCore, QtGui
+from collections import OrderedDict # least recently used transforms
+from native_warp import warp_images, load_transforms, read_geometry, DisplacementField
+from command_runner import run_command, CommandStopped # running ANTs with live output and job control
+from decompression_cache import get_decompressed_files # decompressed copies of compressed transforms
 
-# check if there are no arguments or exactly 4 arguments other than the script name
-if len(sys.argv) == 7:
-    _output_directory = sys.argv[1] 
-    _target_file = sys.argv[2] if sys.argv[2] != "MISSING" else ""
-    _warp_file = sys.argv[3] if sys.argv[3] != "MISSING" else ""
-    _inverse_warp_file = sys.argv[4] if sys.argv[4] != "MISSING" else ""
-    _affine_file = sys.argv[5] if sys.argv[5] != "MISSING" else ""
-    _was_flipped = True if sys.argv[6] == "flipped" else False
-elif len(sys.argv) == 1:
-    _output_directory = ""
-    _target_file = ""
-    _warp_file = ""
-    _inverse_warp_file = ""
-    _affine_file = ""
-    _was_flipped = False
+# number of displacement fields kept in memory by a transform store
+MAX_STORED_FIELDS = 2
+
+# directory and quota (bytes) of the cache of decompressed transforms used by the warping GUI
+DECOMPRESSION_CACHE = os.path.join(tempfile.gettempdir(), "ant_template_builder_transforms")
+DECOMPRESSION_QUOTA = 20 << 30
 
 
 about_message ="""
@@ -36,10 +34,66 @@ https://github.com/neurorishika/ant_template_builder
 Version: 1.0, November 2023. Developed by Rishika Mohanta.
 """
 
+# create a store of loaded transforms and reference geometries shared by the windows of a process
+class TransformStore:
+    """
+    Keep the transform steps (see native_warp.load_transforms) and reference geometries loaded by the
+    native engine, so that warping more files with the same transforms (also from another window)
+    does not read them again. Entries are reloaded if their file changed; only the most recently
+    used MAX_STORED_FIELDS displacement fields are kept. Compressed transforms are read from their
+    decompressed copies in cache_dir (see decompression_cache.py), also for ANTs.
+    """
+
+    def __init__(self, cache_dir=DECOMPRESSION_CACHE, quota=DECOMPRESSION_QUOTA):
+        self.lock = threading.Lock()
+        self.steps = OrderedDict()
+        self.geometries = {}
+        self.cache_dir = cache_dir
+        self.quota = quota
+
+    # function to get the files to read instead of transform files
+    def get_files(self, paths):
+        return get_decompressed_files(paths, self.cache_dir, self.quota)
+
+    # function to get the steps of a list of transforms
+    def get_steps(self, transforms):
+        steps = []
+        for path, invert in transforms:
+            key = (path, invert, os.stat(path).st_mtime_ns)
+            with self.lock:
+                step = self.steps.get(key)
+                if step is not None:
+                    self.steps.move_to_end(key)
+            if step is None:
+                step = load_transforms([(self.get_files([path])[0], invert)])[0]
+                with self.lock:
+                    self.steps[key] = step
+                    # forget the least recently used displacement fields
+                    fields = [k for k, s in self.steps.items() if isinstance(s, DisplacementField)]
+                    for k in fields[:max(0, len(fields) - MAX_STORED_FIELDS)]:
+                        del self.steps[k]
+            steps.append(step)
+        return steps
+
+    # function to get the geometry of a reference file
+    def get_geometry(self, path):
+        key = (path, os.stat(path).st_mtime_ns)
+        with self.lock:
+            geometry = self.geometries.get(key)
+        if geometry is None:
+            geometry = read_geometry(path)
+            with self.lock:
+                self.geometries[key] = geometry
+        return geometry
+
+
 # create the GUI class
 class MainWindow(QtWidgets.QMainWindow):
-    def __init__(self):
+    def __init__(self, output_directory="", target_file="", warp_file="", inverse_warp_file="", affine_file="", was_flipped=False, transform_store=None, show_about=True):
         super().__init__()
+        # transforms and reference geometries loaded by the native engine (may be shared with other windows)
+        self.transform_store = transform_store if transform_store is not None else TransformStore()
+
         self.setWindowTitle("Kronauer Lab Template Warping Kit")
         self.resize(500, 500)
         
@@ -63,11 +117,27 @@ class MainWindow(QtWidgets.QMainWindow):
         self.input_row.addWidget(self.input_browse)
         self.main_layout.addLayout(self.input_row)
 
+        # create the other channels row (warped with the same transforms as the input file)
+        self.channel_files = []
+        self.channels_row = QtWidgets.QHBoxLayout()
+        self.channels_label = QtWidgets.QLabel("Other Channels:")
+        self.channels_textbox = QtWidgets.QLineEdit()
+        self.channels_textbox.setReadOnly(True)
+        self.channels_browse = QtWidgets.QPushButton("Browse")
+        self.channels_browse.clicked.connect(self.browse_channels)
+        self.channels_clear = QtWidgets.QPushButton("Clear")
+        self.channels_clear.clicked.connect(self.clear_channels)
+        self.channels_row.addWidget(self.channels_label)
+        self.channels_row.addWidget(self.channels_textbox)
+        self.channels_row.addWidget(self.channels_browse)
+        self.channels_row.addWidget(self.channels_clear)
+        self.main_layout.addLayout(self.channels_row)
+
         # create the output directory row
         self.output_row = QtWidgets.QHBoxLayout()
         self.output_label = QtWidgets.QLabel("Output Directory:")
         self.output_textbox = QtWidgets.QLineEdit()
-        self.output_textbox.setText(_output_directory)
+        self.output_textbox.setText(output_directory)
         self.output_textbox.setReadOnly(True)
         self.output_browse = QtWidgets.QPushButton("Browse")
         self.output_browse.clicked.connect(self.browse_output)
@@ -80,7 +150,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.target_row = QtWidgets.QHBoxLayout()
         self.target_label = QtWidgets.QLabel("Target Reference:")
         self.target_textbox = QtWidgets.QLineEdit()
-        self.target_textbox.setText(_target_file)
+        self.target_textbox.setText(target_file)
         self.target_textbox.setReadOnly(True)
         self.target_browse = QtWidgets.QPushButton("Browse")
         self.target_browse.clicked.connect(self.browse_target)
@@ -94,7 +164,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.warp_row = QtWidgets.QHBoxLayout()
         self.warp_label = QtWidgets.QLabel("Warp File:")
         self.warp_textbox = QtWidgets.QLineEdit()
-        self.warp_textbox.setText(_warp_file)
+        self.warp_textbox.setText(warp_file)
         self.warp_textbox.setReadOnly(True)
         self.warp_browse = QtWidgets.QPushButton("Browse")
         self.warp_browse.clicked.connect(self.browse_warp)
@@ -107,7 +177,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.inverse_warp_row = QtWidgets.QHBoxLayout()
         self.inverse_warp_label = QtWidgets.QLabel("Inverse Warp File:")
         self.inverse_warp_textbox = QtWidgets.QLineEdit()
-        self.inverse_warp_textbox.setText(_inverse_warp_file)
+        self.inverse_warp_textbox.setText(inverse_warp_file)
         self.inverse_warp_textbox.setReadOnly(True)
         self.inverse_warp_browse = QtWidgets.QPushButton("Browse")
         self.inverse_warp_browse.clicked.connect(self.browse_inverse_warp)
@@ -120,7 +190,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.affine_row = QtWidgets.QHBoxLayout()
         self.affine_label = QtWidgets.QLabel("Affine File:")
         self.affine_textbox = QtWidgets.QLineEdit()
-        self.affine_textbox.setText(_affine_file)
+        self.affine_textbox.setText(affine_file)
         self.affine_textbox.setReadOnly(True)
         self.affine_browse = QtWidgets.QPushButton("Browse")
         self.affine_browse.clicked.connect(self.browse_affine)
@@ -199,20 +269,32 @@ class MainWindow(QtWidgets.QMainWindow):
         self.low_memory_checkbox = QtWidgets.QCheckBox("Low Memory")
         self.low_memory_checkbox.setChecked(True)
         self.flip_brain_checkbox = QtWidgets.QCheckBox("Mirror Before Warping")
-        self.flip_brain_checkbox.setChecked(_was_flipped)
+        self.flip_brain_checkbox.setChecked(was_flipped)
         self.debug_mode_checkbox = QtWidgets.QCheckBox("Debug Mode")
         self.debug_mode_checkbox.setChecked(False)
+        self.native_engine_checkbox = QtWidgets.QCheckBox("Native Engine")
+        self.native_engine_checkbox.setChecked(False)
+        self.native_engine_checkbox.setToolTip("Warp volumes and labels in-process instead of calling antsApplyTransforms")
         self.final_row.addWidget(self.affine_only_checkbox)
         self.final_row.addWidget(self.time_series_checkbox)
         self.final_row.addWidget(self.low_memory_checkbox)
         self.final_row.addWidget(self.flip_brain_checkbox)
         self.final_row.addWidget(self.debug_mode_checkbox)
+        self.final_row.addWidget(self.native_engine_checkbox)
         self.main_layout.addLayout(self.final_row)
 
-        # create the run button
+        # create the run and cancel buttons
+        self.run_row = QtWidgets.QHBoxLayout()
         self.run_button = QtWidgets.QPushButton("Run Warping")
         self.run_button.clicked.connect(self.run_warping)
-        self.main_layout.addWidget(self.run_button)
+        self.cancel_button = QtWidgets.QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel_warping)
+        self.cancel_button.setEnabled(False)
+        self.run_row.addWidget(self.run_button)
+        self.run_row.addWidget(self.cancel_button)
+        self.main_layout.addLayout(self.run_row)
+        self.cancel_event = threading.Event()
+        self.warping_succeeded = False
 
         # create the terminal
         self.terminal = QtWidgets.QTextEdit()
@@ -226,7 +308,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.show()
 
         # as the program starts, show a message to the user about the program using QtMessageBox
-        QtWidgets.QMessageBox.information(self, "About", about_message)
+        if show_about:
+            QtWidgets.QMessageBox.information(self, "About", about_message)
 
     # function to verify no spaces in the file names or directory names
     def verify_no_spaces(self, filename):
@@ -248,6 +331,24 @@ class MainWindow(QtWidgets.QMainWindow):
         # set the textbox to the filename
         self.input_textbox.setText(filename)
 
+    # function to browse for other channels of the input file
+    def browse_channels(self):
+        # open a file dialog (several files can be selected)
+        open_folder = os.getcwd() if self.input_textbox.text() == "" else os.path.dirname(self.input_textbox.text())
+        filenames = QtWidgets.QFileDialog.getOpenFileNames(self, 'Open Other Channels', open_folder, 'Image Files (*.nii.gz *.nrrd *.nhdr)')[0]
+        # make sure there are no spaces in the filenames and alert the user to change them if there are
+        for filename in filenames:
+            if self.verify_no_spaces(filename) is False:
+                return
+        # set the textbox to the filenames
+        self.channel_files = filenames
+        self.channels_textbox.setText(", ".join(os.path.basename(filename) for filename in filenames))
+
+    # function to clear the other channels
+    def clear_channels(self):
+        self.channel_files = []
+        self.channels_textbox.setText("")
+
     # function to browse for the target reference file
     def browse_target(self):
         # open a file dialog
@@ -426,6 +527,17 @@ class MainWindow(QtWidgets.QMainWindow):
             return
 
         special_warping_type = self.special_warping_type
+
+        # other channels are warped next to the input file with the same transforms
+        channel_files = list(self.channel_files)
+        if len(channel_files) > 0 and special_warping_type == "point_set":
+            QtWidgets.QMessageBox.warning(self, "Warning", "Other channels cannot be warped together with a point set.")
+            return
+        channel_prefixes = [os.path.join(output_directory, os.path.splitext(os.path.basename(channel_file))[0]+"_warped") for channel_file in channel_files]
+        if any(len(glob.glob(channel_prefix+"*")) > 0 for channel_prefix in channel_prefixes):
+            QtWidgets.QMessageBox.warning(self, "Warning", "Files with the same prefix as one of the other channels already exist. Please change the output directory.")
+            return
+
         time_series = self.time_series_checkbox.isChecked()
         low_memory = "1" if self.low_memory_checkbox.isChecked() else "0"
         flip_brain = self.flip_brain_checkbox.isChecked()
@@ -448,6 +560,39 @@ class MainWindow(QtWidgets.QMainWindow):
             intermediate_files.append(flipped_input_file[:-5]+"_out.log")
             intermediate_files.append(flipped_input_file[:-5]+"_err.log")
 
+            # flip the other channels the same way
+            for channel_index, channel_file in enumerate(channel_files):
+                channel_filename = os.path.basename(channel_file)
+                flipped_channel_file = output_directory + os.path.splitext(channel_filename)[0]+"_flipped"+os.path.splitext(channel_filename)[1]
+                flip_brain_commands.append("antsApplyTransforms -d 3 -i {} -o {} -t {} -r {} --float {} >{}_out.log 2>{}_err.log".format(channel_file, flipped_channel_file, mirror_file, channel_file, low_memory, flipped_channel_file[:-5], flipped_channel_file[:-5]))
+                channel_files[channel_index] = flipped_channel_file
+                intermediate_files.append(flipped_channel_file)
+                intermediate_files.append(flipped_channel_file[:-5]+"_out.log")
+                intermediate_files.append(flipped_channel_file[:-5]+"_err.log")
+
+        # warp in-process with the native engine (point sets and time series still use ANTs)
+        native_job = None
+        if self.native_engine_checkbox.isChecked() and special_warping_type != "point_set" and not time_series:
+            transforms = []
+            if warping_type == "to_template":
+                if not affine_only:
+                    transforms.append((warp_file, False))
+                transforms.append((affine_file, False))
+            elif warping_type == "from_template":
+                transforms.append((affine_file, True))
+                if not affine_only:
+                    transforms.append((inverse_warp_file, False))
+            if flip_brain:
+                # the mirror is applied as the last transform instead of writing a flipped copy first
+                transforms.append((mirror_file, False))
+                input_file = self.input_textbox.text()
+                channel_files = list(self.channel_files)
+                flip_brain_commands = []
+                intermediate_files = []
+            interpolation = "GenericLabel" if special_warping_type == "segmentation_label" else "Linear"
+            # the sample points are computed once for the input file and all other channels
+            native_job = ([input_file] + channel_files, target_file, [output_prefix[:-1]+".nrrd"] + [channel_prefix+".nrrd" for channel_prefix in channel_prefixes], transforms, interpolation)
+
         # create the command
         warping_command = "antsApplyTransforms" # base command
         warping_command += " -d 4 -e 3" if time_series else " -d 3"
@@ -477,6 +622,13 @@ class MainWindow(QtWidgets.QMainWindow):
         intermediate_files.append(output_prefix[:-1]+"_out.log")
         intermediate_files.append(output_prefix[:-1]+"_err.log")
 
+        # the same command for every other channel
+        warping_commands = [warping_command]
+        for channel_file, channel_prefix in zip(channel_files, channel_prefixes):
+            warping_commands.append(warping_command.replace(" -i "+input_file+" ", " -i "+channel_file+" ", 1).replace(output_prefix[:-1], channel_prefix))
+            intermediate_files.append(channel_prefix+"_out.log")
+            intermediate_files.append(channel_prefix+"_err.log")
+
         # output file
         out_file = output_prefix[:-1]+".nrrd" if not special_warping_type == "point_set" else output_prefix[:-1]+".csv"
         
@@ -487,8 +639,13 @@ class MainWindow(QtWidgets.QMainWindow):
             intermediate_files = []
 
         # disable all the buttons
+        self.cancel_event.clear()
+        self.warping_succeeded = False
+        self.cancel_button.setEnabled(True)
         self.run_button.setEnabled(False)
         self.input_browse.setEnabled(False)
+        self.channels_browse.setEnabled(False)
+        self.channels_clear.setEnabled(False)
         self.target_browse.setEnabled(False)
         self.output_browse.setEnabled(False)
         self.warp_browse.setEnabled(False)
@@ -504,13 +661,15 @@ class MainWindow(QtWidgets.QMainWindow):
         self.low_memory_checkbox.setEnabled(False)
         self.flip_brain_checkbox.setEnabled(False)
         self.debug_mode_checkbox.setEnabled(False)
+        self.native_engine_checkbox.setEnabled(False)
 
 
         # create a new thread to run the warping command
         self.warping_thread = QtCore.QThread()
-        self.warping_worker = WarpingWorker(warping_command, flip_brain_commands, intermediate_files)
+        self.warping_worker = WarpingWorker(warping_commands, flip_brain_commands, intermediate_files, native_job, self.cancel_event, self.transform_store)
         self.warping_worker.moveToThread(self.warping_thread)
         self.warping_thread.started.connect(self.warping_worker.run_warping)
+        self.warping_worker.finished.connect(self.set_warping_status)
         self.warping_worker.finished.connect(self.warping_thread.quit)
         self.warping_worker.finished.connect(self.warping_worker.deleteLater)
         self.warping_thread.finished.connect(self.warping_thread.deleteLater)
@@ -520,11 +679,18 @@ class MainWindow(QtWidgets.QMainWindow):
         # when the thread is finished, print a message and enable the run button
         self.warping_thread.finished.connect(self.warping_finished)
 
+    # function to remember if the warping succeeded
+    def set_warping_status(self, success):
+        self.warping_succeeded = success
+
     # function to print a message when the warping is finished
     def warping_finished(self):
         # enable all the buttons
+        self.cancel_button.setEnabled(False)
         self.run_button.setEnabled(True)
         self.input_browse.setEnabled(True)
+        self.channels_browse.setEnabled(True)
+        self.channels_clear.setEnabled(True)
         self.target_browse.setEnabled(True)
         self.output_browse.setEnabled(True)
         self.warp_browse.setEnabled(True)
@@ -540,40 +706,99 @@ class MainWindow(QtWidgets.QMainWindow):
         self.low_memory_checkbox.setEnabled(True)
         self.flip_brain_checkbox.setEnabled(True)
         self.debug_mode_checkbox.setEnabled(True)
+        self.native_engine_checkbox.setEnabled(True)
+
+        if self.cancel_event.is_set():
+            QtWidgets.QMessageBox.information(self, "Warping Cancelled", "Warping was cancelled.")
+            return
+        if not self.warping_succeeded:
+            QtWidgets.QMessageBox.warning(self, "Warping Failed", "Warping failed, check the terminal and the log files in the output directory.")
+            return
 
         # pop up a message box
         QtWidgets.QMessageBox.information(self, "Warping Finished", "Warping finished check the output directory for the registered file: {}".format(self.out_file))
 
+    # function to cancel the running warping (the native engine is stopped between blocks)
+    def cancel_warping(self):
+        self.cancel_button.setEnabled(False)
+        self.update_terminal("Cancelling...")
+        self.cancel_event.set()
+
     # function to update the terminal
     def update_terminal(self, text):
         self.terminal.append(text)
 
 # create a worker class to run the warping command
 class WarpingWorker(QtCore.QObject):
-    finished = QtCore.pyqtSignal()
+    # True if all commands succeeded
+    finished = QtCore.pyqtSignal(bool)
     progress = QtCore.pyqtSignal(str)
 
-    def __init__(self, warping_command, flip_brain_commands, intermediate_files):
+    def __init__(self, warping_commands, flip_brain_commands, intermediate_files, native_job=None, cancel_event=None, transform_store=None):
         super().__init__()
-        self.warping_command = warping_command
+        self.warping_commands = warping_commands
         self.flip_brain_commands = flip_brain_commands
         self.intermediate_files = intermediate_files
+        self.native_job = native_job
+        self.cancel_event = cancel_event if cancel_event is not None else threading.Event()
+        self.transform_store = transform_store if transform_store is not None else TransformStore()
 
-    def run_warping(self):
+    # function to run the commands, returns True if all of them succeeded
+    def run_commands(self):
         if len(self.flip_brain_commands) > 0:
             self.progress.emit("Flipping brain...")
             self.progress.emit("")
             # run the flip brain command
             for command in self.flip_brain_commands:
                 self.progress.emit(command)
-                os.system(command)
+                returncode = run_command(command, log=self.progress.emit, cancel=self.cancel_event.is_set)
                 self.progress.emit("")
+                if returncode != 0:
+                    self.progress.emit("Flipping failed with exit code {}.".format(returncode))
+                    return False
 
         # run the warping command
+        if self.cancel_event.is_set():
+            raise CommandStopped("cancelled")
         self.progress.emit("Running warping...")
         self.progress.emit("")
-        self.progress.emit(self.warping_command)
-        os.system(self.warping_command)
+        if self.native_job is not None:
+            input_files, target_file, output_files, transforms, interpolation = self.native_job
+            self.progress.emit("Native warping of {} onto {} ({} interpolation)".format(", ".join(input_files), target_file, interpolation))
+            for transform_file, invert in transforms:
+                self.progress.emit("  transform: {}{}".format(transform_file, " (inverted)" if invert else ""))
+            try:
+                # transforms and the reference geometry loaded before are reused
+                warp_images(input_files, self.transform_store.get_geometry(target_file), output_files, self.transform_store.get_steps(transforms), interpolation, cancel=self.cancel_event.is_set)
+            except CommandStopped:
+                raise
+            except Exception as error:
+                self.progress.emit("Native warping failed: {}".format(error))
+                return False
+        else:
+            # ANTs reads the decompressed copies of the compressed transforms
+            transform_files = [path for path in re.findall(r'(?:-t \[?)([^\s,\]]+)', " ".join(self.warping_commands)) if path.endswith(".gz")]
+            if len(transform_files) > 0:
+                self.progress.emit("Decompressing transforms (copies made before are reused)...")
+            copies = dict(zip(transform_files, self.transform_store.get_files(transform_files)))
+            for command in self.warping_commands:
+                for path, copy in copies.items():
+                    command = re.sub(r'(-t \[?){}(?=[\s,\]])'.format(re.escape(path)), lambda match: match.group(1) + copy, command)
+                self.progress.emit(command)
+                returncode = run_command(command, log=self.progress.emit, cancel=self.cancel_event.is_set)
+                self.progress.emit("")
+                if returncode != 0:
+                    self.progress.emit("Warping failed with exit code {}.".format(returncode))
+                    return False
+        return True
+
+    def run_warping(self):
+        # every command runs in its own process group, which is stopped as a whole when cancelled
+        success = False
+        try:
+            success = self.run_commands()
+        except CommandStopped as reason:
+            self.progress.emit("Warping stopped: {}.".format(reason))
 
         # remove all empty log/error files
         if len(self.intermediate_files) > 0:
@@ -608,17 +833,24 @@ class WarpingWorker(QtCore.QObject):
                     self.progress.emit("")
 
         self.progress.emit("")
-        self.progress.emit("Warping finished.")
+        self.progress.emit("Warping finished." if success else "Warping failed.")
         # emit the finished signal
-        self.finished.emit()
+        self.finished.emit(success)
 
 # create the main function
 def main():
     # create the application
     app = QtWidgets.QApplication(sys.argv)
 
+    # the files of a registration can be given as arguments (MISSING for missing files)
+    files = {}
+    if len(sys.argv) == 7:
+        names = ['output_directory', 'target_file', 'warp_file', 'inverse_warp_file', 'affine_file']
+        files = {name: (value if value != "MISSING" else "") for name, value in zip(names, sys.argv[1:6])}
+        files['was_flipped'] = sys.argv[6] == "flipped"
+
     # create the main window
-    main_window = MainWindow()
+    main_window = MainWindow(**files)
 
     # exit the application
     sys.exit(app.exec_())
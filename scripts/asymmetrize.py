@@ -5,6 +5,7 @@ import numpy as np # linear algebra
 import pandas as pd # data processing, CSV file I/O (e.g. pd.read_csv)
 import glob # file handling
 import argparse # command line arguments
+from dataset_views import get_views_dir, make_manifest, build_view # link-based dataset views
 
 # clear output
 os.system('cls' if os.name == 'nt' else 'clear')
@@ -13,15 +14,18 @@ os.system('cls' if os.name == 'nt' else 'clear')
 start_string = 'Kronauer Lab - Microscopy Image Processing Pipeline\n'
 start_string += "="*(len(start_string)-1) + '\n'
 start_string += 'Asymmetrize Resampled Images by Rishika Mohanta\n'
-start_string += 'Version 1.2.0\n'
+start_string += 'Version 2.0.0\n'
 
 print(start_string)
 
 # parse command line arguments
 parser = argparse.ArgumentParser(description='Filter confocal images to keep only uniformly asymmetric brains.')
 parser.add_argument('-i','--input_dir', type=str, help='path to input directory (must contain .nrrd files; default: ./resampled_data/whole_brain/)', default="./resampled_data/whole_brain/", nargs='?')
-parser.add_argument('-o','--output_dir', type=str, help='path to output directory; default: same as input directory', default="", nargs='?')
-parser.add_argument('-b','--backup_dir', type=str, help='path to backup directory (default: <input_dir>/backup/)', default="", nargs='?')
+parser.add_argument('-view','--view_name', type=str, help='name of the view to build in <input_dir>/views/ (default: left or right, with a _quality_affine suffix if -q is set)', default="", nargs='?')
+parser.add_argument('-l','--link', type=str, help='type of links in the view (symlink or hardlink; default: symlink)', default="symlink", nargs='?')
+parser.add_argument('-mv','--move', action='store_true', help='(LEGACY) move the files into the output, backup and diff directories instead of building a view')
+parser.add_argument('-o','--output_dir', type=str, help='(LEGACY, with --move) path to output directory; default: same as input directory', default="", nargs='?')
+parser.add_argument('-b','--backup_dir', type=str, help='(LEGACY, with --move) path to backup directory (default: <input_dir>/backup/)', default="", nargs='?')
 parser.add_argument('-meta','--metadata', type=str, help='path to metadata file (default: ./whole_brain_metadata.csv)', default="./whole_brain_metadata.csv", nargs='?')
 parser.add_argument('-lr','--left_or_right', type=str, help='left or right (default: left)', default="left", nargs='?')
 parser.add_argument('-q','--quality_affine', type=bool, help='(ARCHIVED) whether to use quality affine (default: False)', default=False, nargs='?')
@@ -41,25 +45,30 @@ data_files = list(glob.glob(os.path.join(input_dir, "*.nrrd")))
 
 assert len(data_files) > 0, "Input directory does not contain any files."
 
-# create output directory if it does not exist
-output_dir = args.output_dir
+# check link type
+link_type = args.link
+assert link_type in ['symlink', 'hardlink'], "Link type must be either 'symlink' or 'hardlink'."
 
-if output_dir == "":
-    output_dir = input_dir
-if not os.path.isdir(output_dir):
-    os.makedirs(output_dir)
+if args.move:
+    # create output directory if it does not exist
+    output_dir = args.output_dir
 
-print("Output directory: {}".format(output_dir))
+    if output_dir == "":
+        output_dir = input_dir
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
 
-# create backup directory if it does not exist
-backup_dir = args.backup_dir
+    print("Output directory: {}".format(output_dir))
 
-if backup_dir == "":
-    backup_dir = os.path.join(input_dir, "backup")
-if not os.path.isdir(backup_dir):
-    os.makedirs(backup_dir)
+    # create backup directory if it does not exist
+    backup_dir = args.backup_dir
 
-print("Backup directory: {}".format(backup_dir))
+    if backup_dir == "":
+        backup_dir = os.path.join(input_dir, "backup")
+    if not os.path.isdir(backup_dir):
+        os.makedirs(backup_dir)
+
+    print("Backup directory: {}".format(backup_dir))
 
 # check if metadata file exists
 metadata_file = args.metadata
@@ -112,7 +121,7 @@ if quality_affine:
 else:
     print("Keeping only {} or symmetric brains.".format(left_or_right))
 
-if quality_affine:
+if quality_affine and args.move:
     # create diff directory if it does not exist
     diff_dir = args.diff_dir
 
@@ -122,7 +131,10 @@ if quality_affine:
         os.makedirs(diff_dir)
     
 
-# loop through all files
+# sort all files into the selected files, the backup (not used) and the diff files (only used for the final template)
+groups = {'selected': [], 'backup': []}
+if quality_affine:
+    groups['diff'] = []
 for data_file in data_files:
     # get clean name
     clean_name = os.path.basename(data_file)
@@ -141,46 +153,45 @@ for data_file in data_files:
     # see if we need to keep this file
     if not quality_affine:
         if egocentric_leaning == left_or_right or egocentric_leaning == 'sym':
-            # check if mirror file
-            if is_mirror:
-                # move to backup directory
-                os.rename(data_file, os.path.join(backup_dir, os.path.basename(data_file)))
-            else:
-                # move to output directory
-                os.rename(data_file, os.path.join(output_dir, os.path.basename(data_file)))
+            # keep the original, not the mirror
+            groups['backup' if is_mirror else 'selected'].append(data_file)
         else:
-            # check if mirror file
-            if is_mirror:
-                # move to output directory
-                os.rename(data_file, os.path.join(output_dir, os.path.basename(data_file)))
-            else:
-                # move to backup directory
-                os.rename(data_file, os.path.join(backup_dir, os.path.basename(data_file)))
+            # keep the mirror, not the original
+            groups['selected' if is_mirror else 'backup'].append(data_file)
     else:
         if egocentric_leaning == 'sym' or manually_skipped_this == True:
-            # move to diff directory if not mirror file else move to backup directory
-            if is_mirror:
-                # move to backup directory
-                os.rename(data_file, os.path.join(backup_dir, os.path.basename(data_file)))
-            else:
-                # move to diff directory
-                os.rename(data_file, os.path.join(diff_dir, os.path.basename(data_file)))
+            # original only for the final template, no mirror
+            groups['backup' if is_mirror else 'diff'].append(data_file)
         elif egocentric_leaning == left_or_right:
-            # check if mirror file
-            if is_mirror:
-                # move to backup directory
-                os.rename(data_file, os.path.join(backup_dir, os.path.basename(data_file)))
-            else:
-                # move to output directory
-                os.rename(data_file, os.path.join(output_dir, os.path.basename(data_file)))
+            # keep the original, not the mirror
+            groups['backup' if is_mirror else 'selected'].append(data_file)
         else:
-            # check if mirror file
-            if is_mirror:
-                # move to output directory
-                os.rename(data_file, os.path.join(output_dir, os.path.basename(data_file)))
-            else:
-                # move to backup directory
-                os.rename(data_file, os.path.join(backup_dir, os.path.basename(data_file)))
+            # keep the mirror, not the original
+            groups['selected' if is_mirror else 'backup'].append(data_file)
+
+print("{} files selected, {} files in backup{}.".format(len(groups['selected']), len(groups['backup']), ", {} files in diff".format(len(groups['diff'])) if quality_affine else ""))
+
+if args.move:
+    # move the files into the output, backup and diff directories
+    destinations = {'selected': output_dir, 'backup': backup_dir}
+    if quality_affine:
+        destinations['diff'] = diff_dir
+    for group, files in groups.items():
+        for data_file in files:
+            os.rename(data_file, os.path.join(destinations[group], os.path.basename(data_file)))
+else:
+    # build a view of links, the files in the input directory are not touched
+    view_name = args.view_name
+    if view_name == "":
+        view_name = left_or_right + ("_quality_affine" if quality_affine else "")
+    views_dir = get_views_dir(input_dir)
+    os.makedirs(views_dir, exist_ok=True)
+    view_path = os.path.join(views_dir, view_name)
+    build_view(view_path, make_manifest(view_name, input_dir, groups), link_type)
+    print("View directory: {} (use it as the input of the template construction)".format(view_path))
+    print("Backup files: {}".format(os.path.join(view_path, "backup")))
+    if quality_affine:
+        print("Diff files: {}".format(os.path.join(view_path, "diff")))
 
 # print end string
 end_string = 'Done processing all files. Exiting...\n'
@@ -0,0 +1,486 @@
+# a script to register a batch of brains to a template without the GUI
+
+## IMPLEMENTATION DETAILS
+# Every brain is registered with the same antsIntroduction.sh call as in UI_registration.py
+# (the commands are built here and used by both), but the brains of a batch are registered
+# concurrently on the memory-aware process pool of job_scheduler.py: at most --num_workers
+# registrations run at a time, every one with its share of the CPUs as ITK threads, and a
+# registration is only started if the estimates of all running ones fit into the memory
+# budget. A registration holds the template and the input brain plus several float32
+# volumes on the template grid (the warped image, its gradients and the forward and inverse
+# displacement fields), which is what its estimate counts.
+# Every registration (also a single one from the GUI) runs in its own scratch directory,
+# made under $SLURM_TMPDIR (node-local on the cluster), the temporary directory or
+# --scratch_dir: the commands run there and write all their files there, including the
+# tmp* folder, .cfg file and .nii.gz file antsIntroduction.sh leaves in its working
+# directory. When the registration is done its results (the files named after the output
+# prefix, the .mat reflection matrix of a flipped brain and the logs of failed commands) are moved to the output directory by name and
+# the scratch directory is removed with everything else (in debug mode everything is kept).
+# So registrations never see each other's files and any number can run side by side.
+# Every command of a registration can be cancelled and stopped by time limits (wall time and
+# CPU time per command, see command_runner.py); a batch is cancelled by creating its cancel
+# file (the summary file with .cancel instead of .json): running registrations are stopped
+# and the waiting ones are skipped.
+# A failed registration does not stop the batch. The batch summary (JSON) is rewritten
+# atomically whenever a registration finishes: the settings, the progress (finished and
+# failed registrations) and, for every brain, its status, start and end time, duration,
+# exit code and output files.
+
+import os # file handling
+import sys # exit code
+import glob # input patterns
+import json # batch summary
+import time # job timings
+import shutil # moving output files
+import datetime # date and time
+import argparse # command line arguments
+import tempfile # scratch directories
+from command_runner import run_command, parse_iterations, CommandStopped, PROGRESS_INTERVAL # running ANTs with live progress and job control
+from job_scheduler import run_jobs, estimate_memory, read_image_header, parse_memory, format_memory # memory-aware job scheduling
+
+# registration types of antsIntroduction.sh
+REGISTRATION_TYPES = ['RI', 'RA', 'EL', 'SY', 'S2', 'GR', 'EX', 'DD']
+
+# similarity metrics of antsIntroduction.sh
+SIMILARITY_METRICS = ['CC', 'MI', 'MSQ', 'PR']
+
+# parameters of a registration (as set in the GUI by default)
+DEFAULT_PARAMETERS = {
+    'num_iterations': '30x90x20x8',
+    'registration_type': 'GR',
+    'similarity_metric': 'CC',
+    'n4_bias_field': True,
+    'quality_check': False,
+    'low_memory': False,
+    'flip_brain': False,
+    'debug_mode': False,
+}
+
+# float32 volumes on the template grid held by a running registration
+REGISTRATION_VOLUMES = 12
+
+# minimum number of seconds between two progress messages of a registration in a batch
+BATCH_PROGRESS_INTERVAL = 60
+
+# output files of antsIntroduction.sh (appended to the output prefix)
+OUTPUT_SUFFIXES = {
+    'deformed': 'deformed.nii.gz',
+    'warp': 'Warp.nii.gz',
+    'inverse_warp': 'InverseWarp.nii.gz',
+    'affine': 'Affine.txt',
+}
+
+
+# function to check the parameters of a registration
+def check_parameters(parameters):
+    """
+    Return the parameters completed with the defaults, after checking that they are valid.
+    """
+    unknown = set(parameters) - set(DEFAULT_PARAMETERS)
+    assert len(unknown) == 0, "Unknown registration parameters: {}".format(", ".join(sorted(unknown)))
+    parameters = dict(DEFAULT_PARAMETERS, **parameters)
+    try:
+        assert all(int(i) > 0 for i in parameters['num_iterations'].split("x"))
+    except ValueError:
+        raise AssertionError("Number of iterations must be a series of positive integers separated by x.")
+    assert parameters['registration_type'] in REGISTRATION_TYPES, "Registration type must be one of {}.".format(", ".join(REGISTRATION_TYPES))
+    assert parameters['similarity_metric'] in SIMILARITY_METRICS, "Similarity metric must be one of {}.".format(", ".join(SIMILARITY_METRICS))
+    return parameters
+
+
+# function to get the input files of a batch
+def expand_inputs(patterns):
+    """
+    Return the input files matching a list of file names and glob patterns (in order, without duplicates).
+    """
+    input_files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        assert len(matches) > 0, "No input files match {}.".format(pattern)
+        for path in matches:
+            assert os.path.isfile(path), "Input file {} does not exist.".format(path)
+            assert " " not in os.path.abspath(path), "File name or directory name cannot contain spaces: {}".format(path)
+            if os.path.abspath(path) not in input_files:
+                input_files.append(os.path.abspath(path))
+    return input_files
+
+
+# function to get the output prefix of a registration
+def get_output_prefix(input_file, output_directory):
+    """
+    Return the prefix of the output files of the registration of input_file.
+    """
+    return os.path.join(output_directory, os.path.splitext(os.path.basename(input_file))[0] + "_")
+
+
+# function to get the mirror file of a flipped registration
+def get_mirror_file(input_file, output_directory):
+    """
+    Return the reflection matrix written when input_file is flipped before its registration.
+    """
+    input_filename = os.path.basename(input_file)
+    return os.path.join(output_directory, (input_filename[:-5] if input_filename.endswith(".nrrd") else input_filename[:-7]) + '.mat')
+
+
+# function to build the commands of a registration
+def get_registration_commands(template_file, input_file, output_directory, parameters):
+    """
+    Return (registration command, flip brain commands, intermediate files, output prefix) of the
+    registration of input_file to template_file. Writes the flip marker file if the brain is flipped.
+    """
+    parameters = check_parameters(parameters)
+    input_filename = os.path.basename(input_file)
+    output_directory = os.path.join(output_directory, "")
+    output_prefix = get_output_prefix(input_file, output_directory)
+    n4_bias_field = "1" if parameters['n4_bias_field'] else "0"
+    quality_check = "1" if parameters['quality_check'] else "0"
+    low_memory_flip = "1" if parameters['low_memory'] else "0"
+
+    # create a list of intermediate files
+    intermediate_files = []
+
+    # create a list of flip brain commands
+    flip_brain_commands = []
+
+    # create the flip brain command
+    if parameters['flip_brain']:
+        # define flipped command
+        flipped_input_file = output_directory + os.path.splitext(input_filename)[0]+"_flipped"+os.path.splitext(input_filename)[1]
+        mirror_file = get_mirror_file(input_file, output_directory)
+        flip_brain_commands.append("ImageMath 3 {} ReflectionMatrix {} 0 >{}_out.log 2>{}_err.log".format(mirror_file, input_file, mirror_file[:-4], mirror_file[:-4]))
+        flip_brain_commands.append("antsApplyTransforms -d 3 -i {} -o {} -t {} -r {} --float {} >{}_out.log 2>{}_err.log".format(input_file, flipped_input_file, mirror_file, input_file, low_memory_flip, flipped_input_file[:-5], flipped_input_file[:-5]))
+        # create a file that be a reminder that the brain was flipped
+        flip_marker_file = output_directory + os.path.splitext(input_filename)[0]+"_flipped.txt"
+        with open(flip_marker_file, "w") as f:
+            f.write("This file is a reminder that the brain was flipped before registration.")
+        # set the input file to the flipped input file
+        input_file = flipped_input_file
+
+        # add the intermediate files to the list (log files included)
+        intermediate_files.append(flipped_input_file)
+        intermediate_files.append(mirror_file[:-4]+"_out.log")
+        intermediate_files.append(mirror_file[:-4]+"_err.log")
+        intermediate_files.append(flipped_input_file[:-5]+"_out.log")
+        intermediate_files.append(flipped_input_file[:-5]+"_err.log")
+
+    # create the registration command
+    registration_command = "antsIntroduction.sh -d 3 -r "+template_file+" -i "+input_file+" -o "+output_prefix+" -m "+parameters['num_iterations']+" -t "+parameters['registration_type']+" -n "+n4_bias_field+" -q "+quality_check+" -s "+parameters['similarity_metric']+" >"+output_prefix+"out.log 2>"+output_prefix+"err.log"
+
+    # add the intermediate files to the list (log files included)
+    intermediate_files.append(output_prefix+"out.log")
+    intermediate_files.append(output_prefix+"err.log")
+
+    if parameters['debug_mode']:
+        intermediate_files = []
+
+    return registration_command, flip_brain_commands, intermediate_files, output_prefix
+
+
+# function to get the directory for the scratch directories of registrations
+def get_scratch_root(scratch_root=""):
+    """
+    Return the directory in which the scratch directories of registrations are made: scratch_root if
+    given, else the node-local directory of the batch system (SLURM_TMPDIR) or the temporary directory.
+    """
+    if scratch_root == "":
+        scratch_root = os.environ.get('SLURM_TMPDIR', tempfile.gettempdir())
+    os.makedirs(scratch_root, exist_ok=True)
+    return scratch_root
+
+
+# function to move a file or folder to the output directory
+def move_output(path, output_directory):
+    """
+    Move a file (copied under a temporary name and renamed if it is on another file system, so a
+    partial file never appears in the output directory) or folder into output_directory.
+    """
+    output_path = os.path.join(output_directory, os.path.basename(path))
+    if os.path.isdir(path):
+        if os.path.isdir(output_path):
+            shutil.rmtree(output_path)
+        shutil.move(path, output_path)
+        return output_path
+    shutil.move(path, output_path + '.part')
+    os.replace(output_path + '.part', output_path)
+    return output_path
+
+
+# function to move the results of a registration to the output directory
+def gather_outputs(scratch_dir, output_directory, output_prefix, intermediate_files, output_files=(), log=print):
+    """
+    Move the files of a registration from its scratch directory to output_directory (in name order)
+    and return their new paths. The files named after the output prefix and output_files (e.g. the
+    mirror file of a flipped brain, needed for warping) are results; intermediate
+    files and everything else antsIntroduction.sh leaves behind (tmp* folder, .cfg and .nii.gz
+    files) are left to be removed with the scratch directory unless there are no intermediate files
+    (debug mode). Log files are kept in pairs (_out.log and _err.log) if anything was written to the error log.
+    """
+    log("Moving output files...")
+    output_name = os.path.basename(output_prefix)
+    intermediate_names = set(os.path.basename(file) for file in intermediate_files)
+    output_names = set(os.path.basename(file) for file in output_files)
+    kept = []
+    for name in sorted(os.listdir(scratch_dir)):
+        path = os.path.join(scratch_dir, name)
+        if name.endswith("_out.log") or name.endswith("_err.log"):
+            # keep the logs of failed commands
+            error_file = path[:-8]+"_err.log"
+            keep = len(intermediate_files) == 0 or (os.path.isfile(error_file) and os.stat(error_file).st_size > 0)
+        elif name in intermediate_names:
+            keep = False
+        else:
+            keep = name.startswith(output_name) or name in output_names or len(intermediate_files) == 0
+        if keep:
+            kept.append(path)
+    # nothing is moved before all files are checked (the error log decides about its output log)
+    outputs = []
+    for path in kept:
+        log("mv "+path+" "+output_directory)
+        outputs.append(move_output(path, output_directory))
+    return outputs
+
+
+# function to run the commands of a registration
+def run_registration_commands(registration_command, flip_brain_commands, working_directory, iterations=None, log=print, interval=PROGRESS_INTERVAL, cancel=None, wall_time=0, cpu_time=0):
+    """
+    Run the flip brain commands and the registration command in working_directory, passing their
+    errors and the progress of the registration (see command_runner.run_command) to log, and return
+    the exit code of the first command that failed (0 if all succeeded; later commands are skipped).
+    Raises CommandStopped if a command is cancelled or exceeds wall_time or cpu_time seconds.
+    """
+    if len(flip_brain_commands) > 0:
+        log("Flipping the brain...")
+        log("")
+        # run the flip brain command
+        for command in flip_brain_commands:
+            log(command)
+            returncode = run_command(command, working_directory, log, interval=interval, cancel=cancel, wall_time=wall_time, cpu_time=cpu_time)
+            log("")
+            if returncode != 0:
+                return returncode
+    # run the registration command
+    log("Running registration...")
+    log("")
+    log(registration_command)
+    return run_command(registration_command, working_directory, log, iterations, interval=interval, cancel=cancel, wall_time=wall_time, cpu_time=cpu_time)
+
+
+# function to run a registration in its own scratch directory
+def run_registration(template_file, input_file, output_directory, parameters, scratch_root="", log=print, interval=PROGRESS_INTERVAL, cancel=None, wall_time=0, cpu_time=0):
+    """
+    Register input_file to template_file in a new scratch directory under scratch_root (see
+    get_scratch_root), move the results to output_directory and remove the scratch directory.
+    Returns the exit code and the output prefix of the registration in output_directory.
+    Raises CommandStopped if it is cancelled or exceeds a time limit (see run_registration_commands).
+    """
+    parameters = check_parameters(parameters)
+    template_file = os.path.abspath(template_file)
+    input_file = os.path.abspath(input_file)
+    output_directory = os.path.abspath(output_directory)
+    os.makedirs(output_directory, exist_ok=True)
+    scratch_dir = tempfile.mkdtemp(prefix="registration_{}_".format(os.path.splitext(os.path.basename(input_file))[0]), dir=get_scratch_root(scratch_root))
+    log("Scratch directory: "+scratch_dir)
+    try:
+        registration_command, flip_brain_commands, intermediate_files, output_prefix = get_registration_commands(template_file, input_file, scratch_dir, parameters)
+        returncode = run_registration_commands(registration_command, flip_brain_commands, scratch_dir, parse_iterations(parameters['num_iterations']), log, interval, cancel, wall_time, cpu_time)
+        output_files = [get_mirror_file(input_file, scratch_dir)] if parameters['flip_brain'] else []
+        gather_outputs(scratch_dir, output_directory, output_prefix, intermediate_files, output_files, log)
+        for file in output_files:
+            if returncode == 0 and not os.path.isfile(os.path.join(output_directory, os.path.basename(file))):
+                log("Error: "+os.path.basename(file)+" was not written.")
+                returncode = 1
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    log("Registration finished.")
+    return returncode, get_output_prefix(input_file, output_directory)
+
+
+# function to register a brain to the template
+def register_brain(template_file, input_file, output_directory, parameters, scratch_root="", cancel_file="", wall_time=0, cpu_time=0):
+    """
+    Register input_file to template_file and return the record of the job for the batch summary
+    (status, timings, exit code, output files and the error if it failed). The registration is
+    cancelled (or skipped) if cancel_file exists.
+    """
+    name = os.path.basename(input_file)
+    record = {'input': input_file, 'start': time.time()}
+
+    # function to print the messages of this job
+    def log(text):
+        if text != "":
+            print("[{}] {}".format(name, text), flush=True)
+
+    # function to check if the batch was cancelled
+    def cancel():
+        return cancel_file != "" and os.path.exists(cancel_file)
+
+    try:
+        if cancel():
+            raise CommandStopped("cancelled")
+        record['returncode'], output_prefix = run_registration(template_file, input_file, output_directory, parameters, scratch_root, log, BATCH_PROGRESS_INTERVAL, cancel, wall_time, cpu_time)
+        record['outputs'] = {kind: output_prefix + suffix for kind, suffix in OUTPUT_SUFFIXES.items() if os.path.isfile(output_prefix + suffix)}
+        if parameters.get('flip_brain', False):
+            record['outputs']['flip_marker'] = output_prefix + "flipped.txt"
+            record['outputs']['mirror'] = get_mirror_file(input_file, output_directory)
+        if record['returncode'] != 0 or 'deformed' not in record['outputs']:
+            record['status'] = 'failed'
+            record['error'] = "antsIntroduction.sh exited with code {} (see {}err.log).".format(record['returncode'], output_prefix)
+        else:
+            record['status'] = 'done'
+    except CommandStopped as reason:
+        record['status'] = 'cancelled' if str(reason) == "cancelled" else 'failed'
+        record['error'] = "Registration stopped: {}.".format(reason)
+    except Exception as error:
+        record['status'] = 'failed'
+        record['error'] = "{}: {}".format(type(error).__name__, error)
+    record['end'] = time.time()
+    record['duration'] = record['end'] - record['start']
+    return record
+
+
+# function to estimate the memory used by a registration
+def estimate_registration_memory(template_file, input_file):
+    """
+    Return the estimated peak memory (in bytes) of the registration of input_file to template_file.
+    """
+    template_voxels = 1
+    for size in read_image_header(template_file)[0]:
+        template_voxels *= size
+    return estimate_memory([template_file, input_file]) + template_voxels * 4 * REGISTRATION_VOLUMES
+
+
+# function to write the batch summary
+def write_summary(summary_file, summary):
+    """
+    Write the batch summary to summary_file (written to a temporary file and renamed, so it is always complete).
+    """
+    with open(summary_file + '.tmp', 'w') as f:
+        json.dump(summary, f, indent=1)
+    os.replace(summary_file + '.tmp', summary_file)
+
+
+# function to register a batch of brains to the template
+def run_batch(template_file, input_files, output_directory, parameters, num_workers=1, mem_budget=0, num_threads=0, pin_threads=False, summary_file="", scratch_root="", wall_time=0, cpu_time=0, log=print):
+    """
+    Register every input file to template_file with the same parameters, several at a time (see
+    job_scheduler.run_jobs), each one in its own scratch directory under scratch_root (see
+    get_scratch_root), and keep the batch summary in summary_file up to date (default:
+    batch_registration_<timestamp>.json in the output directory). Every command of a registration
+    is stopped after wall_time seconds or cpu_time CPU seconds (0: no limit), and the batch is
+    cancelled by creating the cancel file (the summary file with .cancel instead of .json). Returns the summary.
+    """
+    parameters = check_parameters(parameters)
+    template_file = os.path.abspath(template_file)
+    output_directory = os.path.abspath(output_directory)
+    input_files = [os.path.abspath(path) for path in input_files]
+    assert os.path.isfile(template_file), "Template file {} does not exist.".format(template_file)
+    assert len(input_files) > 0, "No input files given."
+    names = [os.path.basename(path) for path in input_files]
+    assert len(set(names)) == len(names), "Input files must have different names (their outputs share the output directory)."
+    os.makedirs(output_directory, exist_ok=True)
+
+    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M')
+    if summary_file == "":
+        summary_file = os.path.join(output_directory, "batch_registration_{}.json".format(timestamp))
+    cancel_file = os.path.splitext(summary_file)[0] + ".cancel"
+    summary = {
+        'template': template_file,
+        'output_directory': output_directory,
+        'parameters': parameters,
+        'num_workers': num_workers,
+        'mem_budget': mem_budget,
+        'num_threads': num_threads,
+        'scratch_root': get_scratch_root(scratch_root),
+        'start': time.time(),
+        'end': None,
+        'total': len(input_files),
+        'finished': 0,
+        'failed': 0,
+        'cancelled': 0,
+        'cancel_file': cancel_file,
+        'wall_time': wall_time,
+        'cpu_time': cpu_time,
+        'jobs': [{'input': path, 'status': 'waiting'} for path in input_files],
+    }
+    write_summary(summary_file, summary)
+    log("Batch summary: {}".format(summary_file))
+
+    estimates = [estimate_registration_memory(template_file, path) for path in input_files]
+    jobs = [(template_file, path, output_directory, parameters, scratch_root, cancel_file, wall_time, cpu_time) for path in input_files]
+
+    # function to record a finished registration
+    def finish_job(index, record):
+        summary['jobs'][index] = record
+        summary['finished'] += 1
+        if record['status'] == 'failed':
+            summary['failed'] += 1
+        elif record['status'] == 'cancelled':
+            summary['cancelled'] += 1
+        write_summary(summary_file, summary)
+        log("[{}/{}] {} {} after {:.1f} min (estimated memory: {}).{}".format(summary['finished'], summary['total'], os.path.basename(record['input']), {'done': "registered", 'failed': "FAILED", 'cancelled': "cancelled"}[record['status']], record['duration'] / 60, format_memory(estimates[index]), "" if record['status'] == 'done' else " " + record['error']))
+
+    run_jobs(register_brain, jobs, estimates, num_workers, mem_budget, num_threads, pin_threads, callback=finish_job)
+    summary['end'] = time.time()
+    write_summary(summary_file, summary)
+    if os.path.exists(cancel_file):
+        os.remove(cancel_file)
+    log("Registered {} of {} brains in {:.1f} min ({} failed, {} cancelled). Summary: {}".format(summary['finished'] - summary['failed'] - summary['cancelled'], summary['total'], (summary['end'] - summary['start']) / 60, summary['failed'], summary['cancelled'], summary_file))
+    return summary
+
+
+# create the main function
+def main():
+    # clear output
+    os.system('cls' if os.name == 'nt' else 'clear')
+
+    # print start string
+    start_string = 'Kronauer Lab - Microscopy Image Processing Pipeline\n'
+    start_string += "="*(len(start_string)-1) + '\n'
+    start_string += 'Batch Brain Registration by Rishika Mohanta\n'
+    start_string += 'Version 1.0.0\n'
+
+    print(start_string)
+
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description='Register a batch of brains to a template with antsIntroduction.sh.')
+    parser.add_argument('-r','--template', type=str, help='path to the template file', required=True)
+    parser.add_argument('-i','--inputs', type=str, help='input files or glob patterns (quote the patterns, e.g. "new_brains/*.nrrd")', nargs='+', required=True)
+    parser.add_argument('-o','--output_dir', type=str, help='path to output directory (default: ./registered)', default="./registered", nargs='?')
+    parser.add_argument('-m','--num_iterations', type=str, help='iterations at each level of the registration (default: 30x90x20x8)', default="30x90x20x8", nargs='?')
+    parser.add_argument('-t','--registration_type', type=str, help='registration type of antsIntroduction.sh (RI: rigid, RA: rigid + affine, EL: elastic, SY: SyN with arbitrary time, S2: SyN with 2 time points, GR: greedy SyN, EX: exponential SyN, DD: diffeomorphic demons; default: GR)', default="GR", nargs='?')
+    parser.add_argument('-s','--similarity_metric', type=str, help='similarity metric (CC: cross correlation, MI: mutual information, MSQ: mean squared difference, PR: probability mapping; default: CC)', default="CC", nargs='?')
+    parser.add_argument('-nn4','--no_n4', action='store_true', help='do not run N4 bias field correction')
+    parser.add_argument('-qc','--quality_check', action='store_true', help='run the quality check of antsIntroduction.sh')
+    parser.add_argument('-lm','--low_memory', action='store_true', help='mirror the brains in single precision (with --flip)')
+    parser.add_argument('-f','--flip', action='store_true', help='mirror every brain before registration')
+    parser.add_argument('-d','--debug', action='store_true', help='keep the intermediate files and logs')
+    parser.add_argument('-n','--num_workers', type=int, help='maximum number of registrations to run at a time (0: one per CPU; default: 1)', default=1, nargs='?')
+    parser.add_argument('-mb','--mem_budget', type=str, help='memory budget shared by all registrations (e.g. 64G; 0: no limit; default: auto, the memory currently available)', default="auto", nargs='?')
+    parser.add_argument('-th','--threads', type=int, help='number of ITK threads per registration (0: split the CPUs between the registrations; default: 0)', default=0, nargs='?')
+    parser.add_argument('-pin','--pin_threads', action='store_true', help='pin each registration to its own CPUs')
+    parser.add_argument('-sd','--scratch_dir', type=str, help='directory for the scratch directories of the registrations, ideally on a local disk of the node (default: $SLURM_TMPDIR or the temporary directory)', default="", nargs='?')
+    parser.add_argument('-wt','--wall_time', type=float, help='stop a registration command that runs longer than this many hours (0: no limit; default: 0)', default=0, nargs='?')
+    parser.add_argument('-ct','--cpu_time', type=float, help='stop a registration command that uses more than this many CPU hours, summed over all its processes (0: no limit; default: 0)', default=0, nargs='?')
+    parser.add_argument('-sf','--summary_file', type=str, help='path to the batch summary (default: batch_registration_<timestamp>.json in the output directory; create the same file with .cancel instead of .json to cancel the batch)', default="", nargs='?')
+    args = parser.parse_args()
+
+    parameters = {
+        'num_iterations': args.num_iterations,
+        'registration_type': args.registration_type,
+        'similarity_metric': args.similarity_metric,
+        'n4_bias_field': not args.no_n4,
+        'quality_check': args.quality_check,
+        'low_memory': args.low_memory,
+        'flip_brain': args.flip,
+        'debug_mode': args.debug,
+    }
+    assert " " not in os.path.abspath(args.template) and " " not in os.path.abspath(args.output_dir), "File name or directory name cannot contain spaces."
+    input_files = expand_inputs(args.inputs)
+    print("Registering {} brains to {}.".format(len(input_files), args.template))
+
+    summary = run_batch(args.template, input_files, args.output_dir, parameters, args.num_workers, parse_memory(args.mem_budget), args.threads, args.pin_threads, args.summary_file, args.scratch_dir, args.wall_time * 3600, args.cpu_time * 3600)
+    sys.exit(1 if summary['failed'] + summary['cancelled'] > 0 else 0)
+
+# check if the script is being run directly
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+# helper functions to run ANTs commands with live progress
+
+## IMPLEMENTATION DETAILS
+# The commands of the GUIs redirect their output to log files (>prefix_out.log
+# 2>prefix_err.log), so nothing could be shown until they finished. Here such a command is
+# started without its redirections, and its stdout and stderr are read through non-blocking
+# pipes as they are written and copied to the same log files, so the logs stay as they were.
+# Lines on stderr are passed on as they come. Lines on stdout are parsed for the progress
+# of a registration:
+#   - antsRegistration: "Current level = 2 of 4" and
+#       " 2DIAGNOSTIC,     12, -4.1e-01, 1.2e-03, ..." (iteration, metric value, convergence)
+#   - ANTS (antsIntroduction.sh): lines with "Iteration <n>" or "Its <n>" and an "energy"
+#       or "metric" value (and a convergence value if there is one); a new level starts
+#       whenever the iteration count starts again from the beginning.
+# The latest progress is sent at most once per interval (and once at the end). With the
+# iterations of every level (e.g. 30x90x20x8) an ETA is estimated from the time per
+# iteration of the current level; every later level is assumed to take more time per
+# iteration by the ratio measured between the last two levels (or 8, as each level of the
+# default shrink factors has twice the resolution in every dimension).
+# Every command runs in a process group of its own (a new session), so that it can be
+# stopped together with everything it started (antsIntroduction.sh runs ANTS,
+# N4BiasFieldCorrection, ...): on cancellation or when a time limit is exceeded the group
+# gets SIGTERM and, after a grace period, SIGKILL, and CommandStopped is raised. The CPU time
+# of a group is the sum over its processes (and the children they waited for) in /proc.
+
+import os # file handling
+import re # output parsing
+import time # progress throttling and ETA
+import signal # stopping commands
+import selectors # non-blocking pipes
+import subprocess # running commands
+
+# minimum number of seconds between two progress messages
+PROGRESS_INTERVAL = 2.0
+
+# seconds between two checks for cancellation and the time limits of a command
+STOP_CHECK_INTERVAL = 0.5
+
+# seconds a stopped command gets to exit before it is killed
+STOP_GRACE_PERIOD = 5.0
+
+# assumed ratio of the time per iteration of a level and the one before it
+LEVEL_COST_FACTOR = 8.0
+
+# redirections of the output of a command to log files at its end
+REDIRECTION_PATTERN = re.compile(r'\s+>\s*(\S+)\s+2>\s*(\S+)\s*$')
+
+# progress lines of antsRegistration
+DIAGNOSTIC_PATTERN = re.compile(r'DIAGNOSTIC,\s*(\d+),\s*([-+\d.eE]+),\s*([-+\d.eE]+)')
+CURRENT_LEVEL_PATTERN = re.compile(r'Current level\s*=\s*(\d+)\s*of\s*(\d+)')
+
+# progress lines of ANTS
+ITERATION_PATTERN = re.compile(r'(?i)\b(?:iteration|its?)\s*[:=]?\s*(\d+)')
+METRIC_PATTERN = re.compile(r'(?i)\b(?:energy|metric(?:\s*value)?)\b(?:\s*\d+\s*:)?[^-+\d]*([-+]?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)')
+CONVERGENCE_PATTERN = re.compile(r'(?i)\bconverge\w*\b[^-+\d]*([-+]?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)')
+
+
+# exception raised when a command was cancelled or exceeded a time limit
+class CommandStopped(Exception):
+    pass
+
+
+# function to get the iterations of every level
+def parse_iterations(num_iterations):
+    """
+    Return the iterations of every level of a registration (e.g. '30x90x20x8' -> [30, 90, 20, 8]).
+    """
+    return [int(i) for i in num_iterations.split("x")]
+
+
+# function to format a duration
+def format_duration(seconds):
+    """
+    Return a duration in seconds as a short human readable string.
+    """
+    if seconds < 60:
+        return "{:.0f} s".format(seconds)
+    if seconds < 3600:
+        return "{:.1f} min".format(seconds / 60)
+    return "{:.1f} h".format(seconds / 3600)
+
+
+# class to follow the progress of a registration from its output
+class ProgressParser:
+    """
+    Parse the output lines of antsRegistration or ANTS into progress events: {'level', 'levels',
+    'iteration', 'iterations', 'metric', 'convergence', 'elapsed', 'eta'} (None where unknown).
+    """
+
+    def __init__(self, iterations=None):
+        self.iterations = iterations
+        self.start_time = time.time()
+        self.level = 0
+        self.levels = len(iterations) if iterations is not None else None
+        self.iteration = None
+        self.metric = None
+        self.convergence = None
+        # (time, iteration) at the start of every level seen so far and its time per iteration
+        self.level_start = {}
+        self.level_rate = {}
+
+    # function to start a level
+    def set_level(self, level):
+        if level == self.level and self.level in self.level_start:
+            return
+        self.level = level
+        self.iteration = None
+        self.level_start[level] = (time.time(), 0)
+
+    # function to parse a line of output
+    def feed(self, line):
+        """
+        Update the progress from a line of output and return True if it was a progress line.
+        """
+        match = CURRENT_LEVEL_PATTERN.search(line)
+        if match:
+            # antsRegistration counts the levels from 1
+            self.levels = int(match.group(2))
+            self.set_level(int(match.group(1)) - 1)
+            return True
+        match = DIAGNOSTIC_PATTERN.search(line)
+        if match:
+            self.set_iteration(int(match.group(1)))
+            self.metric = float(match.group(2))
+            self.convergence = float(match.group(3))
+            return True
+        iteration = ITERATION_PATTERN.search(line)
+        metric = METRIC_PATTERN.search(line)
+        if not iteration or not metric:
+            return False
+        self.set_iteration(int(iteration.group(1)))
+        self.metric = float(metric.group(1))
+        convergence = CONVERGENCE_PATTERN.search(line)
+        if convergence:
+            self.convergence = float(convergence.group(1))
+        return True
+
+    # function to record an iteration
+    def set_iteration(self, iteration):
+        if self.level not in self.level_start:
+            self.level_start[self.level] = (self.start_time, 0)
+        elif self.iteration is not None and iteration < self.iteration:
+            # the iterations start again at the next level (which started with this iteration)
+            self.set_level(self.level + 1)
+            self.level_start[self.level] = (time.time(), iteration)
+        self.iteration = iteration
+        start_time, start_iteration = self.level_start[self.level]
+        if iteration > start_iteration:
+            self.level_rate[self.level] = (time.time() - start_time) / (iteration - start_iteration)
+
+    # function to estimate the remaining time
+    def get_eta(self):
+        """
+        Return the estimated number of seconds until the last level is done (None if unknown).
+        """
+        if self.iterations is None or self.level not in self.level_rate or self.level >= len(self.iterations):
+            return None
+        rate = self.level_rate[self.level]
+        factor = LEVEL_COST_FACTOR
+        if self.level - 1 in self.level_rate and self.level_rate[self.level - 1] > 0:
+            factor = max(1.0, rate / self.level_rate[self.level - 1])
+        eta = max(self.iterations[self.level] - self.iteration, 0) * rate
+        for level in range(self.level + 1, len(self.iterations)):
+            rate *= factor
+            eta += self.iterations[level] * rate
+        return eta
+
+    # function to get the current progress
+    def get_event(self):
+        """
+        Return the current progress event.
+        """
+        return {
+            'level': self.level + 1,
+            'levels': self.levels,
+            'iteration': self.iteration,
+            'iterations': self.iterations[self.level] if self.iterations is not None and self.level < len(self.iterations) else None,
+            'metric': self.metric,
+            'convergence': self.convergence,
+            'elapsed': time.time() - self.start_time,
+            'eta': self.get_eta(),
+        }
+
+
+# function to format a progress event
+def format_progress(event):
+    """
+    Return a progress event as a line for the terminal.
+    """
+    text = "Level {}{}".format(event['level'], "/{}".format(event['levels']) if event['levels'] else "")
+    if event['iteration'] is not None:
+        text += ", iteration {}{}".format(event['iteration'], "/{}".format(event['iterations']) if event['iterations'] else "")
+    if event['metric'] is not None:
+        text += ", metric {:.6g}".format(event['metric'])
+    if event['convergence'] is not None:
+        text += ", convergence {:.3g}".format(event['convergence'])
+    text += ", elapsed {}".format(format_duration(event['elapsed']))
+    if event['eta'] is not None:
+        text += ", ETA {}".format(format_duration(event['eta']))
+    return text
+
+
+# function to split the log redirections off a command
+def split_redirections(command):
+    """
+    Return (command, stdout log, stderr log) for a command ending with >out.log 2>err.log
+    (the logs are None if it does not).
+    """
+    match = REDIRECTION_PATTERN.search(command)
+    if match is None:
+        return command, None, None
+    return command[:match.start()], match.group(1), match.group(2)
+
+
+# function to get the CPU time used by a process group
+def get_group_cpu_time(pgid):
+    """
+    Return the CPU seconds used by all processes of a process group, including the children they
+    already waited for (0 where /proc is not available).
+    """
+    if not os.path.isdir('/proc'):
+        return 0.0
+    total = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(pid), 'r') as f:
+                stat = f.read()
+        except OSError:
+            # the process is gone
+            continue
+        # the fields after the command name: state, ppid, pgrp, ... utime, stime, cutime, cstime
+        fields = stat[stat.rindex(')') + 2:].split()
+        if int(fields[2]) == pgid:
+            total += sum(int(i) for i in fields[11:15])
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+# function to check if a process group still has processes
+def group_exists(pgid):
+    """
+    Return True if any process of the process group is still running.
+    """
+    try:
+        os.killpg(pgid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+# function to stop a command and everything it started
+def stop_process_group(process, grace_period=STOP_GRACE_PERIOD):
+    """
+    Send SIGTERM to the process group of a command started by run_command and SIGKILL to whatever
+    is left of it after grace_period seconds.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    deadline = time.time() + grace_period
+    while time.time() < deadline:
+        # the shell is reaped here, its children are reaped by init once it is gone
+        process.poll()
+        if not group_exists(process.pid):
+            return
+        time.sleep(0.1)
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+# function to run a command with live progress
+def run_command(command, cwd=None, log=print, iterations=None, on_progress=None, interval=PROGRESS_INTERVAL, cancel=None, wall_time=0, cpu_time=0):
+    """
+    Run a shell command in its own process group, copy its output to the log files it redirects to
+    (if any), pass every line of stderr to log and the progress parsed from stdout to log (formatted)
+    and on_progress (as an event), at most once per interval seconds. Returns the exit code of the
+    command. The whole process group is stopped and CommandStopped is raised if cancel() returns
+    True or the command runs longer than wall_time or uses more than cpu_time CPU seconds (0: no limit).
+    """
+    command, out_log, err_log = split_redirections(command)
+    if cwd is not None:
+        out_log = os.path.join(cwd, out_log) if out_log is not None else None
+        err_log = os.path.join(cwd, err_log) if err_log is not None else None
+    parser = ProgressParser(iterations)
+    logs = {'stdout': open(out_log, 'wb') if out_log is not None else None, 'stderr': open(err_log, 'wb') if err_log is not None else None}
+    partial = {'stdout': b'', 'stderr': b''}
+    state = {'changed': False, 'sent': 0.0}
+    process = None
+    stopped = None
+
+    # function to send the latest progress
+    def send_progress(force=False):
+        if not state['changed'] or (not force and time.time() - state['sent'] < interval):
+            return
+        event = parser.get_event()
+        log(format_progress(event))
+        if on_progress is not None:
+            on_progress(event)
+        state['changed'] = False
+        state['sent'] = time.time()
+
+    # function to handle a complete line of output
+    def handle_line(name, line):
+        line = line.decode('utf-8', errors='replace').rstrip()
+        if name == 'stderr':
+            if line != "":
+                log(line)
+        elif parser.feed(line):
+            state['changed'] = True
+
+    # function to check if the command has to be stopped
+    def get_stop_reason():
+        if cancel is not None and cancel():
+            return "cancelled"
+        if wall_time > 0 and time.time() - parser.start_time > wall_time:
+            return "wall time limit of {} exceeded".format(format_duration(wall_time))
+        if cpu_time > 0 and get_group_cpu_time(process.pid) > cpu_time:
+            return "CPU time limit of {} exceeded".format(format_duration(cpu_time))
+        return None
+
+    try:
+        process = subprocess.Popen(command, shell=True, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        selector = selectors.DefaultSelector()
+        for name, stream in [('stdout', process.stdout), ('stderr', process.stderr)]:
+            os.set_blocking(stream.fileno(), False)
+            selector.register(stream, selectors.EVENT_READ, name)
+        while len(selector.get_map()) > 0:
+            for key, _ in selector.select(timeout=min(interval, STOP_CHECK_INTERVAL)):
+                name = key.data
+                try:
+                    data = os.read(key.fileobj.fileno(), 1 << 16)
+                except BlockingIOError:
+                    continue
+                if data == b'':
+                    # the stream was closed
+                    selector.unregister(key.fileobj)
+                    if partial[name] != b'':
+                        handle_line(name, partial[name])
+                        partial[name] = b''
+                    continue
+                if logs[name] is not None:
+                    logs[name].write(data)
+                    logs[name].flush()
+                # ANTs ends some progress lines with a carriage return only
+                lines = (partial[name] + data).replace(b'\r', b'\n').split(b'\n')
+                partial[name] = lines.pop()
+                for line in lines:
+                    handle_line(name, line)
+            send_progress()
+            if stopped is None:
+                stopped = get_stop_reason()
+                if stopped is not None:
+                    log("Stopping the command ({})...".format(stopped))
+                    # the pipes are closed once every process of the group is gone
+                    stop_process_group(process)
+        selector.close()
+        returncode = process.wait()
+        send_progress(force=True)
+    finally:
+        for f in logs.values():
+            if f is not None:
+                f.close()
+        # never leave the processes of a command behind
+        if process is not None and (process.poll() is None or group_exists(process.pid)):
+            stop_process_group(process)
+    if stopped is not None:
+        raise CommandStopped(stopped)
+    return returncode
@@ -0,0 +1,201 @@
+# helper functions to build selections of a dataset as directories of links (views)
+
+## IMPLEMENTATION DETAILS
+# A view is a directory of symlinks (or hardlinks) to files of a source directory, built
+# from a manifest that lists the files of every group of the selection: the selected
+# files are linked at the top level of the view, other groups (e.g. backup, diff) in
+# subdirectories of the same name. Views live in <source_dir>/views/. Every build goes
+# into its own directory (views/.build/<name>-<manifest hash>, for hardlinks the hash
+# includes the inode, size and modification time of every source file) that is first assembled
+# under a temporary name and then renamed, and views/<name> is a symlink to the build
+# that is swapped atomically with os.replace. Switching or resetting a view therefore
+# never touches the source files, a crash leaves either the old or the new view, and
+# several views of the same data can be used at the same time.
+
+import os # file handling
+import json # manifests
+import shutil # directory removal
+import hashlib # manifest hashes
+import time # build ages
+
+# name of the directory that holds the views of a source directory
+VIEWS_DIR = 'views'
+
+# name of the directory (inside the views directory) that holds the builds
+BUILD_DIR = '.build'
+
+# unused builds younger than this (in seconds) are kept, another process may be about to use them
+MIN_BUILD_AGE = 60
+
+
+# function to get the directory that holds the views of a source directory
+def get_views_dir(source_dir):
+    """
+    Return the directory that holds the views of source_dir.
+    """
+    return os.path.join(source_dir, VIEWS_DIR)
+
+
+# function to create a manifest
+def make_manifest(name, source_dir, groups):
+    """
+    Return the manifest of a view. groups maps a group name ('selected' for the files
+    at the top level of the view) to a list of file names in source_dir.
+    """
+    return {
+        'name': name,
+        'source_dir': os.path.abspath(source_dir),
+        'groups': {group: sorted(os.path.basename(f) for f in files) for group, files in groups.items()},
+    }
+
+
+# function to get the state of the source files of a manifest
+def get_source_states(manifest):
+    """
+    Return the inode, size and modification time of every source file of a manifest.
+    """
+    states = {}
+    for files in manifest['groups'].values():
+        for f in files:
+            stat = os.stat(os.path.join(manifest['source_dir'], f))
+            states[f] = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+    return states
+
+
+# function to hash a manifest
+def get_manifest_hash(manifest, link_type):
+    """
+    Return a short hash identifying a manifest built with a link type. Hardlinks keep the
+    contents of the files they were made from, so for them the state of the source files
+    is hashed as well and a regenerated source file gives a new build.
+    """
+    description = [manifest, link_type]
+    if link_type == 'hardlink':
+        description.append(get_source_states(manifest))
+    description = json.dumps(description, sort_keys=True)
+    return hashlib.blake2b(description.encode('utf-8'), digest_size=8).hexdigest()
+
+
+# function to link a file into a view
+def link_file(source, destination, link_type='symlink'):
+    """
+    Link source to destination with a relative symlink or a hardlink.
+    """
+    if link_type == 'symlink':
+        os.symlink(os.path.relpath(source, os.path.dirname(destination)), destination)
+    elif link_type == 'hardlink':
+        os.link(source, destination)
+    else:
+        raise ValueError("Link type must be either 'symlink' or 'hardlink'.")
+
+
+# function to check if a process is still running
+def is_running(pid):
+    """
+    Return True if a process with the given pid exists.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# function to build a view
+def build_view(view_path, manifest, link_type='symlink'):
+    """
+    Build the view described by manifest and atomically point view_path at it.
+    Returns the directory of the build.
+    """
+    views_dir = os.path.dirname(os.path.abspath(view_path))
+    build_root = os.path.join(views_dir, BUILD_DIR)
+    os.makedirs(build_root, exist_ok=True)
+    assert not os.path.exists(view_path) or os.path.islink(view_path), "View {} exists and is not a view.".format(view_path)
+
+    name = os.path.basename(os.path.abspath(view_path))
+    build_dir = os.path.join(build_root, '{}-{}'.format(name, get_manifest_hash(manifest, link_type)))
+    if not os.path.isdir(build_dir):
+        # assemble the build under a temporary name
+        temp_dir = '{}.tmp-{}'.format(build_dir, os.getpid())
+        if os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir)
+        os.makedirs(temp_dir)
+        for group, files in manifest['groups'].items():
+            group_dir = temp_dir if group == 'selected' else os.path.join(temp_dir, group)
+            os.makedirs(group_dir, exist_ok=True)
+            for f in files:
+                link_file(os.path.join(manifest['source_dir'], f), os.path.join(group_dir, f), link_type)
+        with open(os.path.join(temp_dir, 'manifest.json'), 'w') as f:
+            json.dump(dict(manifest, link_type=link_type), f, indent=1)
+        try:
+            os.rename(temp_dir, build_dir)
+        except OSError:
+            # the same build was finished by another process
+            shutil.rmtree(temp_dir)
+
+    # swap the view to the new build
+    temp_link = '{}.tmp-{}'.format(os.path.abspath(view_path), os.getpid())
+    if os.path.lexists(temp_link):
+        os.remove(temp_link)
+    os.symlink(os.path.relpath(build_dir, views_dir), temp_link)
+    os.replace(temp_link, view_path)
+    clean_builds(views_dir)
+    return build_dir
+
+
+# function to read the manifest of a view
+def read_manifest(view_path):
+    """
+    Return the manifest of a view.
+    """
+    with open(os.path.join(view_path, 'manifest.json'), 'r') as f:
+        return json.load(f)
+
+
+# function to list the views of a views directory
+def list_views(views_dir):
+    """
+    Return the paths of all views in views_dir.
+    """
+    if not os.path.isdir(views_dir):
+        return []
+    return sorted(os.path.join(views_dir, f) for f in os.listdir(views_dir) if os.path.islink(os.path.join(views_dir, f)) and '.tmp-' not in f)
+
+
+# function to remove a view
+def remove_view(view_path):
+    """
+    Remove a view (its source files are not touched).
+    """
+    assert os.path.islink(view_path), "{} is not a view.".format(view_path)
+    views_dir = os.path.dirname(os.path.abspath(view_path))
+    build_dir = os.path.realpath(view_path)
+    os.remove(view_path)
+    # remove the build right away unless another view uses it
+    if build_dir not in [os.path.realpath(view) for view in list_views(views_dir)]:
+        shutil.rmtree(build_dir, ignore_errors=True)
+    clean_builds(views_dir)
+
+
+# function to remove builds that are not used by any view
+def clean_builds(views_dir):
+    """
+    Remove the builds that no view points at and temporary builds of processes that no longer run.
+    """
+    build_root = os.path.join(views_dir, BUILD_DIR)
+    if not os.path.isdir(build_root):
+        return
+    in_use = set(os.path.basename(os.path.realpath(view)) for view in list_views(views_dir))
+    for build in os.listdir(build_root):
+        if '.tmp-' in build:
+            # keep builds that are still being assembled
+            pid = build.rsplit('.tmp-', 1)[1]
+            if pid.isdigit() and is_running(int(pid)):
+                continue
+        elif build in in_use or time.time() - os.path.getmtime(os.path.join(build_root, build)) < MIN_BUILD_AGE:
+            continue
+        shutil.rmtree(os.path.join(build_root, build), ignore_errors=True)
+    if len(os.listdir(build_root)) == 0:
+        os.rmdir(build_root)
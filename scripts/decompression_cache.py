@@ -0,0 +1,250 @@
+# helper functions for a cache of decompressed transform files
+
+## IMPLEMENTATION DETAILS
+# The transforms of a template construction run are gzip-compressed (Warp.nii.gz,
+# InverseWarp.nii.gz, sometimes Affine.txt.gz), so every tool that reads a displacement
+# field of several GB pays a single-threaded gzip decode on every read. Here compressed
+# transforms are expanded once into a cache directory next to the results (the results
+# themselves are never touched) and later reads use the uncompressed copy: nibabel maps
+# uncompressed .nii files into memory instead of reading them, and ANTs reads them without
+# decoding. Every copy is named after a hash of the path, size and modification time of its
+# compressed file (a changed file gets a new copy) and keeps the name of the file without
+# .gz, so the file type is still recognized. A <copy>.used stamp is touched whenever a copy
+# is used; when the cache grows over its quota the least recently used copies are removed
+# (never the ones of the current request, nor copies used in the last minute, which may be
+# about to be opened by another process).
+# A gzip stream cannot be inflated in parallel without an index, so each file is inflated in
+# large chunks with a pipeline of three threads (read, inflate, write; zlib and file I/O
+# release the GIL) and several files are inflated at the same time on a thread pool.
+# Multi-member files (e.g. from pigz or bgzip) are inflated member by member. A copy is
+# written to a temporary file and renamed when complete, so a crash never leaves a partial
+# copy behind.
+
+import os # file handling
+import time # last use of copies
+import zlib # gzip decoding
+import queue # decoding pipeline
+import struct # gzip trailer
+import hashlib # copy names
+import threading # decoding pipeline
+from concurrent.futures import ThreadPoolExecutor # parallel decoding of several files
+
+# size of the chunks read from a compressed file and of the inflated chunks (bytes)
+CHUNK_SIZE = 16 << 20
+
+# copies used within this many seconds are never evicted
+MIN_EVICTION_AGE = 60
+
+
+# function to get the name of the decompressed copy of a file
+def get_copy_name(path):
+    """
+    Return the name of the decompressed copy of a compressed file (changes whenever the file changes).
+    """
+    stat = os.stat(path)
+    description = '{}:{}:{}'.format(os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    key = hashlib.blake2b(description.encode('utf-8'), digest_size=12).hexdigest()
+    return '{}-{}'.format(key, os.path.basename(path)[:-3])
+
+
+# function to estimate the decompressed size of a gzip file
+def get_decompressed_size(path):
+    """
+    Return the decompressed size of a gzip file from its trailer (stored modulo 4 GiB, so the
+    smallest size not below the compressed size is taken; exact for single-member files).
+    """
+    compressed_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        size = struct.unpack('<I', f.read(4))[0]
+    while size < compressed_size:
+        size += 1 << 32
+    return size
+
+
+# function to inflate a gzip file
+def inflate(path, output_file):
+    """
+    Decompress a (possibly multi-member) gzip file into output_file, reading, inflating and
+    writing chunks on separate threads. The CRC of every member is checked by zlib.
+    """
+    compressed = queue.Queue(maxsize=4)
+    inflated = queue.Queue(maxsize=4)
+    errors = []
+    read_all = False
+
+    # function to read the compressed chunks
+    def read_chunks():
+        try:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    compressed.put(chunk)
+        except Exception as error:
+            errors.append(error)
+        finally:
+            compressed.put(None)
+
+    # function to write the inflated chunks
+    def write_chunks():
+        try:
+            with open(output_file, 'wb') as f:
+                while True:
+                    chunk = inflated.get()
+                    if chunk is None:
+                        break
+                    f.write(chunk)
+        except Exception as error:
+            errors.append(error)
+            # keep draining so that the inflating thread never blocks
+            while inflated.get() is not None:
+                pass
+
+    reader = threading.Thread(target=read_chunks, daemon=True)
+    writer = threading.Thread(target=write_chunks, daemon=True)
+    reader.start()
+    writer.start()
+    try:
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        started = False
+        while True:
+            chunk = compressed.get()
+            if chunk is None:
+                read_all = True
+                break
+            while len(chunk) > 0:
+                if not started:
+                    # skip any padding of zeros between or after members
+                    chunk = chunk.lstrip(b'\0')
+                    if len(chunk) == 0:
+                        break
+                    started = True
+                # bounded output, the rest of the input is kept in unconsumed_tail
+                inflated.put(decoder.decompress(chunk, CHUNK_SIZE))
+                chunk = decoder.unconsumed_tail
+                if decoder.eof:
+                    # the rest of the chunk belongs to the next member
+                    chunk = decoder.unused_data
+                    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    started = False
+        assert not started, "{} is truncated.".format(path)
+    except Exception as error:
+        errors.append(error)
+        # let the reader finish
+        while not read_all and compressed.get() is not None:
+            pass
+    finally:
+        inflated.put(None)
+        reader.join()
+        writer.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+
+# function to mark a copy as used
+def touch(cache_dir, name):
+    """
+    Update the last use of a copy in the cache.
+    """
+    stamp = os.path.join(cache_dir, name + '.used')
+    with open(stamp, 'a'):
+        pass
+    os.utime(stamp)
+
+
+# function to list the copies in the cache
+def list_copies(cache_dir):
+    """
+    Return (name, size, last use) of every copy in the cache, least recently used first, and
+    remove temporary files left behind by crashed processes.
+    """
+    now = time.time()
+    copies = []
+    for entry in os.scandir(cache_dir):
+        if '.tmp-' in entry.name:
+            # a temporary file that is still being written is modified all the time
+            if now - entry.stat().st_mtime > MIN_EVICTION_AGE:
+                os.remove(entry.path)
+            continue
+        if entry.name.endswith('.used'):
+            continue
+        try:
+            stamp = entry.path + '.used'
+            last_use = os.stat(stamp).st_mtime if os.path.isfile(stamp) else entry.stat().st_mtime
+            copies.append((entry.name, entry.stat().st_size, last_use))
+        except FileNotFoundError:
+            # evicted by another process
+            continue
+    return sorted(copies, key=lambda copy: copy[2])
+
+
+# function to make room in the cache
+def evict(cache_dir, needed, keep, quota):
+    """
+    Remove the least recently used copies (except the ones in keep and recently used ones) until
+    needed more bytes fit into quota bytes. Returns the number of bytes that are free afterwards.
+    """
+    copies = list_copies(cache_dir)
+    total = sum(size for _, size, _ in copies)
+    now = time.time()
+    for name, size, last_use in copies:
+        if total + needed <= quota:
+            break
+        if name in keep or now - last_use < MIN_EVICTION_AGE:
+            continue
+        for filename in [name, name + '.used']:
+            if os.path.isfile(os.path.join(cache_dir, filename)):
+                os.remove(os.path.join(cache_dir, filename))
+        total -= size
+        print("Evicted {} from the decompression cache.".format(name))
+    return quota - total
+
+
+# function to store the decompressed copy of a file
+def store(path, cache_dir, name):
+    """
+    Decompress path into the cache under name (written to a temporary file and renamed when complete).
+    """
+    temp_file = os.path.join(cache_dir, '{}.tmp-{}-{}'.format(name, os.getpid(), threading.get_ident()))
+    try:
+        inflate(path, temp_file)
+        os.replace(temp_file, os.path.join(cache_dir, name))
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    touch(cache_dir, name)
+
+
+# function to get the decompressed copies of files
+def get_decompressed_files(paths, cache_dir, quota=0, num_threads=0):
+    """
+    Return the files to read instead of paths: the decompressed copy in cache_dir of every gzip
+    compressed file (made first if it is missing, several files at a time on num_threads threads,
+    0: one per CPU) and every other file as it is. With a quota (bytes, 0: no limit), compressed
+    files whose copies do not fit next to the other copies of this call are returned as they are.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    names = {path: get_copy_name(path) for path in dict.fromkeys(paths) if path.endswith('.gz')}
+    missing = []
+    for path, name in names.items():
+        if os.path.isfile(os.path.join(cache_dir, name)):
+            touch(cache_dir, name)
+        else:
+            missing.append(path)
+
+    if len(missing) > 0:
+        sizes = {path: get_decompressed_size(path) for path in missing}
+        if quota > 0:
+            # copies that do not fit are left out (in the given order)
+            free = evict(cache_dir, sum(sizes.values()), set(names.values()), quota)
+            fitting = []
+            for path in missing:
+                if sizes[path] <= free:
+                    fitting.append(path)
+                    free -= sizes[path]
+                else:
+                    print("WARNING: {} does not fit into the decompression cache. Reading the compressed file.".format(path))
+            missing = fitting
+        with ThreadPoolExecutor(max_workers=num_threads if num_threads > 0 else (os.cpu_count() or 1)) as executor:
+            list(executor.map(lambda path: store(path, cache_dir, names[path]), missing))
+
+    return [os.path.join(cache_dir, names[path]) if path in names and os.path.isfile(os.path.join(cache_dir, names[path])) else path for path in paths]
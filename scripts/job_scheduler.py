@@ -0,0 +1,318 @@
+# helper functions to schedule parallel jobs under a memory budget
+
+## IMPLEMENTATION DETAILS
+# The memory needed by a job is estimated from the headers of its input files (NRRD or
+# NIfTI): every input is counted with its on-disk data type plus a float32 working copy
+# (ANTs and the native engines both work in float), and the output grid is counted as
+# float32 times an interpolation overhead (coordinate and weight buffers). Jobs are
+# started largest-first so that the big stacks do not end up alone at the end of a batch.
+# A job is only started if the estimates of all running jobs plus its own fit into the
+# memory budget; if the largest waiting job does not fit, smaller ones are started in its
+# place. A job that is larger than the whole budget is run on its own.
+# The CPUs are split between the workers and the ANTs processes they start: every job
+# runs with ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS set to its share of the CPUs, and with
+# pinning every worker slot gets its own block of CPUs (inherited by its children).
+# With auto-tuning the split is measured on the batch itself: the smallest jobs are run one
+# after the other with all CPUs, half of them, a quarter, ... as threads (each job only once, its result is kept), their
+# times are scaled by their memory estimates (a stand-in for their size) and the remaining
+# jobs are run with the split of the highest predicted throughput.
+
+import os # file handling
+import gzip # compressed NIfTI headers
+import struct # NIfTI header parsing
+import time # calibration timing
+import numpy as np # linear algebra
+import nrrd # NRRD file handling
+from concurrent.futures import wait, FIRST_COMPLETED # waiting for running jobs
+from joblib.externals.loky import get_reusable_executor # process pool used by joblib
+from native_resample import get_spacing, get_dtype # NRRD header helpers
+
+# environment variable that sets the number of threads of ITK (and therefore ANTs)
+ITK_THREADS_VARIABLE = 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'
+
+# multiplier on the output grid for the buffers used by each interpolation
+INTERPOLATION_OVERHEAD = {'nearest': 1.5, 'linear': 2.0, 'bspline': 4.0}
+
+# number of bytes per voxel of the NIfTI data types
+NIFTI_ITEMSIZE = {2: 1, 4: 2, 8: 4, 16: 4, 32: 8, 64: 8, 128: 3, 256: 1, 512: 2, 768: 4, 1024: 8, 1280: 8, 1792: 16, 2048: 32, 2304: 4}
+
+
+# function to read the grid of a NIfTI file
+def read_nifti_header(path):
+    """
+    Return the shape, bytes per voxel and spacing of a NIfTI-1 file (.nii or .nii.gz).
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        header = f.read(348)
+    assert len(header) == 348, "File {} is not a valid NIfTI file.".format(path)
+    # the header size field tells us the byte order
+    endian = '<' if struct.unpack('<i', header[:4])[0] == 348 else '>'
+    assert struct.unpack(endian + 'i', header[:4])[0] == 348, "File {} is not a valid NIfTI-1 file.".format(path)
+    dim = struct.unpack(endian + '8h', header[40:56])
+    datatype = struct.unpack(endian + 'h', header[70:72])[0]
+    pixdim = struct.unpack(endian + '8f', header[76:108])
+    shape = tuple(int(i) for i in dim[1:dim[0] + 1])
+    spacing = np.abs(np.array(pixdim[1:4], dtype=float))
+    return shape, NIFTI_ITEMSIZE.get(datatype, 4), spacing
+
+
+# function to read the grid of an image file
+def read_image_header(path):
+    """
+    Return the shape, bytes per voxel and spacing of a NRRD (.nrrd/.nhdr) or NIfTI file without reading its data.
+    """
+    if path.endswith('.nrrd') or path.endswith('.nhdr'):
+        header = nrrd.read_header(path)
+        return tuple(int(i) for i in header['sizes']), get_dtype(header).itemsize, get_spacing(header)
+    if path.endswith('.nii') or path.endswith('.nii.gz'):
+        return read_nifti_header(path)
+    raise ValueError("Unsupported image format: {}".format(path))
+
+
+# function to get the output grid of a resampling
+def get_resampled_voxels(path, target_spacing):
+    """
+    Return the number of voxels of an image after resampling it to target_spacing.
+    """
+    shape, _, spacing = read_image_header(path)
+    output_size = [max(1, int(shape[i] * spacing[i] / target_spacing[i])) for i in range(3)]
+    return int(np.prod(output_size))
+
+
+# function to estimate the memory used by a job
+def estimate_memory(input_files, output_voxels=0, interpolation='linear'):
+    """
+    Return the estimated peak memory (in bytes) of a job reading input_files and writing output_voxels voxels.
+    """
+    memory = 0
+    for path in input_files:
+        shape, itemsize, _ = read_image_header(path)
+        # data as stored plus a float32 working copy
+        memory += int(np.prod(shape)) * (itemsize + 4)
+    memory += int(output_voxels * 4 * INTERPOLATION_OVERHEAD[interpolation])
+    return memory
+
+
+# function to parse a memory size
+def parse_memory(text):
+    """
+    Convert a memory size like '64G', '512M' or '1.5T' into bytes. Plain numbers are GB.
+    'auto' uses the memory that is currently available; '0' means no limit.
+    """
+    text = str(text).strip().upper().rstrip('B')
+    if text == 'AUTO':
+        return get_available_memory()
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    try:
+        if text[-1:] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(float(text) * units['G'])
+    except ValueError:
+        raise ValueError("Memory budget must be a number of GB or a size like '64G', '512M' or 'auto'.")
+
+
+# function to get the memory available on this machine
+def get_available_memory():
+    """
+    Return the available memory in bytes (MemAvailable on Linux, total physical memory elsewhere).
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+# function to get a usable number of workers
+def get_num_workers(num_workers, num_jobs):
+    """
+    Clamp the requested number of workers to the number of jobs and CPUs (0 means one per CPU).
+    """
+    assert num_workers >= 0, "Number of workers must be a positive integer (or 0 for one worker per CPU)."
+    cpu_count = os.cpu_count() or 1
+    if num_workers == 0:
+        num_workers = cpu_count
+    if num_workers > cpu_count:
+        print("WARNING: {} workers requested but only {} CPUs are available. Using {} workers.".format(num_workers, cpu_count, cpu_count))
+        num_workers = cpu_count
+    return max(1, min(num_workers, num_jobs))
+
+
+# function to format a memory size
+def format_memory(memory):
+    """
+    Return a memory size in bytes as a human readable string.
+    """
+    if memory < (1 << 30):
+        return "{:.1f} MB".format(memory / (1 << 20))
+    return "{:.2f} GB".format(memory / (1 << 30))
+
+
+# function to get the CPUs this process may run on
+def get_available_cpus():
+    """
+    Return the list of CPUs this process is allowed to run on.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+# function to split the CPUs between the workers
+def get_threads_per_worker(num_threads, num_workers):
+    """
+    Return the number of ITK threads per worker (0 means an even split of the CPUs between the workers).
+    """
+    assert num_threads >= 0, "Number of threads must be a positive integer (or 0 to split the CPUs between the workers)."
+    cpu_count = len(get_available_cpus())
+    if num_threads == 0:
+        return max(1, cpu_count // num_workers)
+    if num_threads * num_workers > cpu_count:
+        print("WARNING: {} workers x {} threads oversubscribe the {} available CPUs.".format(num_workers, num_threads, cpu_count))
+    return num_threads
+
+
+# function to get the CPUs of a worker slot
+def get_slot_cpus(slot, threads):
+    """
+    Return the CPUs a worker slot is pinned to (slots get consecutive blocks of threads CPUs).
+    """
+    cpus = get_available_cpus()
+    return [cpus[(slot * threads + i) % len(cpus)] for i in range(min(threads, len(cpus)))]
+
+
+# function to run a job with a limited number of threads
+def run_with_threads(function, job, threads, cpus=None):
+    """
+    Run function(*job) with ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS set to threads (inherited by the ANTs
+    processes it starts) and, if cpus is given, with the process pinned to those CPUs.
+    """
+    previous_threads = os.environ.get(ITK_THREADS_VARIABLE)
+    os.environ[ITK_THREADS_VARIABLE] = str(threads)
+    previous_cpus = None
+    if cpus is not None and hasattr(os, 'sched_setaffinity'):
+        previous_cpus = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, cpus)
+    try:
+        return function(*job)
+    finally:
+        # restore the settings of the worker
+        if previous_threads is None:
+            del os.environ[ITK_THREADS_VARIABLE]
+        else:
+            os.environ[ITK_THREADS_VARIABLE] = previous_threads
+        if previous_cpus is not None:
+            os.sched_setaffinity(0, previous_cpus)
+
+
+# function to get the thread counts tried by auto-tuning
+def get_thread_candidates():
+    """
+    Return the thread counts tried by auto_tune (the number of CPUs and the powers of two below it, largest first).
+    """
+    cpu_count = len(get_available_cpus())
+    return sorted(set([2 ** i for i in range(cpu_count.bit_length()) if 2 ** i <= cpu_count] + [cpu_count]), reverse=True)
+
+
+# function to choose the number of workers and threads by timing jobs of the batch
+def auto_tune(function, jobs, estimates, calibration, num_jobs, max_workers, callback=None):
+    """
+    Run the jobs in calibration (indices into jobs, one per candidate thread count of
+    get_thread_candidates, the first ones if there are fewer jobs) once each with its thread count and return the (workers, threads) split
+    with the highest predicted throughput for num_jobs jobs, together with their results. The time
+    of every job is divided by its estimate, so jobs of different sizes can be compared.
+    """
+    cpu_count = len(get_available_cpus())
+    best = None
+    results = {}
+    for index, threads in zip(calibration, get_thread_candidates()):
+        start_time = time.time()
+        results[index] = run_with_threads(function, jobs[index], threads)
+        elapsed = max(time.time() - start_time, 1e-9)
+        if callback is not None:
+            callback(index, results[index])
+        workers = max(1, min(cpu_count // threads, num_jobs, max_workers))
+        # units of estimated size finished per second if every worker runs as fast as this job
+        throughput = workers * max(estimates[index], 1) / elapsed
+        print("Calibration: {} threads took {:.1f} s for {} ({} workers: {:.3g} MB/s)".format(threads, elapsed, format_memory(estimates[index]), workers, throughput / (1 << 20)))
+        if best is None or throughput > best[0]:
+            best = (throughput, workers, threads)
+    print("Auto-tune: using {} workers with {} threads each.".format(best[1], best[2]))
+    return best[1], best[2], results
+
+
+# function to run jobs under a memory budget
+def run_jobs(function, jobs, estimates, num_workers=1, mem_budget=0, num_threads=0, pin_threads=False, callback=None, tune=False):
+    """
+    Run function(*job) for every job, largest estimate first, with at most num_workers jobs at a time and
+    the summed estimates of the running jobs under mem_budget bytes (0 means no limit).
+    Every job gets num_threads ITK threads (0: the CPUs split between the workers) and is pinned to its
+    own CPUs if pin_threads is set. With tune, the split is chosen by auto_tune on the smallest jobs of
+    the batch (one per candidate thread count, every job is still run only once).
+    If given, callback(index, result) is called in this process as soon as each job finishes.
+    Returns the results in the order of jobs.
+    """
+    jobs = [job if isinstance(job, tuple) else (job,) for job in jobs]
+    results = [None] * len(jobs)
+    if len(jobs) == 0:
+        return results
+
+    # largest jobs first
+    waiting = sorted(range(len(jobs)), key=lambda i: estimates[i], reverse=True)
+    if tune:
+        # the smallest jobs are timed (and kept) with the candidate thread counts
+        max_workers = max(1, mem_budget // max(estimates[waiting[0]], 1)) if mem_budget > 0 else len(jobs)
+        calibration = waiting[::-1][:len(get_thread_candidates())]
+        waiting = waiting[:len(waiting) - len(calibration)]
+        num_workers, num_threads, calibrated = auto_tune(function, jobs, estimates, calibration, len(waiting), max_workers, callback)
+        for index, result in calibrated.items():
+            results[index] = result
+        if len(waiting) == 0:
+            return results
+    num_workers = get_num_workers(num_workers, len(waiting))
+    num_threads = get_threads_per_worker(num_threads, num_workers)
+    print("Scheduling {} jobs on up to {} workers with {} threads each (memory budget: {}, largest job: {}).".format(len(waiting), num_workers, num_threads, format_memory(mem_budget) if mem_budget > 0 else "unlimited", format_memory(estimates[waiting[0]])))
+    if mem_budget > 0 and estimates[waiting[0]] > mem_budget:
+        print("WARNING: Some jobs are estimated to need more than the memory budget. They will be run on their own.")
+
+    if num_workers == 1:
+        # run each job in this process
+        cpus = get_slot_cpus(0, num_threads) if pin_threads else None
+        for i in waiting:
+            results[i] = run_with_threads(function, jobs[i], num_threads, cpus)
+            if callback is not None:
+                callback(i, results[i])
+        return results
+
+    executor = get_reusable_executor(max_workers=num_workers)
+    running = {}
+    free_slots = list(range(num_workers))
+    while waiting or running:
+        # start as many waiting jobs as fit into the budget
+        in_use = sum(estimates[i] for i, _ in running.values())
+        for i in list(waiting):
+            if len(running) >= num_workers:
+                break
+            if mem_budget > 0 and len(running) > 0 and in_use + estimates[i] > mem_budget:
+                continue
+            waiting.remove(i)
+            slot = free_slots.pop(0)
+            cpus = get_slot_cpus(slot, num_threads) if pin_threads else None
+            running[executor.submit(run_with_threads, function, jobs[i], num_threads, cpus)] = (i, slot)
+            in_use += estimates[i]
+        # wait for a job to finish
+        done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+        for future in done:
+            i, slot = running.pop(future)
+            free_slots.append(slot)
+            results[i] = future.result()
+            if callback is not None:
+                callback(i, results[i])
+    return results
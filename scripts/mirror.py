@@ -1,10 +1,12 @@
 # a script to mirror confocal stacks
 
 import os # file handling
+import numpy as np # linear algebra
 import pandas as pd # data processing, CSV file I/O (e.g. pd.read_csv)
 import glob # file handling
 import argparse # command line arguments
-from joblib import Parallel, delayed # parallel processing
+from native_mirror import mirror_nrrd, write_mirror_header # in-process mirroring
+from job_scheduler import run_jobs, estimate_memory, read_image_header, parse_memory # memory-aware job scheduling
 
 # clear output
 os.system('cls' if os.name == 'nt' else 'clear')
@@ -13,7 +15,7 @@ os.system('cls' if os.name == 'nt' else 'clear')
 start_string = 'Kronauer Lab - Microscopy Image Processing Pipeline\n'
 start_string += "="*(len(start_string)-1) + '\n'
 start_string += 'Confocal Mirror Generator by Rishika Mohanta\n'
-start_string += 'Version 1.1.0\n'
+start_string += 'Version 1.5.0\n'
 
 print(start_string)
 
@@ -22,8 +24,14 @@ parser = argparse.ArgumentParser(description='Generate mirrored images.')
 parser.add_argument('-i','--input_dir', type=str, help='path to input directory (must contain .nrrd files; default: ./cleaned_data/whole_brain/)', default="./cleaned_data/whole_brain/", nargs='?')
 parser.add_argument('-o','--output_dir', type=str, help='path to output directory; default: ./cleaned_data/whole_brain/', default="./cleaned_data/whole_brain/", nargs='?')
 parser.add_argument('-skip','--skip_existing', type=bool, help='skip existing files (default: True)', default=True, nargs='?')
-parser.add_argument('-n','--num_workers', type=int, help='number of workers (default: 1)', default=1, nargs='?')
+parser.add_argument('-n','--num_workers', type=int, help='maximum number of workers (0: one per CPU; default: 1)', default=1, nargs='?')
+parser.add_argument('-mb','--mem_budget', type=str, help='memory budget shared by all workers (e.g. 64G; 0: no limit; default: auto, the memory currently available)', default="auto", nargs='?')
+parser.add_argument('-th','--threads', type=int, help='number of ITK threads per worker (0: split the CPUs between the workers; default: 0)', default=0, nargs='?')
+parser.add_argument('-pin','--pin_threads', action='store_true', help='pin each worker and the ANTs processes it starts to its own CPUs')
+parser.add_argument('-at','--auto_tune', action='store_true', help='choose the number of workers and threads by timing the first (smallest) files with different thread counts (overrides -n and -th)')
 parser.add_argument('-a', '--axis', type=str, help='axis to mirror (vertical/horizontal; default: horizontal)', default="horizontal", nargs='?')
+parser.add_argument('-e','--engine', type=str, help='mirroring engine (ants: reflect and resample with ANTs, native: flip the voxels without interpolation; default: ants)', default="ants", nargs='?')
+parser.add_argument('-d','--detached', action='store_true', help='write each mirror as a detached .nhdr header that points at the original data (uses the native engine)')
 parser.add_argument('-c','--clean_up', type=bool, help='remove non-error log files (default: True)', default=True, nargs='?')
 args = parser.parse_args()
 
@@ -62,6 +70,16 @@ if axis == 'vertical':
 else:
     axis = 0
 
+# check if engine is valid
+engine = args.engine
+assert engine in ['ants', 'native'], "Mirroring engine must be either 'ants' or 'native'."
+
+# detached mirrors only store a header, so they are always generated natively
+detached = args.detached
+if detached and engine == 'ants':
+    print("Detached mirrors use the native engine.")
+    engine = 'native'
+
 # get clean_up
 clean_up = args.clean_up
 
@@ -69,11 +87,11 @@ clean_up = args.clean_up
 def generate_mirror_name(x,output_dir=output_dir):
     """
     INPUT FORMAT: x = 'path/to/IDENTIFIER.nrrd'
-    OUTPUT FORMAT: '<output_dir>/IDENTIFIER_mirror.nrrd'
+    OUTPUT FORMAT: '<output_dir>/IDENTIFIER_mirror.nrrd' ('<output_dir>/IDENTIFIER_mirror.nhdr' for detached mirrors)
     Note: IDENTIFIER can include underscores and dots.
     """
     x = x.split('.nrrd')[0]
-    x = x + '_mirror.nrrd'
+    x = x + ('_mirror.nhdr' if detached else '_mirror.nrrd')
     # change output directory
     x = os.path.join(output_dir, os.path.basename(x))
     return x
@@ -142,6 +160,18 @@ def runAntsFlip(input_file,output_file,index):
     
     mirror_file = output_file[:-5] + '.mat'
 
+    if detached:
+        # only write a header that reflects the original data (and the reflection for tools that expect the .mat file)
+        write_mirror_header(input_file, output_file, axis, mirror_file)
+        assert os.path.isfile(output_file), "ERROR: Output file {} does not exist.".format(output_file)
+        return
+
+    if engine == 'native':
+        # flip the voxels and write the reflection for tools that expect the .mat file
+        mirror_nrrd(input_file, output_file, axis, mirror_file)
+        assert os.path.isfile(output_file), "ERROR: Output file {} does not exist.".format(output_file)
+        return
+
     # print log file location
     print("Log file: {}".format(output_file[:-5] + '_out.log'))
     print("Error file: {}".format(output_file[:-5] + '_err.log'))
@@ -156,19 +186,12 @@ def runAntsFlip(input_file,output_file,index):
     # check if output file exists
     assert os.path.isfile(output_file), "ERROR: Output file {} does not exist. Check log files for more information.".format(output_file)
 
-if args.num_workers == 1:
-    # iterate over files
-    for iterator, (input_file, output_file) in enumerate(zip(input_files, output_files)):
-        # run ANTs
-        runAntsFlip(input_file, output_file, iterator)
-elif args.num_workers > 1:
-    # check if number of workers is valid
-    assert args.num_workers <= len(data_files), "Number of workers must be less than number of files."
-    assert args.num_workers <= os.cpu_count(), "Number of workers must be less than or equal to number of cores."
-    # run ANTs in parallel
-    Parallel(n_jobs=args.num_workers)(delayed(runAntsFlip)(input_file, output_file, iterator) for iterator, (input_file, output_file) in enumerate(zip(data_files, output_files)))
-else:
-    raise ValueError("Number of workers must be a positive integer.")
+# estimate the memory needed to mirror each file (the output has the same grid as the input)
+# (the native engine only holds the input and its flipped copy)
+estimates = [estimate_memory([input_file], int(np.prod(read_image_header(input_file)[0])) if engine == 'ants' else 0, 'linear') for input_file in input_files]
+
+# run ANTs on the largest files first, running as many files in parallel as the memory budget allows
+run_jobs(runAntsFlip, [(input_file, output_file, iterator) for iterator, (input_file, output_file) in enumerate(zip(input_files, output_files))], estimates, args.num_workers, parse_memory(args.mem_budget), args.threads, args.pin_threads, tune=args.auto_tune)
 
 if clean_up:
     # Remove all log files with no error messages
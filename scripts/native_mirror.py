@@ -0,0 +1,223 @@
+# helper functions to mirror NRRD stacks in-process (without calling ANTs)
+
+## IMPLEMENTATION DETAILS
+# mirror.py used to build a reflection with ImageMath ReflectionMatrix (a reflection of one
+# physical axis about the intensity center of gravity of the image) and resample the
+# stack through it with antsApplyTransforms. Reflecting an image is a pure reordering of
+# its voxels, so here we flip the voxel array along the index axis that is closest to the
+# reflected physical axis and move the geometry (space directions and origin) so that
+# every voxel ends up at its reflected position. No voxel is interpolated: the output
+# has the same values and data type as the input. The only difference to the ANTs output
+# is the grid, which is the reflected input grid instead of the input grid itself.
+# The reflection is still written as an ITK transform (.mat) for the tools that expect it.
+# A mirror can also be written as a detached header (.nhdr) only: the voxels are left in
+# place in the original file and the reflection is expressed by the geometry alone
+# (reflected space directions and origin), so a mirror costs a few hundred bytes. The
+# center of gravity it needs is computed from the marginal sums of the stack, which are
+# accumulated slab by slab (raw data is memory-mapped, gzip data decompressed in order),
+# so the stack is never loaded as a whole.
+
+import os # file handling
+import numpy as np # linear algebra
+import nrrd # NRRD file handling
+import scipy.io # MATLAB transform files
+from native_resample import get_spacing, get_origin, get_dtype, format_nrrd_header, SlabReader # NRRD header helpers and slab reading
+
+# sign of each axis when converting the NRRD space to ITK's LPS space
+SPACE_SIGNS = {
+    'left-posterior-superior': [1, 1, 1],
+    'right-anterior-superior': [-1, -1, 1],
+    'left-anterior-superior': [1, -1, 1],
+}
+
+# bytes of voxel data read at a time when computing the center of gravity of a file
+CENTER_SLAB_BYTES = 64 << 20
+
+
+# function to get the space direction vectors from a NRRD header
+def get_space_directions(header):
+    """
+    Return the space direction vectors (one row per axis, scaled by the spacing) of a NRRD header.
+    """
+    if 'space directions' in header and header['space directions'] is not None:
+        return np.asarray(header['space directions'], dtype=float)
+    return np.diag(get_spacing(header))
+
+
+# function to get the marginal sums of an image
+def get_marginals(data):
+    """
+    Return the sums of the image over all other axes, for every axis (float64).
+    """
+    return [data.sum(axis=tuple(i for i in range(data.ndim) if i != axis), dtype=np.float64) for axis in range(data.ndim)]
+
+
+# function to compute the center of gravity from the marginal sums of an image
+def get_center_from_marginals(marginals, header):
+    """
+    Return the intensity weighted center in physical coordinates from the marginal sums of
+    the image along every axis (zero for an empty image, as in ITK).
+    """
+    # mean index along every axis (avoids building index grids)
+    mean_index = np.zeros(len(marginals))
+    for axis, marginal in enumerate(marginals):
+        total = marginal.sum()
+        if total == 0:
+            return np.zeros(len(marginals))
+        mean_index[axis] = np.dot(np.arange(len(marginal)), marginal) / total
+    return get_origin(header) + mean_index @ get_space_directions(header)
+
+
+# function to compute the center of gravity of an image
+def get_center_of_gravity(data, header):
+    """
+    Return the intensity weighted center of the image in physical coordinates (zero for an empty image, as in ITK).
+    """
+    return get_center_from_marginals(get_marginals(data), header)
+
+
+# function to compute the center of gravity of a NRRD file
+def get_file_center_of_gravity(input_file):
+    """
+    Return the center of gravity of a 3D NRRD file (see get_center_of_gravity), its header and its
+    shape. Raw and gzip data is read slab by slab, other encodings are read as a whole.
+    """
+    header = nrrd.read_header(input_file)
+    if header['encoding'] not in ['raw', 'gzip', 'gz']:
+        data, header = nrrd.read(input_file)
+        assert data.ndim == 3, "Only 3D images are supported by the native mirror."
+        return get_center_of_gravity(data, header), header, data.shape
+    reader = SlabReader(input_file)
+    try:
+        shape = reader.shape
+        marginals = [np.zeros(n) for n in shape]
+        step = max(1, CENTER_SLAB_BYTES // reader.slice_bytes)
+        for z0 in range(0, shape[2], step):
+            z1 = min(z0 + step, shape[2])
+            slab = get_marginals(reader.read(z0, z1))
+            marginals[0] += slab[0]
+            marginals[1] += slab[1]
+            marginals[2][z0:z1] = slab[2]
+    finally:
+        reader.close()
+    return get_center_from_marginals(marginals, reader.header), reader.header, shape
+
+
+# function to build the header of a mirrored file
+def make_mirror_header(header, shape, axis, center):
+    """
+    Return the header of the image flipped along the index axis closest to the physical axis
+    and reflected about center, together with the flipped index axis.
+    """
+    directions = get_space_directions(header)
+    origin = get_origin(header)
+    # index axis that runs (mostly) along the physical axis
+    flip_axis = int(np.argmax(np.abs(directions[:, axis])))
+    reflection = np.eye(len(shape))
+    reflection[axis, axis] = -1
+    # the first voxel of the flipped array is the last voxel along flip_axis, reflected
+    last_voxel = origin + (shape[flip_axis] - 1) * directions[flip_axis]
+    new_origin = center + reflection @ (last_voxel - center)
+    new_directions = directions @ reflection
+    new_directions[flip_axis] *= -1
+
+    return copy_geometry(header, new_directions, new_origin), flip_axis
+
+
+# function to copy a NRRD header with a new geometry
+def copy_geometry(header, directions, origin):
+    """
+    Copy the input header with new space directions and origin. Fields that describe
+    how the input was stored on disk are dropped.
+    """
+    out_header = {}
+    for key, value in header.items():
+        if key in ['type', 'dimension', 'sizes', 'data file', 'datafile', 'line skip', 'lineskip', 'byte skip', 'byteskip', 'spacings', 'space directions', 'space origin', 'endian']:
+            continue
+        out_header[key] = value
+    if 'space' not in out_header and 'space dimension' not in out_header:
+        out_header['space'] = 'left-posterior-superior'
+    out_header['space directions'] = directions
+    out_header['space origin'] = origin
+    return out_header
+
+
+# function to count the lines of an attached NRRD header
+def count_header_lines(input_file):
+    """
+    Return the number of lines of the header of a NRRD file (including the blank line that ends it).
+    """
+    count = 0
+    with open(input_file, 'rb') as fh:
+        for line in fh:
+            count += 1
+            if line.strip() == b'':
+                break
+    return count
+
+
+# function to write the reflection as an ITK transform
+def write_reflection_matrix(mat_file, header, axis, center):
+    """
+    Write the reflection about center along the physical axis as an ITK AffineTransform (.mat),
+    the same transform ImageMath ReflectionMatrix writes.
+    """
+    # ITK works in LPS coordinates
+    signs = np.array(SPACE_SIGNS.get(header.get('space', 'left-posterior-superior'), [1, 1, 1]), dtype=float)
+    matrix = np.eye(3)
+    matrix[axis, axis] = -1
+    parameters = np.concatenate([matrix.flatten(), np.zeros(3)])
+    scipy.io.savemat(mat_file, {'AffineTransform_double_3_3': parameters[:, None], 'fixed': (center * signs)[:, None]}, format='4')
+
+
+# function to mirror a NRRD file
+def mirror_nrrd(input_file, output_file, axis, mat_file=None):
+    """
+    Mirror input_file along the physical axis (0: x, 1: y, 2: z) about its center of gravity
+    and write it to output_file. The reflection is also written to mat_file if given.
+    """
+    data, header = nrrd.read(input_file)
+    assert data.ndim == 3, "Only 3D images are supported by the native mirror."
+    center = get_center_of_gravity(data, header)
+    out_header, flip_axis = make_mirror_header(header, data.shape, axis, center)
+    nrrd.write(output_file, np.flip(data, axis=flip_axis), out_header)
+    if mat_file is not None:
+        write_reflection_matrix(mat_file, header, axis, center)
+    return data.size
+
+
+# function to mirror a NRRD file with a detached header
+def write_mirror_header(input_file, output_file, axis, mat_file=None):
+    """
+    Write a detached header (.nhdr) to output_file that points at the data of input_file
+    and reflects it along the physical axis about its center of gravity. The voxels are not copied.
+    """
+    center, header, shape = get_file_center_of_gravity(input_file)
+    reflection = np.eye(3)
+    reflection[axis, axis] = -1
+    # the data stays where it is, only the geometry is reflected
+    directions = get_space_directions(header) @ reflection
+    origin = center + reflection @ (get_origin(header) - center)
+    out_header = copy_geometry(header, directions, origin)
+    out_header['encoding'] = header['encoding']
+
+    # find the data of the input file
+    data_file = header.get('data file', header.get('datafile', None))
+    line_skip = header.get('line skip', header.get('lineskip', 0))
+    byte_skip = header.get('byte skip', header.get('byteskip', 0))
+    if data_file is None:
+        # attached data starts after the header of the input file
+        data_file = input_file
+        line_skip += count_header_lines(input_file)
+    elif not os.path.isabs(data_file):
+        data_file = os.path.join(os.path.dirname(input_file), data_file)
+    # data files are stored relative to the header
+    data_file = os.path.relpath(data_file, os.path.dirname(os.path.abspath(output_file)))
+
+    text = format_nrrd_header(out_header, shape, get_dtype(header))
+    text = text[:-1] + 'data file: {}\nline skip: {}\nbyte skip: {}\n\n'.format(data_file, line_skip, byte_skip).encode('ascii')
+    with open(output_file, 'wb') as fh:
+        fh.write(text)
+    if mat_file is not None:
+        write_reflection_matrix(mat_file, header, axis, center)
+    return int(np.prod(shape))
@@ -0,0 +1,502 @@
+# helper functions to resample NRRD stacks in-process (without calling ANTs)
+
+## IMPLEMENTATION DETAILS
+# The output geometry mirrors the two ANTs calls used in resample.py:
+#   - ResampleImageBySpacing 3 <in> <out> sx sy sz 0 0 0   ('spacing' type)
+#       size = int(size_old * spacing_old / spacing), background = input voxel (1,1,1)
+#   - ResampleImage 3 <in> <out> sxxsyxsz 0 0 6             ('size' type)
+#       size = int(spacing_old * size_old / spacing + 0.5), background = 0
+# In both cases the origin and direction are kept, the transform is the identity
+# and the interpolation is linear, so the continuous input index of output voxel i
+# along an axis is simply i * spacing / spacing_old. Trilinear interpolation on a
+# regular grid is separable, so we interpolate one axis at a time with vectorized
+# gathers instead of evaluating every output voxel in 3D.
+
+import os # file handling
+import io # in-memory buffers
+import json # pyramid manifests
+import gzip # compressed NRRD data
+import time # timing
+import numpy as np # linear algebra
+import nrrd # NRRD file handling
+
+# version of the native engines (bump when their output changes, this invalidates cached results)
+ENGINE_VERSION = '1.0.0'
+
+
+# function to get the voxel spacing from a NRRD header
+def get_spacing(header):
+    """
+    Return the voxel spacing (x, y, z) stored in a NRRD header.
+    'space directions' takes precedence over 'spacings' (same as ITK).
+    """
+    if 'space directions' in header and header['space directions'] is not None:
+        directions = np.asarray(header['space directions'], dtype=float)
+        return np.linalg.norm(directions, axis=1)
+    if 'spacings' in header:
+        return np.asarray(header['spacings'], dtype=float)
+    return np.ones(len(header['sizes']))
+
+
+# function to get the origin from a NRRD header
+def get_origin(header):
+    """
+    Return the physical origin stored in a NRRD header (zero if missing).
+    """
+    if 'space origin' in header and header['space origin'] is not None:
+        return np.asarray(header['space origin'], dtype=float)
+    return np.zeros(len(header['sizes']))
+
+
+# function to get the unit direction vectors from a NRRD header
+def get_directions(header):
+    """
+    Return the unit direction vectors (one row per axis) stored in a NRRD header.
+    """
+    if 'space directions' in header and header['space directions'] is not None:
+        directions = np.asarray(header['space directions'], dtype=float)
+        return directions / np.linalg.norm(directions, axis=1)[:, None]
+    return np.eye(len(header['sizes']))
+
+
+# function to build the header of a resampled file
+def make_output_header(header, spacing, origin=None):
+    """
+    Copy the input header and replace the geometry with the new spacing (and origin).
+    Fields that describe how the input was stored on disk are dropped so that
+    pynrrd can write the output with its own defaults.
+    """
+    out_header = {}
+    for key, value in header.items():
+        if key in ['type', 'dimension', 'sizes', 'encoding', 'endian', 'data file', 'datafile', 'line skip', 'lineskip', 'byte skip', 'byteskip', 'spacings', 'space directions']:
+            continue
+        out_header[key] = value
+    spacing = np.asarray(spacing, dtype=float)
+    if 'space directions' in header and header['space directions'] is not None:
+        out_header['space directions'] = get_directions(header) * spacing[:, None]
+    else:
+        out_header['spacings'] = spacing
+    if origin is not None:
+        out_header['space origin'] = np.asarray(origin, dtype=float)
+    return out_header
+
+
+# function to compute the output size of a resampling run
+def get_output_size(size, spacing, target_spacing, resampling_type='spacing'):
+    """
+    Return the output size that ANTs would produce for the given resampling type.
+    """
+    if resampling_type == 'spacing':
+        return [int(n * s / t) for n, s, t in zip(size, spacing, target_spacing)]
+    if resampling_type == 'size':
+        return [int((s * n) / t + 0.5) for n, s, t in zip(size, spacing, target_spacing)]
+    raise ValueError("Resampling type must be 'spacing' or 'size'.")
+
+
+# function to get the value used outside the input buffer
+def get_background_value(data, resampling_type='spacing'):
+    """
+    ResampleImageBySpacing fills regions without source with the voxel at index (1,1,1),
+    ResampleImage fills them with 0.
+    """
+    if resampling_type == 'spacing':
+        return float(data[tuple(min(1, n - 1) for n in data.shape)])
+    return 0.0
+
+
+# function to get the interpolation indices and weights along one axis
+def axis_weights(size_in, size_out, ratio, offset=0.0):
+    """
+    Return lower index, upper index, upper weight and outside mask for every output
+    sample along one axis. Output sample i sits at continuous input index offset + i * ratio.
+    """
+    # continuous index of every output sample along this axis
+    cindex = offset + np.arange(size_out) * ratio
+    # ITK treats samples beyond half a voxel from the last voxel as outside the buffer
+    outside = (cindex < -0.5) | (cindex >= size_in - 0.5)
+    lower = np.floor(cindex).astype(np.intp)
+    weight = (cindex - lower).astype(np.float32)
+    # neighbours outside the buffer are clamped to the border voxel
+    upper = np.clip(lower + 1, 0, size_in - 1)
+    lower = np.clip(lower, 0, size_in - 1)
+    return lower, upper, weight, outside
+
+
+# function to interpolate an array along one axis
+def interpolate_axis(data, axis, lower, upper, weight):
+    """
+    Linearly interpolate data along one axis using precomputed indices and weights.
+    """
+    # gather the two neighbours of every output sample
+    low = np.take(data, lower, axis=axis).astype(np.float32, copy=False)
+    high = np.take(data, upper, axis=axis).astype(np.float32, copy=False)
+    # broadcast the weights along the interpolated axis
+    shape = [1] * data.ndim
+    shape[axis] = -1
+    weight = weight.reshape(shape)
+    # low + (high - low) * weight, computed in place to save memory
+    high -= low
+    high *= weight
+    high += low
+    return high
+
+
+# function to get the order in which the axes are interpolated
+def get_axis_order(input_size, output_size):
+    """
+    Return the axes sorted from the most shrinking to the most growing.
+    """
+    return list(np.argsort([n_out / n_in for n_in, n_out in zip(input_size, output_size)], kind='stable'))
+
+
+# function to interpolate a block with precomputed weights
+def interpolate_block(data, weights, background=0.0, order=None):
+    """
+    Apply separable linear interpolation to a 3D block.
+    weights is a list with one (lower, upper, weight, outside) tuple per axis (see axis_weights).
+    order is the order in which the axes are interpolated (default: most shrinking axis first).
+    Returns a float32 array.
+    """
+    # interpolate the axes that shrink the most first to keep the intermediates small
+    if order is None:
+        order = get_axis_order(data.shape, [len(w[0]) for w in weights])
+    output = data
+    for axis in order:
+        lower, upper, weight, _ = weights[axis]
+        output = interpolate_axis(output, axis, lower, upper, weight)
+    output = np.asarray(output, dtype=np.float32)
+    # fill the samples that fall outside the input buffer
+    for axis in range(output.ndim):
+        outside = weights[axis][3]
+        if outside.any():
+            index = [slice(None)] * output.ndim
+            index[axis] = outside
+            output[tuple(index)] = background
+    return output
+
+
+# function to resample a full array
+def resample_array(data, spacing, target_spacing, output_size, background=0.0):
+    """
+    Resample a 3D array from spacing to target_spacing using separable linear interpolation.
+    Returns a float32 array of shape output_size.
+    """
+    ratios = [t / s for s, t in zip(spacing, target_spacing)]
+    weights = [axis_weights(n_in, n_out, r) for n_in, n_out, r in zip(data.shape, output_size, ratios)]
+    return interpolate_block(data, weights, background)
+
+
+# function to resample a NRRD file
+def resample_nrrd(input_file, output_file, target_spacing, resampling_type='spacing'):
+    """
+    Resample input_file to target_spacing and write it to output_file.
+    Returns the number of input voxels and the time taken in seconds.
+    """
+    start_time = time.time()
+    # read the data
+    data, header = nrrd.read(input_file)
+    assert data.ndim == 3, "Only 3D images are supported by the native engine."
+    spacing = get_spacing(header)
+    # compute the output geometry
+    output_size = get_output_size(data.shape, spacing, target_spacing, resampling_type)
+    background = get_background_value(data, resampling_type)
+    # resample and write the data
+    output = resample_array(data, spacing, target_spacing, output_size, background)
+    nrrd.write(output_file, output, make_output_header(header, target_spacing))
+    return data.size, time.time() - start_time
+
+
+
+## MULTI-RESOLUTION PYRAMIDS
+# A pyramid is a list of voxel sizes (fine to coarse). The input is read once and every
+# level is interpolated from the previous (finer) level, which is much cheaper than going
+# back to the full resolution stack. The size of every level is the one a direct
+# resampling of the input would have, so pyramid levels can be used wherever a single
+# resample.py output is expected. A JSON manifest lists the levels and their files.
+
+# function to resample a NRRD file to several voxel sizes
+def resample_pyramid(input_file, output_files, levels, resampling_type='spacing'):
+    """
+    Resample input_file to every voxel size in levels (sorted fine to coarse) and write
+    level i to output_files[i]. Returns the number of input voxels and the time taken in seconds.
+    """
+    start_time = time.time()
+    # read the data once
+    data, header = nrrd.read(input_file)
+    assert data.ndim == 3, "Only 3D images are supported by the native engine."
+    spacing = get_spacing(header)
+    background = get_background_value(data, resampling_type)
+    # build every level from the previous one
+    source, source_spacing = data, spacing
+    for target_spacing, output_file in zip(levels, output_files):
+        output_size = get_output_size(data.shape, spacing, target_spacing, resampling_type)
+        output = resample_array(source, source_spacing, target_spacing, output_size, background)
+        nrrd.write(output_file, output, make_output_header(header, target_spacing))
+        source, source_spacing = output, target_spacing
+    return data.size, time.time() - start_time
+
+
+# function to write a pyramid manifest
+def write_pyramid_manifest(manifest_file, levels, labels, input_files, level_output_files, resampling_type='spacing'):
+    """
+    Write a JSON manifest listing every pyramid level with its voxel size and files.
+    Paths are stored relative to the manifest.
+    """
+    root = os.path.dirname(os.path.abspath(manifest_file))
+    manifest = {'resampling_type': resampling_type, 'engine_version': ENGINE_VERSION, 'levels': []}
+    for level, label, output_files in zip(levels, labels, level_output_files):
+        files = {os.path.basename(i): os.path.relpath(os.path.abspath(o), root) for i, o in zip(input_files, output_files)}
+        manifest['levels'].append({'label': label, 'voxel_size': [float(i) for i in level], 'files': files})
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+# function to read a pyramid manifest
+def read_pyramid_manifest(manifest_file):
+    """
+    Read a pyramid manifest and turn the file paths into paths relative to the current directory.
+    """
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+    root = os.path.dirname(manifest_file)
+    for level in manifest['levels']:
+        level['files'] = {name: os.path.join(root, path) for name, path in level['files'].items()}
+    return manifest
+
+
+# function to pick a pyramid level
+def select_pyramid_level(manifest, target_voxel_size):
+    """
+    Return the level of a pyramid manifest with the requested voxel size. If there is no
+    exact match, return the coarsest level that is at least as fine as the target (the best
+    level to resample from), or the finest level if all levels are coarser.
+    """
+    target = np.asarray(target_voxel_size, dtype=float)
+    levels = sorted(manifest['levels'], key=lambda level: np.prod(level['voxel_size']))
+    for level in levels:
+        if np.allclose(level['voxel_size'], target):
+            return level
+    finer = [level for level in levels if np.all(np.asarray(level['voxel_size']) <= target)]
+    return finer[-1] if len(finer) > 0 else levels[0]
+
+## STREAMING (OUT-OF-CORE) RESAMPLING
+# NRRD data is stored with x varying fastest, so every z-slice (and every slab of
+# consecutive z-slices) is a contiguous block of the data file. The streaming engine
+# walks the output volume in z-slabs, reads only the input slices that the slab
+# needs (neighbouring slabs overlap by the slices shared by the interpolation) and
+# writes each slab into a preallocated raw NRRD file through a memory map. Both maps
+# only cover the current slab, so the resident memory is bounded by the slab size.
+
+# map of NRRD type names to numpy type strings
+NRRD_TYPES = {}
+for _names, _typestring in [
+        (['signed char', 'int8', 'int8_t'], 'i1'),
+        (['uchar', 'unsigned char', 'uint8', 'uint8_t'], 'u1'),
+        (['short', 'short int', 'signed short', 'signed short int', 'int16', 'int16_t'], 'i2'),
+        (['ushort', 'unsigned short', 'unsigned short int', 'uint16', 'uint16_t'], 'u2'),
+        (['int', 'signed int', 'int32', 'int32_t'], 'i4'),
+        (['uint', 'unsigned int', 'uint32', 'uint32_t'], 'u4'),
+        (['longlong', 'long long', 'long long int', 'signed long long', 'signed long long int', 'int64', 'int64_t'], 'i8'),
+        (['ulonglong', 'unsigned long long', 'unsigned long long int', 'uint64', 'uint64_t'], 'u8'),
+        (['float'], 'f4'),
+        (['double'], 'f8')]:
+    for _name in _names:
+        NRRD_TYPES[_name] = _typestring
+
+
+# function to get the numpy dtype of the data in a NRRD file
+def get_dtype(header):
+    """
+    Return the numpy dtype (with byte order) described by a NRRD header.
+    """
+    dtype = np.dtype(NRRD_TYPES[header['type']])
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder('>' if header.get('endian', 'little') == 'big' else '<')
+    return dtype
+
+
+# function to find where the data of a NRRD file is stored
+def get_data_location(input_file):
+    """
+    Return the header, the path of the file holding the data and the byte offset of the data.
+    Works for attached headers (.nrrd) and detached headers (.nhdr with a 'data file' field).
+    For compressed encodings the offset points to the start of the compressed stream.
+    """
+    with open(input_file, 'rb') as fh:
+        header = nrrd.read_header(fh)
+        offset = fh.tell()
+    data_file = header.get('data file', header.get('datafile', None))
+    if data_file is not None:
+        assert not data_file.startswith('LIST') and ' ' not in data_file, "Multi-file NRRD data is not supported."
+        # relative data files are relative to the header
+        if not os.path.isabs(data_file):
+            data_file = os.path.join(os.path.dirname(input_file), data_file)
+        offset = 0
+    else:
+        data_file = input_file
+    # skip lines before the data
+    line_skip = header.get('line skip', header.get('lineskip', 0))
+    if line_skip > 0:
+        with open(data_file, 'rb') as fh:
+            fh.seek(offset)
+            for _ in range(line_skip):
+                fh.readline()
+            offset = fh.tell()
+    # skip bytes before the data (-1 means the data is at the end of the file)
+    byte_skip = header.get('byte skip', header.get('byteskip', 0))
+    if byte_skip == -1:
+        assert header['encoding'] == 'raw', "Byte skip of -1 is only supported for raw encoding."
+        offset = os.path.getsize(data_file) - int(np.prod(header['sizes'])) * get_dtype(header).itemsize
+    else:
+        offset += byte_skip
+    return header, data_file, offset
+
+
+# function to format a NRRD header
+def format_nrrd_header(header, shape, dtype):
+    """
+    Return the text of a NRRD header (up to and including the blank line that ends it)
+    for data of the given shape and dtype, stored with the encoding given in header.
+    """
+    dtype = np.dtype(dtype)
+    # let pynrrd format the header of a single voxel and patch in the real sizes
+    buffer = io.BytesIO()
+    nrrd.write(buffer, np.zeros((1,) * len(shape), dtype=dtype), header)
+    text = buffer.getvalue()
+    text = text[:text.index(b'\n\n') + 2]
+    single_sizes = ('\nsizes: ' + ' '.join(['1'] * len(shape)) + '\n').encode('ascii')
+    real_sizes = ('\nsizes: ' + ' '.join(str(int(n)) for n in shape) + '\n').encode('ascii')
+    assert single_sizes in text, "Could not generate NRRD header."
+    return text.replace(single_sizes, real_sizes)
+
+
+# function to write a NRRD header for raw data
+def write_nrrd_header(output_file, header, shape, dtype):
+    """
+    Write a NRRD header for raw-encoded data of the given shape and dtype and
+    preallocate the data section. Returns the byte offset of the data.
+    """
+    dtype = np.dtype(dtype)
+    text = format_nrrd_header(dict(header, encoding='raw'), shape, dtype)
+    # write the header and extend the file to its final size
+    with open(output_file, 'wb') as fh:
+        fh.write(text)
+        fh.truncate(len(text) + int(np.prod(shape)) * dtype.itemsize)
+    return len(text)
+
+
+# class to read z-slabs of a NRRD file
+class SlabReader:
+    """
+    Read z-slabs of a 3D NRRD file without loading the full stack.
+    Raw data is memory-mapped slab by slab. Gzip data is decompressed sequentially,
+    so slabs must be requested in increasing order (overlaps are kept in a buffer).
+    """
+    def __init__(self, input_file):
+        self.header, self.data_file, self.offset = get_data_location(input_file)
+        assert self.header['dimension'] == 3, "Only 3D images are supported by the streaming engine."
+        self.encoding = self.header['encoding']
+        assert self.encoding in ['raw', 'gzip', 'gz'], "Streaming engine only supports raw or gzip encoded NRRD files."
+        self.dtype = get_dtype(self.header)
+        self.shape = tuple(int(n) for n in self.header['sizes'])
+        self.slice_bytes = self.shape[0] * self.shape[1] * self.dtype.itemsize
+        # state of the sequential gzip reader
+        self.stream = None
+        self.buffer = np.empty(self.shape[:2] + (0,), dtype=self.dtype, order='F')
+        self.buffer_start = 0
+
+    def read(self, z0, z1):
+        """
+        Return the input slices z0 to z1 (exclusive) as an array of shape (x, y, z1 - z0).
+        """
+        if self.encoding == 'raw':
+            # map only the requested slab
+            return np.memmap(self.data_file, dtype=self.dtype, mode='r', offset=self.offset + z0 * self.slice_bytes, shape=self.shape[:2] + (z1 - z0,), order='F')
+        if self.stream is None:
+            fh = open(self.data_file, 'rb')
+            fh.seek(self.offset)
+            self.stream = gzip.GzipFile(fileobj=fh)
+        assert z0 >= self.buffer_start, "Slabs of gzip encoded files must be read in order."
+        buffer_end = self.buffer_start + self.buffer.shape[2]
+        # skip slices that are not needed
+        while buffer_end < z0:
+            n_skip = min(z0 - buffer_end, max(1, (64 << 20) // self.slice_bytes))
+            self.stream.read(n_skip * self.slice_bytes)
+            buffer_end += n_skip
+        # keep the overlap with the previous slab and read the new slices
+        keep = self.buffer[:, :, max(0, z0 - self.buffer_start):]
+        n_new = z1 - max(buffer_end, z0)
+        if n_new > 0:
+            raw = self.stream.read(n_new * self.slice_bytes)
+            assert len(raw) == n_new * self.slice_bytes, "Unexpected end of data in {}.".format(self.data_file)
+            new = np.frombuffer(raw, dtype=self.dtype).reshape(self.shape[:2] + (n_new,), order='F')
+            keep = np.concatenate([keep, new], axis=2)
+        self.buffer = keep
+        self.buffer_start = z0
+        return self.buffer[:, :, :z1 - z0]
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.fileobj.close()
+            self.stream.close()
+            self.stream = None
+
+
+# function to choose the number of output slices per slab
+def get_slab_size(input_shape, itemsize, output_size, ratio, max_memory):
+    """
+    Return the number of output z-slices per slab so that one slab fits in max_memory bytes.
+    Counts the input slices of the slab (plus float32 interpolation copies) and the output slab.
+    """
+    input_slice = input_shape[0] * input_shape[1] * (itemsize + 8)
+    output_slice = output_size[0] * output_size[1] * 4 * 3
+    # every slab needs up to two extra input slices at its borders
+    per_slice = input_slice * max(ratio, 1.0) + output_slice
+    available = max_memory - 2 * input_slice
+    return int(max(1, min(output_size[2], available // per_slice)))
+
+
+# function to resample a NRRD file slab by slab
+def resample_nrrd_streaming(input_file, output_file, target_spacing, resampling_type='spacing', max_memory=2.0):
+    """
+    Resample input_file to target_spacing and write it to output_file (raw encoded float NRRD)
+    while keeping the resident memory under roughly max_memory GB.
+    Returns the number of input voxels and the time taken in seconds.
+    """
+    start_time = time.time()
+    reader = SlabReader(input_file)
+    header = reader.header
+    spacing = get_spacing(header)
+    # compute the output geometry and the interpolation weights along every axis
+    output_size = get_output_size(reader.shape, spacing, target_spacing, resampling_type)
+    ratios = [t / s for s, t in zip(spacing, target_spacing)]
+    weights = [axis_weights(n_in, n_out, r) for n_in, n_out, r in zip(reader.shape, output_size, ratios)]
+    order = get_axis_order(reader.shape, output_size)
+    slab_size = get_slab_size(reader.shape, reader.dtype.itemsize, output_size, ratios[2], max_memory * 1024**3)
+    # preallocate the output file
+    out_dtype = np.dtype('<f4')
+    data_offset = write_nrrd_header(output_file, make_output_header(header, target_spacing), output_size, out_dtype)
+    out_slice_bytes = output_size[0] * output_size[1] * out_dtype.itemsize
+    background = None
+    try:
+        for oz0 in range(0, output_size[2], slab_size):
+            oz1 = min(oz0 + slab_size, output_size[2])
+            # input slices needed by this slab
+            lower, upper, weight, outside = (w[oz0:oz1] for w in weights[2])
+            z0, z1 = int(lower.min()), int(upper.max()) + 1
+            slab = reader.read(z0, z1)
+            # the first slab always starts at slice 0 and holds the background voxel
+            if background is None:
+                background = get_background_value(slab, resampling_type)
+            # use the axis order of the full volume so that the result matches resample_array
+            block = interpolate_block(slab, weights[:2] + [(lower - z0, upper - z0, weight, outside)], background, order)
+            del slab
+            # write the slab through a map that only covers it
+            out = np.memmap(output_file, dtype=out_dtype, mode='r+', offset=data_offset + oz0 * out_slice_bytes, shape=block.shape, order='F')
+            out[:] = block
+            out.flush()
+            del out, block
+    finally:
+        reader.close()
+    return int(np.prod(reader.shape)), time.time() - start_time
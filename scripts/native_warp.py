@@ -0,0 +1,544 @@
+# helper functions to apply ANTs transforms in-process (without calling ANTs)
+
+## IMPLEMENTATION DETAILS
+# template_resample.py and the GUIs used to warp every image with WarpImageMultiTransform or
+# antsApplyTransforms. Both map every voxel of the reference grid to the moving image and
+# sample it there. Here the same is done in numpy:
+#   - all points are in ITK's physical space (LPS): NRRD geometry is converted with the
+#     signs of its space, NIfTI affines (RAS) by flipping x and y
+#   - affine transforms are read from ITK text files (Affine.txt, optionally gzipped) or
+#     MATLAB v4 files (GenericAffine.mat): y = A (x - c) + t + c with c the fixed parameters
+#   - displacement fields (Warp.nii.gz) hold LPS vectors on their own grid; they are sampled
+#     with linear interpolation and add nothing outside their grid (as in ITK)
+#   - the transforms are applied to the points in the order they are given on the command
+#     line of antsApplyTransforms / WarpImageMultiTransform ('-t Warp -t Affine' maps a
+#     reference point through the warp first and then through the affine)
+#   - consecutive affine steps (including the reference and moving grid geometry) are
+#     merged into a single matrix, so an affine-only warp costs one matrix product per block
+#   - the moving image is sampled with the rules of ITK's interpolators: points outside
+#     [-0.5, size - 0.5) get the default value 0, linear interpolation clamps the neighbours
+#     at the border, nearest neighbour rounds half up and GenericLabel picks the label with
+#     the largest total linear weight among the 8 neighbours
+# Several channels of the same brain share their sample points: the points of a block
+# (and the neighbour indices and weights of the interpolators) are computed once and
+# used for every channel. An image can be warped onto several reference grids (e.g. templates
+# at several voxel sizes) while its channels and transforms are only read once.
+# A displacement field that lives on the reference grid itself (e.g. a chain of transforms
+# composed once with compose_field) is looked up per block without interpolation.
+# The reference grid is processed in blocks along its first axis on a thread pool (numpy
+# releases the GIL in the heavy loops), so the memory needed on top of the images is a few
+# arrays of the block size per thread. A warp can be cancelled between blocks (the blocks
+# already started are finished), which raises command_runner.CommandStopped.
+
+import os # file handling
+import gzip # compressed transforms
+import numpy as np # linear algebra
+import nrrd # NRRD file handling
+import nibabel as nib # NIfTI file handling
+import scipy.io # MATLAB transform files
+from concurrent.futures import ThreadPoolExecutor # block parallelism
+from native_mirror import SPACE_SIGNS, get_space_directions # NRRD geometry
+from native_resample import get_origin # NRRD geometry
+from job_scheduler import ITK_THREADS_VARIABLE # thread count set by the scheduler
+from command_runner import CommandStopped # cancelled warps
+
+# number of reference voxels processed at a time by every thread
+BLOCK_VOXELS = 1 << 18
+
+# conversion between NIfTI (RAS) and ITK (LPS) physical coordinates
+RAS_TO_LPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+# function to check if a file is a NIfTI file
+def is_nifti(path):
+    """
+    Return True if path is a NIfTI file (.nii or .nii.gz).
+    """
+    return path.endswith('.nii') or path.endswith('.nii.gz')
+
+
+# function to get the geometry of a NRRD header
+def get_nrrd_affine(header):
+    """
+    Return the 4x4 matrix that maps voxel indices to LPS physical points for a NRRD header.
+    """
+    signs = np.array(SPACE_SIGNS.get(header.get('space', 'left-posterior-superior'), [1, 1, 1]), dtype=float)
+    affine = np.eye(4)
+    affine[:3, :3] = (get_space_directions(header) * signs).T
+    affine[:3, 3] = get_origin(header) * signs
+    return affine
+
+
+# function to read the geometry of an image
+def read_geometry(path):
+    """
+    Return the grid shape (first three axes) and the 4x4 index to LPS matrix of a NRRD or NIfTI file
+    without reading its data.
+    """
+    if is_nifti(path):
+        image = nib.load(path)
+        return tuple(image.shape[:3]), RAS_TO_LPS @ image.affine
+    header = nrrd.read_header(path)
+    return tuple(int(i) for i in header['sizes'][:3]), get_nrrd_affine(header)
+
+
+# function to read an image
+def read_image(path):
+    """
+    Return the data and the 4x4 index to LPS matrix of a NRRD or NIfTI file.
+    """
+    if is_nifti(path):
+        image = nib.load(path)
+        return np.asanyarray(image.dataobj), RAS_TO_LPS @ image.affine
+    data, header = nrrd.read(path)
+    return data, get_nrrd_affine(header)
+
+
+# function to write an image
+def write_image(path, data, affine):
+    """
+    Write data on the grid given by the 4x4 index to LPS matrix as NRRD or NIfTI (chosen by the extension).
+    """
+    if is_nifti(path):
+        nib.save(nib.Nifti1Image(data, RAS_TO_LPS @ affine), path)
+        return
+    header = {
+        'space': 'left-posterior-superior',
+        'space directions': affine[:3, :3].T,
+        'space origin': affine[:3, 3],
+        'encoding': 'gzip',
+    }
+    nrrd.write(path, data, header)
+
+
+# function to open a text file that may be gzipped
+def open_text(path):
+    """
+    Open a text file for reading, decompressing it on the fly if it ends with .gz.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path, 'r')
+
+
+# function to build an affine matrix from ITK parameters
+def make_affine(parameters, fixed_parameters):
+    """
+    Return the 4x4 matrix of an ITK MatrixOffsetTransformBase (3D) from its 12 parameters
+    (matrix row by row, then translation) and its center (fixed parameters).
+    """
+    parameters = np.asarray(parameters, dtype=float).flatten()
+    assert parameters.size == 12, "Only 3D affine transforms (12 parameters) are supported."
+    center = np.zeros(3) if fixed_parameters is None else np.asarray(fixed_parameters, dtype=float).flatten()[:3]
+    matrix = parameters[:9].reshape(3, 3)
+    affine = np.eye(4)
+    affine[:3, :3] = matrix
+    affine[:3, 3] = parameters[9:] + center - matrix @ center
+    return affine
+
+
+# function to read an ITK affine transform
+def read_affine(path):
+    """
+    Return the 4x4 LPS matrix of an ITK affine transform file: text (Affine.txt, Affine.txt.gz)
+    or MATLAB v4 (GenericAffine.mat). The matrix maps points of the fixed space to the moving space.
+    """
+    if path.endswith('.mat'):
+        variables = scipy.io.loadmat(path)
+        names = [name for name in variables if name.startswith('AffineTransform') or name.startswith('MatrixOffsetTransformBase')]
+        assert len(names) == 1, "No affine transform found in {}.".format(path)
+        return make_affine(variables[names[0]], variables.get('fixed', None))
+
+    parameters = None
+    fixed_parameters = None
+    with open_text(path) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            key = key.strip()
+            if key == 'Transform':
+                transform_type = value.strip()
+                assert transform_type.startswith('AffineTransform') or transform_type.startswith('MatrixOffsetTransformBase'), "Unsupported transform type {} in {}.".format(transform_type, path)
+            elif key == 'Parameters':
+                assert parameters is None, "Only files with a single transform are supported ({}).".format(path)
+                parameters = [float(i) for i in value.split()]
+            elif key == 'FixedParameters':
+                fixed_parameters = [float(i) for i in value.split()]
+    assert parameters is not None, "No transform parameters found in {}.".format(path)
+    return make_affine(parameters, fixed_parameters)
+
+
+# class to hold a displacement field
+class DisplacementField:
+    """
+    Displacement field: LPS vectors (x, y, z, 3) on the grid given by a 4x4 index to LPS matrix,
+    linearly interpolated and zero outside the grid. The vectors may be a memmap.
+    """
+    def __init__(self, vectors, affine):
+        self.vectors = vectors
+        self.affine = np.asarray(affine, dtype=float)
+        self.inverse_affine = np.linalg.inv(self.affine)
+
+    def matches(self, shape, affine):
+        """
+        Return True if the field is defined on the grid with the given shape and 4x4 index to LPS matrix.
+        """
+        return tuple(self.vectors.shape[:3]) == tuple(shape[:3]) and np.allclose(self.affine, affine, atol=1e-6)
+
+    def transform(self, points):
+        """
+        Move points (N x 3, LPS) by the displacement at their position.
+        """
+        cindex = points @ self.inverse_affine[:3, :3].T + self.inverse_affine[:3, 3]
+        return points + interpolate_linear(self.vectors, cindex)
+
+    def transform_grid(self, points, start, stop):
+        """
+        Move the points of the grid slices start to stop along the first axis (the grid of the field) without interpolation.
+        """
+        return points + self.vectors[start:stop].reshape(-1, 3)
+
+
+# function to read an ANTs displacement field
+def read_displacement_field(path):
+    """
+    Return the DisplacementField stored in an ANTs warp file (Warp.nii.gz, 5D NIfTI with LPS vectors).
+    """
+    assert is_nifti(path), "Displacement fields must be NIfTI files ({}).".format(path)
+    image = nib.load(path)
+    shape = image.shape
+    assert len(shape) == 5 and shape[3] == 1 and shape[4] == 3, "{} is not a 3D displacement field.".format(path)
+    # an uncompressed field (e.g. from the decompression cache) stays memory-mapped
+    vectors = np.asanyarray(image.dataobj)[:, :, :, 0, :]
+    if vectors.dtype != np.float32:
+        vectors = vectors.astype(np.float32)
+    return DisplacementField(vectors, RAS_TO_LPS @ image.affine)
+
+
+# function to load a list of transforms
+def load_transforms(transforms):
+    """
+    Return the steps of a list of (path, invert) transforms, in the order they are applied to
+    reference points (the command line order of antsApplyTransforms). Affine steps are 4x4
+    matrices, displacement fields DisplacementField objects (steps are passed through as they are).
+    """
+    steps = []
+    for transform in transforms:
+        if not isinstance(transform, tuple):
+            steps.append(transform)
+            continue
+        path, invert = transform
+        if is_nifti(path):
+            assert not invert, "Displacement fields cannot be inverted, use the InverseWarp file instead ({}).".format(path)
+            steps.append(read_displacement_field(path))
+        else:
+            affine = read_affine(path)
+            steps.append(np.linalg.inv(affine) if invert else affine)
+    return steps
+
+
+# function to merge consecutive affine steps
+def merge_steps(steps):
+    """
+    Multiply consecutive affine steps into single matrices.
+    """
+    merged = []
+    for step in steps:
+        if isinstance(step, np.ndarray) and len(merged) > 0 and isinstance(merged[-1], np.ndarray):
+            merged[-1] = step @ merged[-1]
+        else:
+            merged.append(step)
+    return merged
+
+
+# function to find the neighbours of continuous indices
+def get_neighbours(shape, cindex):
+    """
+    Return the mask of continuous indices (N x 3) inside [-0.5, size - 0.5), and for the points
+    inside, the 8 neighbour indices (clamped to the grid) with their linear weights.
+    """
+    size = np.asarray(shape[:3])
+    inside = np.all((cindex >= -0.5) & (cindex < size - 0.5), axis=1)
+    cindex = cindex[inside]
+    base = np.floor(cindex)
+    fraction = cindex - base
+    lower = np.clip(base, 0, size - 1).astype(np.intp)
+    upper = np.clip(base + 1, 0, size - 1).astype(np.intp)
+    neighbours = []
+    for corner in range(8):
+        bits = [(corner >> axis) & 1 for axis in range(3)]
+        index = tuple(upper[:, axis] if bits[axis] else lower[:, axis] for axis in range(3))
+        weight = np.ones(len(cindex))
+        for axis in range(3):
+            weight *= fraction[:, axis] if bits[axis] else 1 - fraction[:, axis]
+        neighbours.append((index, weight))
+    return inside, neighbours
+
+
+# class to hold the sample points of a block
+class SampleCoordinates:
+    """
+    Continuous indices (N x 3) of sample points on a grid, together with the neighbour indices and
+    weights the interpolators need. They are computed once (on first use) and shared by all
+    channels sampled at the same points.
+    """
+    def __init__(self, shape, cindex):
+        self.shape = tuple(shape[:3])
+        self.cindex = cindex
+        self.linear = None
+        self.nearest = None
+
+    def get_linear(self):
+        """
+        Return the mask of points inside the grid and the 8 neighbours with their linear weights.
+        """
+        if self.linear is None:
+            self.linear = get_neighbours(self.shape, self.cindex)
+        return self.linear
+
+    def get_nearest(self):
+        """
+        Return the mask of points inside the grid and the index of their nearest voxel.
+        """
+        if self.nearest is None:
+            size = np.asarray(self.shape)
+            inside = np.all((self.cindex >= -0.5) & (self.cindex < size - 0.5), axis=1)
+            index = np.clip(np.floor(self.cindex[inside] + 0.5), 0, size - 1).astype(np.intp)
+            self.nearest = inside, (index[:, 0], index[:, 1], index[:, 2])
+        return self.nearest
+
+
+# function to get the sample coordinates of continuous indices
+def get_coordinates(data, cindex):
+    """
+    Return cindex as SampleCoordinates on the grid of data (unchanged if it already is).
+    """
+    if isinstance(cindex, SampleCoordinates):
+        assert cindex.shape == tuple(data.shape[:3]), "All channels must be on the same grid."
+        return cindex
+    return SampleCoordinates(data.shape, cindex)
+
+
+# function to interpolate linearly
+def interpolate_linear(data, cindex, default=0.0):
+    """
+    Linearly interpolate data (with optional trailing channel axes) at continuous indices (N x 3 or SampleCoordinates).
+    """
+    coordinates = get_coordinates(data, cindex)
+    inside, neighbours = coordinates.get_linear()
+    values = np.zeros((inside.sum(),) + data.shape[3:], dtype=np.float64)
+    for index, weight in neighbours:
+        values += weight.reshape((-1,) + (1,) * (data.ndim - 3)) * data[index]
+    output = np.full((len(inside),) + data.shape[3:], default, dtype=np.float32)
+    output[inside] = values
+    return output
+
+
+# function to interpolate with the nearest neighbour
+def interpolate_nearest(data, cindex, default=0):
+    """
+    Return the value of the nearest voxel of data at continuous indices (N x 3 or SampleCoordinates).
+    """
+    inside, index = get_coordinates(data, cindex).get_nearest()
+    output = np.full((len(inside),) + data.shape[3:], default, dtype=data.dtype)
+    output[inside] = data[index]
+    return output
+
+
+# function to interpolate labels
+def interpolate_label(data, cindex, default=0):
+    """
+    Return the label with the largest total linear weight among the 8 neighbours at continuous
+    indices (N x 3 or SampleCoordinates).
+    """
+    inside, neighbours = get_coordinates(data, cindex).get_linear()
+    labels = np.stack([data[index] for index, _ in neighbours])
+    weights = np.stack([weight for _, weight in neighbours])
+    scores = np.zeros(weights.shape)
+    for corner in range(8):
+        scores += weights[corner] * (labels == labels[corner])
+    best = np.argmax(scores, axis=0)
+    output = np.full(len(inside), default, dtype=data.dtype)
+    output[inside] = labels[best, np.arange(labels.shape[1])]
+    return output
+
+
+# interpolation functions by name
+INTERPOLATORS = {'Linear': interpolate_linear, 'NearestNeighbor': interpolate_nearest, 'GenericLabel': interpolate_label}
+
+
+# function to get the number of threads
+def get_num_threads(num_threads=0):
+    """
+    Return the number of threads to use (0: the ITK thread count set by the scheduler, or one per CPU).
+    """
+    if num_threads > 0:
+        return num_threads
+    if os.environ.get(ITK_THREADS_VARIABLE, '').isdigit() and int(os.environ[ITK_THREADS_VARIABLE]) > 0:
+        return int(os.environ[ITK_THREADS_VARIABLE])
+    return os.cpu_count() or 1
+
+
+# function to run a function on blocks of a grid
+def run_blocks(function, shape, num_threads=0, cancel=None):
+    """
+    Call function(start, stop) for blocks of slices along the first axis of a grid of the given
+    shape, on a thread pool. If cancel (a function) returns True the remaining blocks are skipped
+    and CommandStopped is raised.
+    """
+    step = max(1, BLOCK_VOXELS // max(1, shape[1] * shape[2]))
+
+    # function to run a block unless cancelled
+    def run_block(start):
+        if cancel is not None and cancel():
+            return
+        function(start, min(start + step, shape[0]))
+
+    with ThreadPoolExecutor(get_num_threads(num_threads)) as executor:
+        list(executor.map(run_block, range(0, shape[0], step)))
+    if cancel is not None and cancel():
+        raise CommandStopped("cancelled")
+
+
+# function to get the indices of a block of a grid
+def get_block_indices(shape, start, stop):
+    """
+    Return the indices (N x 3, float) of the grid slices start to stop along the first axis.
+    """
+    i, j, k = np.meshgrid(np.arange(start, stop), np.arange(shape[1]), np.arange(shape[2]), indexing='ij')
+    return np.column_stack([i.ravel(), j.ravel(), k.ravel()]).astype(np.float64)
+
+
+# function to map a block of a grid through transform steps
+def transform_block(steps, shape, start, stop):
+    """
+    Return the points of the grid slices start to stop mapped through the steps, the first of
+    which maps grid indices to points. A displacement field defined on the grid itself is
+    looked up without interpolation.
+    """
+    points = get_block_indices(shape, start, stop)
+    for position, transform in enumerate(steps):
+        if isinstance(transform, np.ndarray):
+            points = points @ transform[:3, :3].T + transform[:3, 3]
+        elif position == 1 and transform.matches(shape, steps[0]):
+            points = transform.transform_grid(points, start, stop)
+        else:
+            points = transform.transform(points)
+    return points
+
+
+# function to warp the channels of an image
+def warp_channels(channels, affine, reference_shape, reference_affine, steps, interpolations='Linear', num_threads=0, cancel=None):
+    """
+    Sample a list of channels (arrays on the same grid, given by its 4x4 index to LPS matrix) on
+    the reference grid through the transform steps (see load_transforms). The sample points are
+    computed once per block and shared by all channels. interpolations is one name for all
+    channels or one per channel. Returns float32 arrays for linear interpolation and the input
+    data type otherwise. Raises CommandStopped if cancel (a function) returns True (see run_blocks).
+    """
+    if isinstance(interpolations, str):
+        interpolations = [interpolations] * len(channels)
+    assert len(interpolations) == len(channels), "There must be one interpolation per channel."
+    assert all(interpolation in INTERPOLATORS for interpolation in interpolations), "Interpolation must be one of {}.".format(', '.join(INTERPOLATORS))
+    assert all(data.shape[:3] == channels[0].shape[:3] for data in channels), "All channels must have the same size."
+    reference_shape = tuple(reference_shape[:3])
+    # reference indices -> points -> transforms -> moving indices, with affine steps merged
+    steps = merge_steps([reference_affine] + list(steps) + [np.linalg.inv(affine)])
+    outputs = [np.zeros(reference_shape + data.shape[3:], dtype=np.float32 if interpolation == 'Linear' else data.dtype) for data, interpolation in zip(channels, interpolations)]
+
+    # function to warp a block of the reference grid
+    def warp_block(start, stop):
+        coordinates = SampleCoordinates(channels[0].shape, transform_block(steps, reference_shape, start, stop))
+        for data, interpolation, output in zip(channels, interpolations, outputs):
+            output[start:stop] = INTERPOLATORS[interpolation](data, coordinates).reshape((stop - start,) + reference_shape[1:] + data.shape[3:])
+
+    run_blocks(warp_block, reference_shape, num_threads, cancel)
+    return outputs
+
+
+# function to warp an array
+def warp_array(data, affine, reference_shape, reference_affine, steps, interpolation='Linear', num_threads=0):
+    """
+    Sample data (on the grid given by its 4x4 index to LPS matrix) on the reference grid through
+    the transform steps (see load_transforms). Returns float32 for linear interpolation and the
+    input data type otherwise.
+    """
+    return warp_channels([data], affine, reference_shape, reference_affine, steps, interpolation, num_threads)[0]
+
+
+# function to compose transforms into a single displacement field
+def compose_field(steps, reference_shape, reference_affine, output=None, num_threads=0):
+    """
+    Return the displacement field on the reference grid that moves every grid point the same way
+    as the transform steps together (float32, written into output if given, e.g. a memmap).
+    """
+    reference_shape = tuple(reference_shape[:3])
+    steps = merge_steps([reference_affine] + list(steps))
+    if output is None:
+        output = np.zeros(reference_shape + (3,), dtype=np.float32)
+
+    # function to compose a block of the reference grid
+    def compose_block(start, stop):
+        points = get_block_indices(reference_shape, start, stop) @ reference_affine[:3, :3].T + reference_affine[:3, 3]
+        output[start:stop] = (transform_block(steps, reference_shape, start, stop) - points).reshape((stop - start,) + reference_shape[1:] + (3,))
+
+    run_blocks(compose_block, reference_shape, num_threads)
+    return DisplacementField(output, reference_affine)
+
+
+# function to warp the channels of an image onto several grids
+def warp_images_to_grids(moving_files, reference_files, output_files, transforms, interpolations='Linear', num_threads=0, cancel=None):
+    """
+    Warp several channels of the same image (files on the same grid) onto the grid of every file
+    in reference_files, reading the channels only once. transforms holds one list of (path, invert)
+    transforms per reference (in antsApplyTransforms order; steps loaded once with load_transforms
+    can be shared by all grids) and output_files one list of output files per reference (or None);
+    every output is written to its entry unless it is None. The sample points are computed once per
+    grid for all channels. A reference can also be given as its (shape, 4x4 index to LPS matrix)
+    geometry (see read_geometry). Returns (warped channels, 4x4 index to LPS matrix) for every reference.
+    Raises CommandStopped if cancel (a function) returns True, before any output of its grid is written.
+    """
+    assert len(transforms) == len(reference_files), "There must be one list of transforms per reference."
+    output_files = output_files or [None] * len(reference_files)
+    assert len(output_files) == len(reference_files), "There must be one list of output files per reference."
+    assert all(files is None or len(files) == len(moving_files) for files in output_files), "There must be one output file per channel."
+    channels = []
+    for moving_file in moving_files:
+        data, affine = read_image(moving_file)
+        assert data.ndim == 3, "Only 3D images are supported by the native warp."
+        if len(channels) > 0:
+            assert data.shape == channels[0].shape and np.allclose(affine, first_affine, atol=1e-6), "{} is not on the same grid as {}.".format(moving_file, moving_files[0])
+        else:
+            first_affine = affine
+        channels.append(data)
+    results = []
+    for reference_file, files, grid_transforms in zip(reference_files, output_files, transforms):
+        reference_shape, reference_affine = read_geometry(reference_file) if isinstance(reference_file, str) else reference_file
+        outputs = warp_channels(channels, first_affine, reference_shape, reference_affine, load_transforms(grid_transforms), interpolations, num_threads, cancel)
+        for output, output_file in zip(outputs, files or [None] * len(outputs)):
+            if output_file is not None:
+                write_image(output_file, output, reference_affine)
+        results.append((outputs, reference_affine))
+    return results
+
+
+# function to warp the channels of an image
+def warp_images(moving_files, reference_file, output_files, transforms, interpolations='Linear', num_threads=0, cancel=None):
+    """
+    Warp several channels of the same image (files on the same grid) onto the grid of reference_file
+    (or a geometry from read_geometry) through a list of (path, invert) transforms (in antsApplyTransforms
+    order, loaded steps are also accepted), computing the sample points once for all channels. Every output is written to its
+    entry of output_files unless it is None. Returns the warped channels and their 4x4 index to LPS matrix.
+    Raises CommandStopped if cancel (a function) returns True (see run_blocks).
+    """
+    return warp_images_to_grids(moving_files, [reference_file], [output_files], [transforms], interpolations, num_threads, cancel)[0]
+
+
+# function to warp an image file
+def warp_image(moving_file, reference_file, output_file, transforms, interpolation='Linear', num_threads=0):
+    """
+    Warp moving_file onto the grid of reference_file through a list of (path, invert) transforms
+    (in antsApplyTransforms order, loaded steps are also accepted) and write it to output_file if
+    given. Returns the warped data and its 4x4 index to LPS matrix.
+    """
+    outputs, reference_affine = warp_images([moving_file], reference_file, [output_file], transforms, interpolation, num_threads)
+    return outputs[0], reference_affine
@@ -0,0 +1,162 @@
+# a script to mirror, resample and asymmetrize confocal stacks in a single pass
+
+import os # file handling
+import numpy as np # linear algebra
+import pandas as pd # data processing, CSV file I/O (e.g. pd.read_csv)
+import glob # file handling
+import argparse # command line arguments
+import time # timing
+import nrrd # NRRD file handling
+from native_resample import get_spacing, get_output_size, get_background_value, resample_array, make_output_header # in-process resampling
+from native_mirror import get_center_of_gravity, make_mirror_header # in-process mirroring
+from job_scheduler import run_jobs, estimate_memory, get_resampled_voxels, parse_memory # memory-aware job scheduling
+
+# clear output
+os.system('cls' if os.name == 'nt' else 'clear')
+
+# print start string
+start_string = 'Kronauer Lab - Microscopy Image Processing Pipeline\n'
+start_string += "="*(len(start_string)-1) + '\n'
+start_string += 'Confocal Preprocessing Pipeline (Mirror + Resample + Asymmetrize) by Rishika Mohanta\n'
+start_string += 'Version 1.0.0\n'
+
+print(start_string)
+
+# parse command line arguments
+parser = argparse.ArgumentParser(description='Resample confocal stacks and keep only the orientation needed for the template (mirroring the others) in a single pass.')
+parser.add_argument('-i','--input_dir', type=str, help='path to input directory (must contain .nrrd files; default: ./cleaned_data/whole_brain/)', default="./cleaned_data/whole_brain/", nargs='?')
+parser.add_argument('-o','--output_dir', type=str, help='path to output directory (default: ./resampled_data/whole_brain/)', default="./resampled_data/whole_brain/", nargs='?')
+parser.add_argument('-v','--target_voxel_size', type=str, help='target voxel size in microns (e.g. 0.8x0.8x0.8)', default="0.8x0.8x0.8", nargs='?')
+parser.add_argument('-t','--type', type=str, help='type of resampling (spacing or size; default: spacing)', default="spacing", nargs='?')
+parser.add_argument('-meta','--metadata', type=str, help='path to metadata file (default: ./whole_brain_metadata.csv)', default="./whole_brain_metadata.csv", nargs='?')
+parser.add_argument('-lr','--left_or_right', type=str, help='orientation of the template (left or right; default: left)', default="left", nargs='?')
+parser.add_argument('-a', '--axis', type=str, help='axis to mirror (vertical/horizontal; default: horizontal)', default="horizontal", nargs='?')
+parser.add_argument('-n','--num_workers', type=int, help='maximum number of workers to use (0: one per CPU; default: 1)', default=1, nargs='?')
+parser.add_argument('-mb','--mem_budget', type=str, help='memory budget shared by all workers (e.g. 64G; 0: no limit; default: auto, the memory currently available)', default="auto", nargs='?')
+args = parser.parse_args()
+
+# check if target voxel size is valid
+target_voxel_size = args.target_voxel_size
+original_target_voxel_size = target_voxel_size
+target_voxel_size = target_voxel_size.split('x')
+assert len(target_voxel_size) == 3, "Target voxel size must be in the format '0.8x0.8x0.8'."
+
+try:
+    target_voxel_size = [float(i) for i in target_voxel_size]
+except:
+    raise ValueError("Target voxel size must be in the format '0.8x0.8x0.8'.")
+
+# check if target voxel size is positive
+assert all(i > 0 for i in target_voxel_size), "Target voxel size must be positive."
+
+# check type of resampling
+resampling_type = args.type
+assert resampling_type in ['spacing', 'size'], "Type of resampling must be either 'spacing' or 'size'."
+
+# check if input directory is valid
+input_dir = args.input_dir
+assert os.path.isdir(input_dir), "Input directory does not exist."
+
+print("Input directory: {}".format(input_dir))
+
+# check if input directory has required files (mirrors are generated on the fly)
+data_files = list(glob.glob(os.path.join(input_dir, "*.nrrd")))
+data_files = [i for i in data_files if '_mirror' not in i]
+
+assert len(data_files) > 0, "Input directory does not contain any files."
+
+# create output directory if it does not exist
+output_dir = args.output_dir
+if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+
+print("Output directory: {}".format(output_dir))
+
+# check if axis is valid
+axis = args.axis
+assert axis in ['vertical', 'horizontal'], "Axis must be either 'vertical' or 'horizontal'."
+axis = 1 if axis == 'vertical' else 0
+
+# get left or right
+left_or_right = args.left_or_right
+assert left_or_right in ['left', 'right'], "Left or right must be either 'left' or 'right'."
+
+# check if metadata file exists
+metadata_file = args.metadata
+assert os.path.isfile(metadata_file), "Metadata file does not exist."
+
+# check metadata to be either whole_brain_metadata.csv or antennal_lobe_metadata.csv
+assert os.path.basename(metadata_file) in ['whole_brain_metadata.csv', 'antennal_lobe_metadata.csv'], "Metadata file must be either whole_brain_metadata.csv or antennal_lobe_metadata.csv."
+
+# read metadata file and keep only the asymmetry of every brain
+metadata = pd.read_csv(metadata_file)
+if os.path.basename(metadata_file) == 'whole_brain_metadata.csv':
+    metadata = metadata.set_index('Clean Name').to_dict()['Egocentric Leaning']
+else:
+    metadata = metadata.set_index('Clean Name').to_dict()['Lateralization']
+print("Metadata file: {}".format(metadata_file))
+
+# decide for every file whether the original or the mirror is needed
+# (same rule as asymmetrize.py: brains leaning the other way are replaced by their mirror)
+needs_mirror = []
+output_files = []
+for data_file in data_files:
+    clean_name = os.path.basename(data_file)
+    assert clean_name in metadata.keys(), "Clean name {} not found in metadata.".format(clean_name)
+    egocentric_leaning = metadata[clean_name]
+    assert egocentric_leaning in ['left', 'right', 'sym'], "Egocentric leaning must be either 'left', 'right', or 'sym'."
+    mirror = egocentric_leaning not in [left_or_right, 'sym']
+    needs_mirror.append(mirror)
+    # same names as mirror.py followed by resample.py
+    output_name = clean_name[:-5] + ('_mirror' if mirror else '') + f'_resampled_{original_target_voxel_size}.nrrd'
+    output_files.append(os.path.join(output_dir, output_name))
+
+# Print number of files to process and their names
+print("Keeping only {} or symmetric brains (mirroring the others).".format(left_or_right))
+print("Number of files to process: {} ({} mirrored)".format(len(data_files), sum(needs_mirror)))
+for index, file in enumerate(data_files):
+    print("File {}: {} -> {}".format(index, file, output_files[index]))
+
+# define a function to preprocess a file
+def preprocess_file(index):
+    # print progress
+    print(f"Preprocessing file {index+1} of {len(data_files)}")
+    start_time = time.time()
+
+    # read the data once
+    data, header = nrrd.read(data_files[index])
+    assert data.ndim == 3, "Only 3D images are supported."
+    spacing = get_spacing(header)
+
+    # resample
+    output_size = get_output_size(data.shape, spacing, target_voxel_size, resampling_type)
+    output = resample_array(data, spacing, target_voxel_size, output_size, get_background_value(data, resampling_type))
+    out_header = make_output_header(header, target_voxel_size)
+
+    # mirror the resampled stack about the center of gravity of the full resolution stack
+    if needs_mirror[index]:
+        center = get_center_of_gravity(data, header)
+        out_header, flip_axis = make_mirror_header(dict(out_header, sizes=np.array(output.shape)), output.shape, axis, center)
+        output = np.flip(output, axis=flip_axis)
+
+    # write only the variant that is needed
+    nrrd.write(output_files[index], output, out_header)
+
+    elapsed = time.time() - start_time
+    print(f"Preprocessed {os.path.basename(data_files[index])} in {elapsed:.1f} s ({data.size / max(elapsed, 1e-9) / 1e6:.2f} Mvoxels/s)")
+    return data.size, elapsed
+
+# preprocess the largest files first, running as many files in parallel as the memory budget allows
+estimates = [estimate_memory([data_file], get_resampled_voxels(data_file, target_voxel_size), 'linear') for data_file in data_files]
+stats = run_jobs(preprocess_file, range(len(data_files)), estimates, args.num_workers, parse_memory(args.mem_budget))
+
+# clear output
+os.system('cls' if os.name == 'nt' else 'clear')
+
+# report throughput
+total_voxels = sum(s[0] for s in stats)
+total_time = sum(s[1] for s in stats)
+print(f"Total: {total_voxels} voxels in {total_time:.1f} s ({total_voxels / max(total_time, 1e-9) / 1e6:.2f} Mvoxels/s)")
+print(f"{len(data_files) - sum(needs_mirror)} files kept as is, {sum(needs_mirror)} files mirrored.")
+
+print("All files preprocessed. Exiting...")
@@ -4,7 +4,12 @@ import os # file handling
 import numpy as np # linear algebra
 import glob # file handling
 import argparse # command line arguments
+import time # timing
+import nrrd # NRRD file handling
 from joblib import Parallel, delayed # parallel processing
+from native_resample import resample_nrrd, resample_nrrd_streaming, resample_pyramid, write_pyramid_manifest # in-process resampling engines
+import resample_cache # content-addressed cache of resampled files
+from job_scheduler import run_jobs, estimate_memory, get_resampled_voxels, get_num_workers, parse_memory # memory-aware job scheduling
 
 # clear output
 os.system('cls' if os.name == 'nt' else 'clear')
@@ -13,7 +18,7 @@ os.system('cls' if os.name == 'nt' else 'clear')
 start_string = 'Kronauer Lab - Microscopy Image Processing Pipeline\n'
 start_string += "="*(len(start_string)-1) + '\n'
 start_string += 'Confocal Resampler by Rishika Mohanta\n'
-start_string += 'Version 1.1.0\n'
+start_string += 'Version 1.7.0\n'
 
 print(start_string)
 
@@ -22,8 +27,17 @@ parser = argparse.ArgumentParser(description='Resample confocal stacks to a targ
 parser.add_argument('-i','--input_dir', type=str, help='path to input directory (must contain .nrrd files; default: ./cleaned_data/whole_brain/)', default="./cleaned_data/whole_brain/", nargs='?')
 parser.add_argument('-o','--output_dir', type=str, help='path to output directory (default: ./resampled_data/whole_brain/)', default="./resampled_data/whole_brain/", nargs='?')
 parser.add_argument('-v','--target_voxel_size', type=str, help='target voxel size in microns (e.g. 0.8x0.8x0.8)', default="0.8x0.8x0.8", nargs='?')
-parser.add_argument('-n','--num_workers', type=int, help='number of workers to use (default: 1)', default=1, nargs='?')
+parser.add_argument('-p','--pyramid', type=str, help='comma separated list of voxel sizes to generate in a single pass (e.g. 0.8,1.6,3.2; overrides -v; default: none)', default="", nargs='?')
+parser.add_argument('-n','--num_workers', type=int, help='maximum number of workers to use (0: one per CPU; default: 1)', default=1, nargs='?')
+parser.add_argument('-mb','--mem_budget', type=str, help='memory budget shared by all workers (e.g. 64G; 0: no limit; default: auto, the memory currently available)', default="auto", nargs='?')
+parser.add_argument('-th','--threads', type=int, help='number of ITK threads per worker (0: split the CPUs between the workers; default: 0)', default=0, nargs='?')
+parser.add_argument('-pin','--pin_threads', action='store_true', help='pin each worker and the ANTs processes it starts to its own CPUs')
+parser.add_argument('-at','--auto_tune', action='store_true', help='choose the number of workers and threads by timing the first (smallest) files with different thread counts (overrides -n and -th)')
 parser.add_argument('-t','--type', type=str, help='type of resampling (spacing or size; default: spacing)', default="spacing", nargs='?')
+parser.add_argument('-e','--engine', type=str, help='resampling engine (ants, native or stream; default: ants)', default="ants", nargs='?')
+parser.add_argument('-sm','--stream_memory', type=float, help='memory budget per file in GB for the stream engine (default: 2.0)', default=2.0, nargs='?')
+parser.add_argument('-cache','--cache_dir', type=str, help='path to resample cache directory (default: <output_dir>/.resample_cache/)', default="", nargs='?')
+parser.add_argument('-nc','--no_cache', action='store_true', help='do not use the resample cache and recompute every file')
 parser.add_argument('-c','--clean_up', type=bool, help='remove non-error log files (default: True)', default=True, nargs='?')
 args = parser.parse_args()
 
@@ -46,8 +60,8 @@ input_dir = args.input_dir
 # check if input directory exists
 assert os.path.isdir(input_dir), "Input directory does not exist."
 
-# check if input directory has required files
-data_files = list(glob.glob(os.path.join(input_dir, "*.nrrd")))
+# check if input directory has required files (detached .nhdr headers, e.g. mirrors, are resampled too)
+data_files = list(glob.glob(os.path.join(input_dir, "*.nrrd"))) + list(glob.glob(os.path.join(input_dir, "*.nhdr")))
 
 assert len(data_files) > 0, "Input directory does not contain any files."
 
@@ -56,24 +70,105 @@ output_dir = args.output_dir
 if not os.path.isdir(output_dir):
     os.makedirs(output_dir)
 
-output_files = list(glob.glob(os.path.join(input_dir, "*.nrrd")))
-
 # append '_resampled' to output files
-output_files = [os.path.join(output_dir, os.path.basename(f).replace('.nrrd', f'_resampled_{original_target_voxel_size}.nrrd')) for f in output_files]
+output_files = [os.path.join(output_dir, os.path.splitext(os.path.basename(f))[0] + f'_resampled_{original_target_voxel_size}.nrrd') for f in data_files]
 
-# check if output files already exist
-for f in output_files:
-    if os.path.isfile(f):
-        print(f"Output file {f} already exists. Will be overwritten.")
-        os.remove(f)
+# check pyramid levels
+pyramid = args.pyramid != ""
+if pyramid:
+    levels = []
+    for level in args.pyramid.split(','):
+        level = level.strip().split('x')
+        # a single number is an isotropic voxel size
+        if len(level) == 1:
+            level = level * 3
+        assert len(level) == 3, "Pyramid levels must be in the format '0.8,1.6,3.2' or '0.8x0.8x0.8,1.6x1.6x1.6'."
+        try:
+            level = [float(i) for i in level]
+        except:
+            raise ValueError("Pyramid levels must be in the format '0.8,1.6,3.2' or '0.8x0.8x0.8,1.6x1.6x1.6'.")
+        assert all(i > 0 for i in level), "Pyramid voxel sizes must be positive."
+        levels.append(level)
+    # sort levels from fine to coarse
+    levels = sorted(levels, key=np.prod)
+    level_labels = ['x'.join(f'{i:g}' for i in level) for level in levels]
+    print(f"Pyramid levels: {', '.join(level_labels)}")
+    # every level goes into its own subdirectory of the output directory
+    level_output_files = []
+    for label in level_labels:
+        level_dir = os.path.join(output_dir, label)
+        if not os.path.isdir(level_dir):
+            os.makedirs(level_dir)
+        level_output_files.append([os.path.join(level_dir, os.path.splitext(os.path.basename(f))[0] + f'_resampled_{label}.nrrd') for f in data_files])
+else:
+    levels = [target_voxel_size]
+    level_labels = [original_target_voxel_size]
+    level_output_files = [output_files]
 
 # check type of resampling
 resampling_type = args.type
 assert resampling_type in ['spacing', 'size'], "Resampling type must be 'spacing' or 'size'."
 
+# check resampling engine
+engine = args.engine
+assert engine in ['ants', 'native', 'stream'], "Resampling engine must be 'ants', 'native' or 'stream'."
+
+# pyramids are built in-process so that every input is read only once
+if pyramid:
+    assert engine != 'stream', "Pyramid mode is not supported by the stream engine."
+    if engine == 'ants':
+        print("Pyramid mode uses the native engine.")
+        engine = 'native'
+
+# check streaming memory budget
+stream_memory = args.stream_memory
+assert stream_memory > 0, "Streaming memory budget must be positive."
+
 # get clean up flag
 clean_up = args.clean_up
 
+# look up every input file in the resample cache
+use_cache = not args.no_cache
+cached_indices = []
+if use_cache:
+    cache_dir = args.cache_dir if args.cache_dir != "" else os.path.join(output_dir, ".resample_cache")
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    print(f"Cache directory: {cache_dir}")
+    # hash the input files that are new or changed since the last run
+    hash_index = resample_cache.load_index(cache_dir)
+    to_hash = [f for f in data_files if resample_cache.get_indexed_hash(f, hash_index) is None]
+    if len(to_hash) > 0:
+        print(f"Hashing {len(to_hash)} new or changed input files...")
+        hashes = Parallel(n_jobs=get_num_workers(args.num_workers, len(to_hash)))(delayed(resample_cache.hash_file)(f) for f in to_hash)
+        for f, content_hash in zip(to_hash, hashes):
+            resample_cache.set_indexed_hash(f, hash_index, content_hash)
+        resample_cache.save_index(cache_dir, hash_index)
+    # serve unchanged files from the cache
+    engine_version = resample_cache.get_engine_version(engine)
+    content_hashes = [resample_cache.get_indexed_hash(f, hash_index) for f in data_files]
+    cache_keys = []
+    for level_index, level in enumerate(levels):
+        # coarse pyramid levels also depend on the levels they were built from
+        level_engine_version = engine_version if level_index == 0 else engine_version + '-pyramid-' + '-'.join(level_labels[:level_index])
+        cache_keys.append([resample_cache.get_cache_key(content_hash, level, resampling_type, level_engine_version) for content_hash in content_hashes])
+    for index in range(len(data_files)):
+        # a file is up to date only if every level is in the cache
+        if all(resample_cache.fetch(cache_dir, cache_keys[level_index][index], level_output_files[level_index][index]) for level_index in range(len(levels))):
+            print(f"Output file(s) for {os.path.basename(data_files[index])} are up to date (served from cache).")
+            cached_indices.append(index)
+
+# check if output files already exist
+for output_files_of_level in level_output_files:
+    for index, f in enumerate(output_files_of_level):
+        if index not in cached_indices and os.path.isfile(f):
+            print(f"Output file {f} already exists. Will be overwritten.")
+            os.remove(f)
+
+# files that need to be resampled
+todo_indices = [index for index in range(len(data_files)) if index not in cached_indices]
+print(f"{len(todo_indices)} of {len(data_files)} files need to be resampled.")
+
 # define a function to resample a file
 def resample_file(index):
     # print progress
@@ -81,28 +176,63 @@ def resample_file(index):
 
     # target resolution in microns (x, y, z)
     target_resolution = np.array(target_voxel_size)
-    print(f"Target resolution: {target_resolution[0]} μm x {target_resolution[1]} μm x {target_resolution[2]} μm")
+    if pyramid:
+        print(f"Target resolutions: {', '.join(level_labels)} μm")
+    else:
+        print(f"Target resolution: {target_resolution[0]} μm x {target_resolution[1]} μm x {target_resolution[2]} μm")
 
-    # print log file location
-    print("Log file: {}".format(output_files[index][:-5] + '_out.log'))
-    print("Error file: {}".format(output_files[index][:-5] + '_err.log'))
+    # get number of input voxels from the header
+    num_voxels = int(np.prod(nrrd.read_header(data_files[index])['sizes']))
+    start_time = time.time()
 
-    # resample data using ANTs
-    if resampling_type == 'size':
-        os.system('ResampleImage 3 {} {} {}x{}x{} 0 0 6 >{}_out.log 2>{}_err.log'.format(data_files[index], output_files[index], target_resolution[0], target_resolution[1], target_resolution[2], output_files[index][:-5], output_files[index][:-5]))
-    if resampling_type == 'spacing':
-        os.system('ResampleImageBySpacing 3 {} {} {} {} {} 0 0 0 >{}_out.log 2>{}_err.log'.format(data_files[index], output_files[index], target_resolution[0], target_resolution[1], target_resolution[2], output_files[index][:-5], output_files[index][:-5]))   
+    if pyramid:
+        # read the file once and build every level from the previous one
+        resample_pyramid(data_files[index], [i[index] for i in level_output_files], levels, resampling_type)
+    elif engine == 'native':
+        # resample data in-process
+        resample_nrrd(data_files[index], output_files[index], target_resolution, resampling_type)
+    elif engine == 'stream':
+        # resample data slab by slab without loading the full stack
+        resample_nrrd_streaming(data_files[index], output_files[index], target_resolution, resampling_type, stream_memory)
+    else:
+        # print log file location
+        print("Log file: {}".format(output_files[index][:-5] + '_out.log'))
+        print("Error file: {}".format(output_files[index][:-5] + '_err.log'))
 
-if args.num_workers == 1:
-    # resample each file sequentially
-    for index in range(len(data_files)):
-        resample_file(index)
-else:
-    assert args.num_workers > 1, "Number of workers must be greater than 1."
-    assert args.num_workers <= len(data_files), "Number of workers must be less than or equal to number of files."
-    assert args.num_workers <= os.cpu_count(), "Number of workers must be less than or equal to number of CPUs."
-    # resample each file in parallel using joblib
-    Parallel(n_jobs=args.num_workers)(delayed(resample_file)(index) for index in range(len(data_files)))
+        # resample data using ANTs
+        if resampling_type == 'size':
+            os.system('ResampleImage 3 {} {} {}x{}x{} 0 0 6 >{}_out.log 2>{}_err.log'.format(data_files[index], output_files[index], target_resolution[0], target_resolution[1], target_resolution[2], output_files[index][:-5], output_files[index][:-5]))
+        if resampling_type == 'spacing':
+            os.system('ResampleImageBySpacing 3 {} {} {} {} {} 0 0 0 >{}_out.log 2>{}_err.log'.format(data_files[index], output_files[index], target_resolution[0], target_resolution[1], target_resolution[2], output_files[index][:-5], output_files[index][:-5]))   
+
+    # report throughput
+    elapsed = time.time() - start_time
+    print(f"Resampled {os.path.basename(data_files[index])} in {elapsed:.1f} s ({num_voxels / max(elapsed, 1e-9) / 1e6:.2f} Mvoxels/s)")
+    return os.path.basename(data_files[index]), num_voxels, elapsed
+
+# define a function to estimate the memory needed to resample a file
+def estimate_file_memory(index):
+    if engine == 'stream':
+        # the stream engine keeps its slabs under the stream memory budget
+        return int(stream_memory * (1 << 30))
+    output_voxels = sum(get_resampled_voxels(data_files[index], level) for level in levels)
+    return estimate_memory([data_files[index]], output_voxels, 'linear')
+
+# resample the largest files first, running as many files in parallel as the memory budget allows
+estimates = [estimate_file_memory(index) for index in todo_indices]
+stats = run_jobs(resample_file, todo_indices, estimates, args.num_workers, parse_memory(args.mem_budget), args.threads, args.pin_threads, tune=args.auto_tune)
+
+# add the new results to the cache
+if use_cache:
+    for level_index, output_files_of_level in enumerate(level_output_files):
+        for index in todo_indices:
+            if os.path.isfile(output_files_of_level[index]):
+                resample_cache.store(cache_dir, cache_keys[level_index][index], output_files_of_level[index])
+
+# write a manifest listing the pyramid levels
+if pyramid:
+    manifest_file = os.path.join(output_dir, "pyramid_manifest.json")
+    write_pyramid_manifest(manifest_file, levels, level_labels, data_files, level_output_files, resampling_type)
     
 # clear output
 os.system('cls' if os.name == 'nt' else 'clear')
@@ -122,6 +252,18 @@ if clean_up:
                     print(f"Could not remove out file associated with {file}. Please check manually.")
                     
 
+# print throughput summary
+print(f"Throughput summary ({engine} engine):")
+for name, num_voxels, elapsed in stats:
+    print(f"{name}: {num_voxels} voxels in {elapsed:.1f} s ({num_voxels / max(elapsed, 1e-9) / 1e6:.2f} Mvoxels/s)")
+total_voxels = sum(i[1] for i in stats)
+total_time = sum(i[2] for i in stats)
+print(f"Total: {total_voxels} voxels in {total_time:.1f} s ({total_voxels / max(total_time, 1e-9) / 1e6:.2f} Mvoxels/s)")
+print(f"{len(cached_indices)} files served from cache, {len(stats)} files resampled.")
+
+if pyramid:
+    print(f"Pyramid manifest: {manifest_file}")
+
 print("All files resampled. Exiting...")
 
 
@@ -0,0 +1,173 @@
+# helper functions for a content-addressed cache of resampled files
+
+## IMPLEMENTATION DETAILS
+# Every resampled file is stored in the cache directory as <key>.nrrd where the key is
+# a hash of (input content hash, target voxel size, resampling type, engine version).
+# Outputs are hard-linked into the cache (copied if the cache is on another disk), so
+# cached results cost no extra space. Content hashes are remembered in index.json
+# together with the size and modification time of the input, so unchanged inputs are
+# only hashed once. For detached headers (.nhdr, e.g. mirrors) the data file the header
+# points at is part of the content.
+
+import os # file handling
+import json # index file
+import shutil # file copies
+import hashlib # content hashes
+import subprocess # ANTs version lookup
+import nrrd # detached NRRD headers
+from native_resample import ENGINE_VERSION # version of the native engines
+
+# version of the cache layout (bump to invalidate all entries)
+CACHE_VERSION = 2
+
+
+# function to get the files that hold the content of an image
+def get_content_files(path):
+    """
+    Return the file itself and, for a detached NRRD header, the data file it points at.
+    """
+    if not path.endswith('.nhdr'):
+        return [path]
+    header = nrrd.read_header(path)
+    data_file = header.get('data file', header.get('datafile', None))
+    if data_file is None:
+        return [path]
+    if not os.path.isabs(data_file):
+        data_file = os.path.join(os.path.dirname(path), data_file)
+    return [path, data_file]
+
+
+# function to hash the content of a file
+def hash_file(path, chunk_size=16 << 20):
+    """
+    Return the BLAKE2b hash of the content of a file (including the data of a detached header).
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    for content_file in get_content_files(path):
+        with open(content_file, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(chunk_size), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+# function to get the size and modification time of the content of a file
+def get_content_stat(path):
+    """
+    Return the sizes and modification times of the files that hold the content of path.
+    """
+    stats = [os.stat(content_file) for content_file in get_content_files(path)]
+    return [stat.st_size for stat in stats], [stat.st_mtime_ns for stat in stats]
+
+
+# function to load the hash index of a cache directory
+def load_index(cache_dir):
+    """
+    Return the hash index stored in the cache directory (empty if missing or unreadable).
+    """
+    index_file = os.path.join(cache_dir, 'index.json')
+    if not os.path.isfile(index_file):
+        return {}
+    try:
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        print("WARNING: Could not read cache index {}. Hashes will be recomputed.".format(index_file))
+        return {}
+    if index.get('version') != CACHE_VERSION:
+        return {}
+    return index.get('files', {})
+
+
+# function to save the hash index of a cache directory
+def save_index(cache_dir, index):
+    """
+    Atomically write the hash index to the cache directory.
+    """
+    index_file = os.path.join(cache_dir, 'index.json')
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'files': index}, f, indent=1)
+    os.replace(index_file + '.tmp', index_file)
+
+
+# function to check if the hash stored for a file is still valid
+def get_indexed_hash(path, index):
+    """
+    Return the stored content hash of a file if its size and modification time did not change, else None.
+    """
+    entry = index.get(os.path.realpath(path))
+    size, mtime_ns = get_content_stat(path)
+    if entry is not None and entry['size'] == size and entry['mtime_ns'] == mtime_ns:
+        return entry['hash']
+    return None
+
+
+# function to store the hash of a file in the index
+def set_indexed_hash(path, index, content_hash):
+    """
+    Remember the content hash of a file together with its size and modification time.
+    """
+    size, mtime_ns = get_content_stat(path)
+    index[os.path.realpath(path)] = {'size': size, 'mtime_ns': mtime_ns, 'hash': content_hash}
+
+
+# function to get the version of an engine
+def get_engine_version(engine):
+    """
+    Return a string identifying the resampling engine and its version.
+    """
+    if engine in ['native', 'stream']:
+        return '{}-{}'.format(engine, ENGINE_VERSION)
+    # ask ANTs for its version
+    try:
+        result = subprocess.run(['antsRegistration', '--version'], capture_output=True, text=True)
+        version = result.stdout.strip().splitlines()[0]
+    except (OSError, IndexError):
+        version = 'unknown'
+    return '{}-{}'.format(engine, version)
+
+
+# function to build the cache key of a resampling job
+def get_cache_key(content_hash, target_voxel_size, resampling_type, engine_version):
+    """
+    Return the cache key of a resampled file.
+    """
+    description = json.dumps([CACHE_VERSION, content_hash, [float(i) for i in target_voxel_size], resampling_type, engine_version])
+    return hashlib.blake2b(description.encode('utf-8'), digest_size=20).hexdigest()
+
+
+# function to link a file (or copy it if linking is not possible)
+def link_or_copy(source, destination):
+    """
+    Hard-link source to destination, replacing destination atomically. Falls back to a copy.
+    """
+    temp = destination + '.tmp'
+    if os.path.lexists(temp):
+        os.remove(temp)
+    try:
+        os.link(source, temp)
+    except OSError:
+        shutil.copyfile(source, temp)
+    os.replace(temp, destination)
+
+
+# function to serve a file from the cache
+def fetch(cache_dir, key, output_file):
+    """
+    Place the cached result for key at output_file. Returns False if there is no cached result.
+    """
+    cached_file = os.path.join(cache_dir, key + '.nrrd')
+    if not os.path.isfile(cached_file):
+        return False
+    # nothing to do if the output already is the cached file
+    if os.path.isfile(output_file) and os.path.samefile(cached_file, output_file):
+        return True
+    link_or_copy(cached_file, output_file)
+    return True
+
+
+# function to store a file in the cache
+def store(cache_dir, key, output_file):
+    """
+    Add a freshly resampled output file to the cache.
+    """
+    link_or_copy(output_file, os.path.join(cache_dir, key + '.nrrd'))
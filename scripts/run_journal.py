@@ -0,0 +1,117 @@
+# helper functions to resume interrupted template generation runs
+
+## IMPLEMENTATION DETAILS
+# A resumable run keeps its temporary files in a job directory named after the results run
+# and the target voxel size, so that a rerun finds them again. job.json holds the settings
+# of the job (a rerun with other settings is refused) and the timestamp of its outputs.
+# journal.jsonl gets one line for every finished step (the upsampled template, then every
+# brain), appended and synced to disk as soon as the step is done: the content hashes of
+# its inputs and the checksums of the files it wrote. On a rerun a step is only skipped if
+# its inputs still have the same hashes and every output is still there with the same
+# checksum. Input hashes are remembered in index.json with the size and modification time
+# of every file (as in resample_cache.py), so unchanged inputs are only hashed once; outputs
+# are hashed again on every check. A line cut short by a crash is ignored, and a later line
+# for the same step replaces an earlier one.
+
+import os # file handling
+import json # job and journal files
+import resample_cache # content hashes and hash index
+
+# version of the journal layout (bump to invalidate all jobs)
+JOURNAL_VERSION = 2
+
+# name of the settings file in the job directory
+JOB_FILE = 'job.json'
+
+# name of the journal in the job directory
+JOURNAL_FILE = 'journal.jsonl'
+
+
+# function to open the job directory of a resumable run
+def open_job(job_dir, settings, timestamp):
+    """
+    Create the job directory (or reopen it if the settings match the ones it was started with)
+    and return the timestamp of the job.
+    """
+    os.makedirs(job_dir, exist_ok=True)
+    job_file = os.path.join(job_dir, JOB_FILE)
+    if os.path.isfile(job_file):
+        with open(job_file, 'r') as f:
+            job = json.load(f)
+        assert job.get('version') == JOURNAL_VERSION and job.get('settings') == settings, "Job directory {} was started with other settings. Remove it or run without --resume.".format(job_dir)
+        print("Resuming job started at {}.".format(job['timestamp']))
+        return job['timestamp']
+    with open(job_file + '.tmp', 'w') as f:
+        json.dump({'version': JOURNAL_VERSION, 'settings': settings, 'timestamp': timestamp}, f, indent=1)
+    os.replace(job_file + '.tmp', job_file)
+    return timestamp
+
+
+# function to get the content hashes of the inputs of a step
+def get_input_hashes(job_dir, files):
+    """
+    Return {absolute path: content hash} for files, hashing only the files that changed since
+    they were last hashed, and update the hash index of the job directory.
+    """
+    index = resample_cache.load_index(job_dir)
+    hashes = {}
+    changed = False
+    for path in files:
+        content_hash = resample_cache.get_indexed_hash(path, index)
+        if content_hash is None:
+            content_hash = resample_cache.hash_file(path)
+            resample_cache.set_indexed_hash(path, index, content_hash)
+            changed = True
+        hashes[os.path.abspath(path)] = content_hash
+    if changed:
+        resample_cache.save_index(job_dir, index)
+    return hashes
+
+
+# function to load the journal of a job
+def load_journal(job_dir):
+    """
+    Return the last journal entry of every step of the job: {name: entry}.
+    """
+    journal_file = os.path.join(job_dir, JOURNAL_FILE)
+    journal = {}
+    if not os.path.isfile(journal_file):
+        return journal
+    with open(journal_file, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a line cut short by a crash
+                continue
+            journal[entry['name']] = entry
+    return journal
+
+
+# function to record a finished step in the journal
+def record_step(job_dir, name, inputs, output_files, **info):
+    """
+    Append a journal entry for a finished step (its input hashes, the checksums of its output
+    files and any extra information) and make sure it is on disk.
+    """
+    outputs = {os.path.abspath(path): resample_cache.hash_file(path) for path in output_files}
+    entry = dict(info, name=name, inputs=inputs, outputs=outputs)
+    with open(os.path.join(job_dir, JOURNAL_FILE), 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    return entry
+
+
+# function to check if a step can be skipped
+def is_done(entry, inputs):
+    """
+    Return True if a journal entry exists for the same inputs and all its outputs still have their checksums.
+    """
+    if entry is None or entry['inputs'] != inputs:
+        return False
+    for path, checksum in entry['outputs'].items():
+        if not os.path.isfile(path) or resample_cache.hash_file(path) != checksum:
+            print("WARNING: {} is missing or changed since it was written.".format(path))
+            return False
+    return True
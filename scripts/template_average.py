@@ -0,0 +1,338 @@
+# helper functions to average warped brains into a template in-process
+
+## IMPLEMENTATION DETAILS
+# template_resample.py used to write every warped brain to disk and average them at the
+# end with 'AverageImages 3 <out> 1 <files>'. With the normalize flag set to 1, ANTs
+# divides every image by its mean intensity (1 if the mean is not positive), averages
+# them and applies a Laplacian sharpening to the average. Here every warped brain is
+# normalized the same way and added to a float64 accumulator as soon as it is ready, so
+# the warped files do not have to be kept. The sharpening is left to
+# 'ImageMath 3 <out> Sharpen <average>', the same ITK filter AverageImages uses.
+# The accumulator either keeps a running sum or a Welford running mean and variance.
+# Warping and averaging overlap: the workers load and normalize their warped brain and
+# hand it over as a raw float32 file in shared memory (/dev/shm, a memmap for the reducer),
+# and a reducer thread in the main process folds it into the accumulator while the
+# workers go on warping. The queue of the reducer is bounded, so a slow reducer holds
+# back new warps instead of piling up volumes in memory.
+# Robust averages (median, trimmed mean, similarity weighted mean) need all brains at every
+# voxel, so the normalized brains are kept as raw float32 files and reduced block by block
+# along the first axis: only one block of every brain is in memory at a time. The weighted
+# mean gives every brain a weight of its squared correlation with the median (brains that
+# do not correlate get no weight), so badly registered brains barely contribute.
+# A running average can be checkpointed (its arrays as .npy files, its count and the names of
+# the volumes in it in average.json), so an interrupted run can go on from the checkpoint.
+
+import os # file handling
+import json # checkpoints
+import time # checkpoint names
+import queue # reducer queue
+import threading # reducer thread
+import tempfile # shared memory directory
+import numpy as np # linear algebra
+import nibabel as nib # NIfTI file handling
+import nrrd # NRRD file handling
+
+# number of voxels added to the average at a time
+BLOCK_VOXELS = 1 << 22
+
+
+# class to accumulate the average of a sequence of volumes
+class RunningAverage:
+    """
+    Running average of volumes in float64. With welford=True the variance is tracked as well
+    (Welford's algorithm, numerically stable for any number of volumes).
+    """
+    def __init__(self, welford=False):
+        self.welford = welford
+        self.count = 0
+        self.total = None
+        self.mean = None
+        self.m2 = None
+
+    def add(self, volume):
+        """
+        Add a volume to the average (a float32 memmap is read once, block by block along the first axis).
+        """
+        volume = np.asarray(volume)
+        self.count += 1
+        if self.welford:
+            if self.mean is None:
+                self.mean = np.zeros(volume.shape, dtype=np.float64)
+                self.m2 = np.zeros(volume.shape, dtype=np.float64)
+            assert self.mean.shape == volume.shape, "All volumes must have the same shape."
+        else:
+            if self.total is None:
+                self.total = np.zeros(volume.shape, dtype=np.float64)
+            assert self.total.shape == volume.shape, "All volumes must have the same shape."
+        # work in blocks so that temporaries stay small
+        step = max(1, BLOCK_VOXELS // max(1, volume[0].size))
+        for start in range(0, volume.shape[0], step):
+            block = np.asarray(volume[start:start + step], dtype=np.float64)
+            if not self.welford:
+                self.total[start:start + step] += block
+                continue
+            mean = self.mean[start:start + step]
+            delta = block - mean
+            mean += delta / self.count
+            # delta * (volume - new mean), computed in place
+            delta *= block - mean
+            self.m2[start:start + step] += delta
+
+    def get_mean(self):
+        """
+        Return the mean of all volumes added so far.
+        """
+        assert self.count > 0, "No volumes were added."
+        if self.welford:
+            return self.mean
+        return self.total / self.count
+
+    def get_variance(self):
+        """
+        Return the (population) variance of all volumes added so far (needs welford=True).
+        """
+        assert self.welford, "The variance is only tracked with welford=True."
+        assert self.count > 0, "No volumes were added."
+        return self.m2 / self.count
+
+
+# function to load a NIfTI volume
+def load_volume(path):
+    """
+    Return the data (float32) and the affine of a NIfTI file.
+    """
+    image = nib.load(path)
+    return np.asarray(image.dataobj, dtype=np.float32), image.affine
+
+
+# function to normalize a volume like AverageImages
+def normalize_by_mean(volume):
+    """
+    Divide a volume by its mean intensity (by 1 if the mean is not positive), as 'AverageImages 3 <out> 1' does.
+    """
+    mean = float(np.mean(volume, dtype=np.float64))
+    if mean <= 0:
+        mean = 1.0
+    return volume / mean
+
+
+# function to save a NIfTI volume
+def save_volume(path, volume, affine):
+    """
+    Save a volume as float32 NIfTI with the given affine.
+    """
+    nib.save(nib.Nifti1Image(np.asarray(volume, dtype=np.float32), affine), path)
+
+
+# function to save a volume as NRRD
+def save_volume_nrrd(path, volume, affine):
+    """
+    Save a volume as float32 NRRD, converting the NIfTI (RAS) affine to the LPS geometry ITK writes.
+    """
+    lps = np.diag([-1.0, -1.0, 1.0]) @ np.asarray(affine, dtype=float)[:3]
+    header = {
+        'space': 'left-posterior-superior',
+        'space directions': lps[:, :3].T,
+        'space origin': lps[:, 3],
+    }
+    nrrd.write(path, np.asarray(volume, dtype=np.float32), header)
+
+
+# function to get a directory in shared memory
+def get_shared_dir(fallback_dir):
+    """
+    Return a new directory in shared memory (/dev/shm) for handing volumes to the reducer,
+    or a new directory in fallback_dir if there is no shared memory filesystem.
+    """
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return tempfile.mkdtemp(prefix='template_average_', dir='/dev/shm')
+    return tempfile.mkdtemp(prefix='template_average_', dir=fallback_dir)
+
+
+# function to hand a volume to the reducer
+def write_shared_volume(path, volume):
+    """
+    Write a volume as raw float32 to path and return its shape (read back with np.memmap).
+    """
+    np.asarray(volume, dtype=np.float32).tofile(path)
+    return volume.shape
+
+
+# class to fold volumes into a running average in the background
+class AverageReducer:
+    """
+    Thread that adds the raw float32 volumes handed to put() to a RunningAverage and deletes them.
+    put() blocks while max_pending volumes are waiting, which holds back new jobs.
+    """
+    def __init__(self, average, max_pending=2, on_add=None):
+        self.average = average
+        self.on_add = on_add
+        self.error = None
+        self.queue = queue.Queue(maxsize=max(1, max_pending))
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, path, shape, name=None):
+        """
+        Queue a raw float32 volume for the average (blocks while the queue is full).
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((path, tuple(shape), name))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            path, shape, name = item
+            try:
+                if self.error is None:
+                    self.average.add(np.memmap(path, dtype=np.float32, mode='r', shape=shape))
+                    if self.on_add is not None:
+                        self.on_add(name)
+            except Exception as error:
+                self.error = error
+            finally:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def close(self):
+        """
+        Wait until all queued volumes are added to the average.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+# function to save a checkpoint of a running average
+def save_checkpoint(directory, average, names, affine):
+    """
+    Save the state of a running average, the names of the volumes in it and their affine to
+    directory (average.json and its arrays), replacing the previous checkpoint atomically.
+    """
+    tag = str(time.time_ns())
+    arrays = {}
+    for key in ['total', 'mean', 'm2']:
+        array = getattr(average, key)
+        if array is None:
+            continue
+        arrays[key] = 'average_{}_{}.npy'.format(key, tag)
+        with open(os.path.join(directory, arrays[key] + '.tmp'), 'wb') as f:
+            np.save(f, array)
+        os.replace(os.path.join(directory, arrays[key] + '.tmp'), os.path.join(directory, arrays[key]))
+    checkpoint_file = os.path.join(directory, 'average.json')
+    with open(checkpoint_file + '.tmp', 'w') as f:
+        json.dump({'count': average.count, 'welford': average.welford, 'names': list(names), 'affine': None if affine is None else np.asarray(affine, dtype=float).tolist(), 'arrays': arrays}, f, indent=1)
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+    # remove the arrays of older checkpoints
+    for filename in os.listdir(directory):
+        if filename.startswith('average_') and filename.endswith('.npy') and filename not in arrays.values():
+            os.remove(os.path.join(directory, filename))
+    print("Saved a checkpoint of the average of {} volumes.".format(average.count))
+
+
+# function to restore a running average from a checkpoint
+def load_checkpoint(directory, average):
+    """
+    Restore a running average from the checkpoint in directory and return the names of the volumes
+    in it and their affine, or None if there is no usable checkpoint.
+    """
+    checkpoint_file = os.path.join(directory, 'average.json')
+    if not os.path.isfile(checkpoint_file):
+        return None
+    with open(checkpoint_file, 'r') as f:
+        checkpoint = json.load(f)
+    if checkpoint['welford'] != average.welford:
+        return None
+    for key, filename in checkpoint['arrays'].items():
+        setattr(average, key, np.load(os.path.join(directory, filename)))
+    average.count = checkpoint['count']
+    return checkpoint['names'], None if checkpoint['affine'] is None else np.array(checkpoint['affine'])
+
+
+# function to remove the checkpoint of a running average
+def remove_checkpoint(directory):
+    """
+    Remove the checkpoint in directory (if any).
+    """
+    for filename in os.listdir(directory):
+        if filename == 'average.json' or (filename.startswith('average_') and filename.endswith('.npy')):
+            os.remove(os.path.join(directory, filename))
+
+
+# robust averaging methods (computed out-of-core by robust_average)
+ROBUST_METHODS = ['median', 'trimmed', 'weighted']
+
+
+# function to choose the block size of a robust average
+def get_block_size(shape, num_volumes, max_memory=0):
+    """
+    Return the number of slices along the first axis per block, so that a block of every volume
+    (and its working copies) fits in max_memory bytes (0: no limit).
+    """
+    if max_memory <= 0:
+        return shape[0]
+    # float32 block of every volume, sorted float64 copy and the float64 output block
+    per_slice = int(np.prod(shape[1:])) * (num_volumes * 12 + 16)
+    return int(max(1, min(shape[0], max_memory // per_slice)))
+
+
+# function to get the similarity weights of volumes
+def get_similarity_weights(correlation_sums, count):
+    """
+    Return the weight of every volume from the sums (x, y, xx, yy, xy) of its voxels (x) and the
+    reference (y): its squared Pearson correlation with the reference (zero if negative).
+    """
+    sx, sy, sxx, syy, sxy = [np.asarray(i, dtype=np.float64) for i in correlation_sums]
+    covariance = sxy - sx * sy / count
+    variance = np.maximum(sxx - sx * sx / count, 0) * np.maximum(syy - sy * sy / count, 0)
+    correlation = np.where(variance > 0, covariance / np.sqrt(np.where(variance > 0, variance, 1)), 0)
+    return np.maximum(correlation, 0) ** 2
+
+
+# function to compute a robust average of volumes out-of-core
+def robust_average(volume_files, shape, method='median', trim=0.1, max_memory=0):
+    """
+    Return the voxel-wise median, trimmed mean (dropping the fraction trim of the volumes at each
+    end) or similarity weighted mean of raw float32 volumes of the given shape, reading one block
+    of every volume at a time. Also returns the weight of every volume (None unless weighted).
+    """
+    assert method in ROBUST_METHODS, "Robust averaging must be one of {}.".format(', '.join(ROBUST_METHODS))
+    assert 0 <= trim < 0.5, "Trim fraction must be between 0 and 0.5."
+    shape = tuple(shape)
+    volumes = [np.memmap(path, dtype=np.float32, mode='r', shape=shape) for path in volume_files]
+    num_volumes = len(volumes)
+    step = get_block_size(shape, num_volumes, max_memory)
+    cut = int(trim * num_volumes)
+    output = np.zeros(shape, dtype=np.float64)
+    correlation_sums = np.zeros((5, num_volumes))
+
+    for start in range(0, shape[0], step):
+        block = np.stack([np.asarray(volume[start:start + step], dtype=np.float64) for volume in volumes])
+        if method == 'trimmed':
+            block.sort(axis=0)
+            output[start:start + step] = block[cut:num_volumes - cut].mean(axis=0)
+            continue
+        median = np.median(block, axis=0)
+        output[start:start + step] = median
+        if method == 'weighted':
+            # correlation of every volume with the median, accumulated block by block
+            flat = block.reshape(num_volumes, -1)
+            reference = median.ravel()
+            correlation_sums += [flat.sum(axis=1), np.full(num_volumes, reference.sum()), (flat * flat).sum(axis=1), np.full(num_volumes, reference @ reference), flat @ reference]
+
+    if method != 'weighted':
+        return output, None
+
+    # second pass: weighted mean
+    weights = get_similarity_weights(correlation_sums, int(np.prod(shape)))
+    if weights.sum() == 0:
+        print("WARNING: No volume correlates with the median. Using equal weights.")
+        weights = np.ones(num_volumes)
+    weights = weights / weights.sum()
+    for start in range(0, shape[0], step):
+        output[start:start + step] = sum(weight * np.asarray(volume[start:start + step], dtype=np.float64) for weight, volume in zip(weights, volumes))
+    return output, weights
@@ -3,10 +3,18 @@
 
 import os # file handling
 import numpy as np # linear algebra
-import glob # file handling
 import argparse # command line arguments
-from joblib import Parallel, delayed # parallel processing
+from template_average import RunningAverage, AverageReducer, load_volume, normalize_by_mean, save_volume, save_volume_nrrd, get_shared_dir, write_shared_volume, robust_average, ROBUST_METHODS, save_checkpoint, load_checkpoint, remove_checkpoint # in-process template averaging
+from native_warp import warp_images_to_grids, load_transforms, read_geometry, RAS_TO_LPS # in-process warping
+import transform_cache # cache of composed transforms
+from transform_registry import load_registry, get_transform_file # index of the transforms of a run
+from decompression_cache import get_decompressed_files # decompressed copies of compressed transforms
+from job_scheduler import run_jobs, estimate_memory, get_resampled_voxels, parse_memory # memory-aware job scheduling
+from run_journal import open_job, get_input_hashes, load_journal, record_step, is_done # resumable runs
 import datetime # date and time
+import time # checkpoint intervals
+import sys # exit
+import signal # termination by the batch system
 
 # clear output
 os.system('cls' if os.name == 'nt' else 'clear')
@@ -15,7 +23,7 @@ os.system('cls' if os.name == 'nt' else 'clear')
 start_string = 'Kronauer Lab - Microscopy Image Processing Pipeline\n'
 start_string += "="*(len(start_string)-1) + '\n'
 start_string += 'High Resolution Brain Template Generator by Rishika Mohanta\n'
-start_string += 'Version 1.0.0\n'
+start_string += 'Version 1.13.0\n'
 
 print(start_string)
 
@@ -24,8 +32,24 @@ parser = argparse.ArgumentParser(description='Resample generated brain template
 parser.add_argument('-i','--input_dir', type=str, help='path to results directory (must contain syn directory and complete_template0.nii.gz files; default: latest obiroi directory in results/)', default="", nargs='?')
 parser.add_argument('-db','--clean_database', type=str, help='path to clean database directory (must contain .nrrd files; default: ./cleaned_data/whole_brain)', default="./cleaned_data/whole_brain", nargs='?')
 parser.add_argument('-o','--output_dir', type=str, help='path to output directory (default: ./final_templates)', default="./final_templates", nargs='?')
-parser.add_argument('-v','--target_voxel_size', type=str, help='target voxel size in microns (e.g. 0.8x0.8x0.8)', default="0.8x0.8x0.8", nargs='?')
-parser.add_argument('-n','--num_workers', type=int, help='number of workers to use (default: 1)', default=1, nargs='?')
+parser.add_argument('-v','--target_voxel_size', type=str, help='target voxel size in microns, or several comma separated voxel sizes to generate the template at all of them in one run (e.g. 0.8x0.8x0.8 or 0.8x0.8x0.8,0.4x0.4x0.4; default: 0.8x0.8x0.8)', default="0.8x0.8x0.8", nargs='?')
+parser.add_argument('-n','--num_workers', type=int, help='maximum number of workers to use (0: one per CPU; default: 1)', default=1, nargs='?')
+parser.add_argument('-mb','--mem_budget', type=str, help='memory budget shared by all workers (e.g. 64G; 0: no limit; default: auto, the memory currently available)', default="auto", nargs='?')
+parser.add_argument('-th','--threads', type=int, help='number of ITK threads per worker (0: split the CPUs between the workers; default: 0)', default=0, nargs='?')
+parser.add_argument('-pin','--pin_threads', action='store_true', help='pin each worker and the ANTs processes it starts to its own CPUs')
+parser.add_argument('-at','--auto_tune', action='store_true', help='choose the number of workers and threads by timing the first (smallest) files with different thread counts (overrides -n and -th)')
+parser.add_argument('-e','--engine', type=str, help='warping engine (ants: WarpImageMultiTransform, native: warp in-process; default: ants)', default="ants", nargs='?')
+parser.add_argument('-tc','--transform_cache', type=str, help='path to a cache directory for the Warp and Affine transforms of every brain composed into one displacement field on the target grid (native engine only; uses about 12 bytes per voxel of the target grid per brain; default: no cache)', default="", nargs='?')
+parser.add_argument('-dc','--decompression_cache', type=str, help='path to a cache directory for uncompressed copies of the compressed transforms (Warp.nii.gz, Affine.txt.gz), made once and reused by later runs (default: no cache)', default="", nargs='?')
+parser.add_argument('-dq','--decompression_quota', type=str, help='maximum size of the decompression cache, least recently used copies are removed first (e.g. 100G; 0: no limit; default: 100G)', default="100G", nargs='?')
+parser.add_argument('-ch','--channels', type=str, help='other channels to warp with every brain, comma separated (e.g. GFP,DAPI; found next to the brain with the channel instead of the first part of its name, e.g. GFP_RM_OB-1_20240101.nrrd; default: none)', default="", nargs='?')
+parser.add_argument('-avg','--averaging', type=str, help='averaging of the warped brains (ants: AverageImages at the end, stream: running average as each brain is warped, median: voxel-wise median, trimmed: trimmed mean, weighted: mean weighted by the similarity of every brain to the median; default: ants)', default="ants", nargs='?')
+parser.add_argument('-tr','--trim', type=float, help='fraction of the brains dropped at each end of every voxel for trimmed averaging (default: 0.1)', default=0.1, nargs='?')
+parser.add_argument('-nw','--no_warped', action='store_true', help='do not keep the warped brains (each one is deleted as soon as it is handed to the averaging; not with ants averaging)')
+parser.add_argument('-var','--variance', action='store_true', help='also write a variance map of the warped brains (Welford running variance; stream averaging only)')
+parser.add_argument('-q','--queue_size', type=int, help='maximum number of warped brains waiting to be added to the average (stream averaging only; default: 2)', default=2, nargs='?')
+parser.add_argument('-r','--resume', action='store_true', help='keep the temporary files in a job directory named after the run and the target voxel size (temp_<run>_<target voxel size>) and skip everything a previous run of the same job already finished')
+parser.add_argument('-ci','--checkpoint_interval', type=float, help='minutes between checkpoints of the running average of a resumable job (stream averaging only; default: 10)', default=10, nargs='?')
 parser.add_argument('-t','--keep_temp', type=bool, help='keep temporary files (default: False)', default=False, nargs='?')
 args = parser.parse_args()
 
@@ -34,35 +58,46 @@ timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M')
 
 ## ARGUMENT VERIFICATION
 
-# check if target voxel size is valid
-target_voxel_size = args.target_voxel_size
-original_target_voxel_size = target_voxel_size
-target_voxel_size = target_voxel_size.split('x')
-assert len(target_voxel_size) == 3, "Target voxel size must be in the format '<x-resolution>x<y-resolution>x<z-resolution>'."
-
-try:
-    target_voxel_size = [float(i) for i in target_voxel_size]
-except:
-    raise ValueError("Target voxel size must be in the format '<x-resolution>x<y-resolution>x<z-resolution>'.")
-
-# check if target voxel size is positive
-assert all(i > 0 for i in target_voxel_size), "Target voxel size must be positive."
+# check if target voxel sizes are valid (one or more, comma separated)
+target_voxel_sizes = [i.strip() for i in args.target_voxel_size.split(',') if i.strip() != ""]
+assert len(target_voxel_sizes) > 0, "At least one target voxel size is needed."
+assert len(set(target_voxel_sizes)) == len(target_voxel_sizes), "Target voxel sizes must not repeat."
+# all target voxel sizes together name the temporary directory
+original_target_voxel_size = "_".join(target_voxel_sizes)
+
+# target resolutions in microns (x, y, z)
+target_resolutions = []
+for target_voxel_size in target_voxel_sizes:
+    target_voxel_size = target_voxel_size.split('x')
+    assert len(target_voxel_size) == 3, "Target voxel size must be in the format '<x-resolution>x<y-resolution>x<z-resolution>'."
+
+    try:
+        target_voxel_size = [float(i) for i in target_voxel_size]
+    except:
+        raise ValueError("Target voxel size must be in the format '<x-resolution>x<y-resolution>x<z-resolution>'.")
+
+    # check if target voxel size is positive
+    assert all(i > 0 for i in target_voxel_size), "Target voxel size must be positive."
+    target_resolutions.append(np.array(target_voxel_size))
+
+# check averaging
+averaging = args.averaging
+assert averaging in ['stream', 'ants'] + ROBUST_METHODS, "Averaging must be one of stream, ants, {}.".format(', '.join(ROBUST_METHODS))
+assert averaging != 'ants' or not args.no_warped, "--no_warped does not work with ants averaging (use -avg stream)."
+assert averaging == 'stream' or not args.variance, "--variance needs stream averaging (-avg stream)."
+assert 0 <= args.trim < 0.5, "Trim fraction must be between 0 and 0.5."
+assert args.queue_size > 0, "Queue size must be positive."
+assert args.checkpoint_interval >= 0, "Checkpoint interval must not be negative."
+
+# check if engine is valid
+engine = args.engine
+assert engine in ['ants', 'native'], "Warping engine must be either 'ants' or 'native'."
+assert engine == 'native' or args.transform_cache == "", "The transform cache needs the native engine."
 
 # create output directory if it does not exist
 output_dir = args.output_dir
 if not os.path.isdir(output_dir):
     os.makedirs(output_dir)
-# make a temporary directory (temp_DDMMYY_HHMM_<target_voxel_size>) inside output directory
-temp_dir = os.path.join(output_dir, f"temp_{timestamp}_{original_target_voxel_size}")
-if not os.path.isdir(temp_dir):
-    os.makedirs(temp_dir)
-else:
-    # if temp directory already exists, delete it and create a new one
-    os.system(f"rm -rf {temp_dir}")
-    os.makedirs(temp_dir)
-
-# check if output file (obiroi_template_DDMMYY_HHMM_<target_voxel_size>.nrrd) already exists
-output_file = os.path.join(output_dir, f"obiroi_template_{timestamp}_{original_target_voxel_size}.nrrd")
 
 # check if clean database directory is valid
 clean_database_dir = args.clean_database
@@ -97,131 +132,180 @@ assert os.path.isdir(os.path.join(input_dir, "syn")), "Input directory does not
 # make sure there is complete_template0.nii.gz file
 assert os.path.isfile(os.path.join(input_dir, "complete_template0.nii.gz")), "Input directory does not contain complete_template0.nii.gz file."
 
-# get list of all *.nii.gz files in syn directory
-# nii_files = list(glob.glob(os.path.join(input_dir, "syn", "*.nii.gz")))
-nii_files = os.listdir(os.path.join(input_dir, "syn"))
-nii_files = [os.path.join(input_dir, "syn", file) for file in nii_files if file.endswith(".nii.gz")]
-
-# remove any files that start with complete_template
-nii_files = [file for file in nii_files if not os.path.basename(file).startswith("complete_template")]
-
-# remove duplicates
-nii_files = list(set(nii_files))
-
-# create function to get original name
-def get_original_name(file):
-    # get basename
-    file = os.path.basename(file)
-    # remove everything after resampled
-    original_name = file.split("_resampled")[0] + ".nrrd"
-    # remove "complete_" from the beginning
-    original_name = original_name.replace("complete_", "")
-    return original_name
-
-# create function to get basefile names
-def get_basefile_name(file):
-    # get basename
-    file = os.path.basename(file)
-    # remove everything after nrrd
-    basefile = file.split(".nrrd")[0] + ".nrrd"
-    return basefile
-
-# get list of all basefile names
-basefiles = [get_basefile_name(file) for file in nii_files]
-
-# remove duplicates
-basefiles = list(set(basefiles))
+# make a temporary directory inside output directory
+if args.resume:
+    # a resumable job always uses the same directory (temp_<run>_<target_voxel_size>) and keeps the timestamp of its outputs
+    temp_dir = os.path.join(output_dir, f"temp_{os.path.basename(os.path.normpath(input_dir))}_{original_target_voxel_size}")
+    job_settings = {'script': os.path.basename(__file__), 'input_dir': os.path.abspath(input_dir), 'clean_database': os.path.abspath(clean_database_dir), 'target_voxel_size': original_target_voxel_size, 'engine': engine, 'averaging': averaging, 'trim': args.trim, 'channels': args.channels, 'no_warped': args.no_warped, 'variance': args.variance}
+    timestamp = open_job(temp_dir, job_settings, timestamp)
+    print(f"Job directory: {temp_dir}")
+    # let the batch system stop the job like an interrupt (so that the running average is checkpointed)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+else:
+    # temp_DDMMYY_HHMM_<target_voxel_size>
+    temp_dir = os.path.join(output_dir, f"temp_{timestamp}_{original_target_voxel_size}")
+    if not os.path.isdir(temp_dir):
+        os.makedirs(temp_dir)
+    else:
+        # if temp directory already exists, delete it and create a new one
+        os.system(f"rm -rf {temp_dir}")
+        os.makedirs(temp_dir)
+
+# the files of every target voxel size go to their own directory if there is more than one
+grid_dirs = [temp_dir if len(target_voxel_sizes) == 1 else os.path.join(temp_dir, target_voxel_size) for target_voxel_size in target_voxel_sizes]
+for grid_dir in grid_dirs:
+    os.makedirs(grid_dir, exist_ok=True)
+
+# index all transforms in the syn directory (scanned once and reused until the directory changes)
+transform_index = load_registry(input_dir)
 
+# get a list of all original files
+original_files = sorted(transform_index)
 
-# for every basefile, make sure there is a Warp file
+# create dictionaries to store the basefile, Warp file and GenericAffine.mat file for each original file
+basefile_dict = {}
 basefile_to_warp = {}
-for basefile in basefiles:
-    # find all files that start with basefile and end with Warp.nii.gz
-    warp_files = [file for file in os.listdir(os.path.join(input_dir, "syn")) if file.startswith(basefile) and file.endswith("Warp.nii.gz") and not "Inverse" in file]
-    # make sure there is only one Warp file
-    assert len(warp_files) == 1, f"Input directory does not contain {basefile}<xxx>Warp.nii.gz file."
-    # add basefile and Warp file to dictionary
-    basefile_to_warp[basefile] = warp_files[0]
-    print(f"Found {warp_files[0]}.")
-
-# for every basefile, make sure there is an GenericAffine.mat file
 basefile_to_affine = {}
-for basefile in basefiles:
-    # find all files that start with basefile and end with GenericAffine.mat
-    affine_files = [file for file in os.listdir(os.path.join(input_dir, "syn")) if file.startswith(basefile) and file.endswith("GenericAffine.mat")]
-    # make sure there is only one GenericAffine.mat file
-    assert len(affine_files) == 1, f"Input directory does not contain {basefile}<xxx>GenericAffine.mat file."
-    # add basefile and GenericAffine.mat file to dictionary
-    basefile_to_affine[basefile] = affine_files[0]
-    print(f"Found {affine_files[0]}.")
 
-# get a list of all original files
-original_files = [get_original_name(file) for file in nii_files]
-
-# remove duplicates
-original_files = list(set(original_files))
+# for every original file, make sure there is exactly one Warp file and one GenericAffine.mat file
+for original_file in original_files:
+    basefile = transform_index[original_file]['basefile']
+    basefile_dict[original_file] = basefile
+    basefile_to_warp[basefile] = get_transform_file(transform_index, original_file, 'warp')
+    print(f"Found {basefile_to_warp[basefile]}.")
+    basefile_to_affine[basefile] = get_transform_file(transform_index, original_file, 'affine')
+    assert basefile_to_affine[basefile].endswith("GenericAffine.mat"), f"Input directory does not contain {basefile}<xxx>GenericAffine.mat file."
+    print(f"Found {basefile_to_affine[basefile]}.")
+
+# create function to get the Warp and Affine files of an original file (their decompressed copies if there are any)
+decompressed_files = {}
+def get_transform_files(original_file):
+    basefile = basefile_dict[original_file]
+    transform_files = [os.path.join(input_dir, "syn", basefile_to_warp[basefile]), os.path.join(input_dir, "syn", basefile_to_affine[basefile])]
+    return [decompressed_files.get(transform_file, transform_file) for transform_file in transform_files]
+
+# decompress the compressed transforms once, never in place: all of them into the decompression cache,
+# or else only compressed Affine files (which ANTs cannot read) into the temporary directory
+compressed_files = [transform_file for original_file in original_files for transform_file in get_transform_files(original_file) if transform_file.endswith('.gz') and (args.decompression_cache != "" or not transform_file.endswith('.nii.gz'))]
+if len(compressed_files) > 0:
+    decompression_dir = args.decompression_cache if args.decompression_cache != "" else os.path.join(temp_dir, "transforms")
+    print(f"Decompressing {len(compressed_files)} transform files into {decompression_dir}...")
+    decompressed_files = dict(zip(compressed_files, get_decompressed_files(compressed_files, decompression_dir, parse_memory(args.decompression_quota) if args.decompression_cache != "" else 0)))
+
+# create function to get the path of an original file (mirrors can be detached .nhdr headers)
+def get_original_path(original_file):
+    path = os.path.join(clean_database_dir, original_file)
+    if not os.path.isfile(path) and os.path.isfile(path[:-5] + ".nhdr"):
+        path = path[:-5] + ".nhdr"
+    return path
 
 # check if each original file exists in clean database directory
 for original_file in original_files:
-    assert os.path.isfile(os.path.join(clean_database_dir, original_file)), f"Original file {original_file} not found in clean database directory."
+    assert os.path.isfile(get_original_path(original_file)), f"Original file {original_file} not found in clean database directory."
     print(f"Found {original_file} in clean database directory.")
 
 
-# create a dictionary to store basefile for each original file
-basefile_dict = {}
+print("All files found in input directory and clean database directory.")
 
-# for each original file, find the basefile
+# find the other channels of every brain (same name with the channel instead of the first part)
+channels = [channel.strip() for channel in args.channels.split(',') if channel.strip() != ""]
+channel_files = {}
 for original_file in original_files:
-    # find the matching basefile
-    temp = original_file.replace(".nrrd", "")
-    temp = "complete_" + temp
-    basefile = [file for file in basefiles if file.startswith(temp)]
-    # make sure there is only one basefile
-    assert len(basefile) == 1, f"Could not find basefile for {original_file}. Make sure there is only one basefile for each original file."
-    # add basefile to dictionary
-    basefile_dict[original_file] = basefile[0]
-
-print("All files found in input directory and clean database directory.")
+    channel_files[original_file] = []
+    for channel in channels:
+        channel_file = get_original_path(channel + "_" + original_file.split("_", 1)[1])
+        if not os.path.isfile(channel_file):
+            print(f"WARNING: {channel} channel of {original_file} not found ({channel_file}). Skipping.")
+            continue
+        channel_files[original_file].append(channel_file)
+        print(f"Found {os.path.basename(channel_file)} in clean database directory.")
+
+# make a directory for the warped channels of every target voxel size (obiroi_template_DDMMYY_HHMM_<target_voxel_size>_channels)
+channels_dirs = [os.path.join(output_dir, f"obiroi_template_{timestamp}_{target_voxel_size}_channels") for target_voxel_size in target_voxel_sizes]
+for channels_dir in channels_dirs:
+    if len(channels) > 0 and not os.path.isdir(channels_dir):
+        os.makedirs(channels_dir)
 
 ## RESAMPLING
 
-# make a upsampled_template.nii.gz file in temp directory using ResampleImageBySpacing from ANTs
+# make a upsampled_template.nii.gz file for every target voxel size in temp directory using ResampleImageBySpacing from ANTs
 
-# target resolution in microns (x, y, z)
-target_resolution = np.array(target_voxel_size)
-print(f"Target resolution: {target_resolution[0]} μm x {target_resolution[1]} μm x {target_resolution[2]} μm")
+complete_template_file = os.path.join(input_dir, "complete_template0.nii.gz")
 
-print("Resampling template to generate low quality upsampled template...")
+# journal of the finished steps of a resumable job
+journal = load_journal(temp_dir) if args.resume else {}
+template_inputs = get_input_hashes(temp_dir, [complete_template_file]) if args.resume else {}
 
-log_file = os.path.join(temp_dir, "upsampled_template_out.log")
-err_file = os.path.join(temp_dir, "upsampled_template_err.log")
-print(f"Log file: {log_file}")
-print(f"Error file: {err_file}")
+upsampled_template_files = []
+for grid, target_resolution in enumerate(target_resolutions):
+    # target resolution in microns (x, y, z)
+    print(f"Target resolution: {target_resolution[0]} μm x {target_resolution[1]} μm x {target_resolution[2]} μm")
 
-complete_template_file = os.path.join(input_dir, "complete_template0.nii.gz")
-upsampled_template_file = os.path.join(temp_dir, "upsampled_template.nii.gz")
+    print("Resampling template to generate low quality upsampled template...")
+
+    log_file = os.path.join(grid_dirs[grid], "upsampled_template_out.log")
+    err_file = os.path.join(grid_dirs[grid], "upsampled_template_err.log")
+    print(f"Log file: {log_file}")
+    print(f"Error file: {err_file}")
+
+    upsampled_template_file = os.path.join(grid_dirs[grid], "upsampled_template.nii.gz")
+    upsampled_template_files.append(upsampled_template_file)
 
-os.system(f"ResampleImageBySpacing 3 {complete_template_file} {upsampled_template_file} {target_resolution[0]} {target_resolution[1]} {target_resolution[2]} 0 0 0 > {log_file} 2> {err_file}")
+    template_step = os.path.relpath(upsampled_template_file, temp_dir)
+    if args.resume and is_done(journal.get(template_step), template_inputs):
+        print("Upsampled template already generated. Skipping.")
+        continue
+    os.system(f"ResampleImageBySpacing 3 {complete_template_file} {upsampled_template_file} {target_resolution[0]} {target_resolution[1]} {target_resolution[2]} 0 0 0 > {log_file} 2> {err_file}")
+    if args.resume:
+        assert os.path.isfile(upsampled_template_file), "Upsampled template was not generated. Please check log and error files."
+        record_step(temp_dir, template_step, template_inputs, [upsampled_template_file])
 
 ## WARPING
 # WarpImageMultiTransform 3 synA647_LL_L12_200727.nrrd  applytransformonoriginaltoupsampled_template.nii.gz -R upsampled_template.nii.gz complete_synA647_LL_L12_200727_resampled_0.6x0.6x0Warp.nii.gz complete_synA647_LL_L12_200727_resampled_0.6x0.6x0Affine.txt
 
-
-# define a function to warp a file
+# indices of the target voxel sizes
+grids = range(len(target_voxel_sizes))
+
+# define a function to get the warped file of a brain on a target grid (files that are not kept are written uncompressed, faster to write and read back)
+def get_warped_file(index, grid):
+    return os.path.join(grid_dirs[grid], f"{original_files[index][:-5]}_warped.nii" + ("" if args.no_warped else ".gz"))
+
+# define a function to get the warped channel files of a brain on a target grid (kept next to the template)
+def get_warped_channel_files(index, grid):
+    return [os.path.join(channels_dirs[grid], os.path.splitext(os.path.basename(channel_file))[0] + "_warped.nrrd") for channel_file in channel_files[original_files[index]]]
+
+# define a function to get the normalized brain on a target grid handed to the averaging
+def get_normalized_file(index, grid):
+    return os.path.join(shared_dir if averaging == 'stream' else normalized_dirs[grid], f"{original_files[index][:-5]}_{target_voxel_sizes[grid]}.f32")
+
+# define a function to get the files a brain leaves behind (checked before a resumed job skips it)
+def get_output_files(index):
+    output_files = []
+    for grid in grids:
+        if not args.no_warped:
+            output_files.append(get_warped_file(index, grid))
+        output_files += get_warped_channel_files(index, grid)
+        if averaging in ROBUST_METHODS:
+            output_files.append(get_normalized_file(index, grid))
+    return output_files
+
+# define a function to warp a file onto every target grid
 def warp_file(index):
     # print progress
     print(f"Warp file {index+1} of {len(original_files)}")
 
-    # print original file, basefile, warped file, Warp file, and Affine file
-    original_file = os.path.join(clean_database_dir, original_files[index])
-    basefile = os.path.join(input_dir, "syn", basefile_dict[original_files[index]])
-    warped_file = os.path.join(temp_dir, f"{original_files[index][:-5]}_warped.nii.gz")
-    warp_file = os.path.join(input_dir, "syn", basefile_to_warp[basefile_dict[original_files[index]]])
-    affine_file = os.path.join(input_dir, "syn", basefile_to_affine[basefile_dict[original_files[index]]])
+    # print original file, basefile, transform files, and warped files
+    original_file = get_original_path(original_files[index])
+    transform_files = get_transform_files(original_files[index])
 
     print(f"Original file: {original_file}")
-    print(f"Basefile: {basefile}")
-    print(f"Warped file: {warped_file}")
+    print(f"Basefile: {basefile_dict[original_files[index]]}")
+    for transform_file in transform_files:
+        print(f"Transform file: {transform_file}")
+    for grid in grids:
+        print(f"Warped file: {get_warped_file(index, grid)}")
+        for warped_channel_file in get_warped_channel_files(index, grid):
+            print(f"Warped channel file: {warped_channel_file}")
 
     # print log file location
     log_file = os.path.join(temp_dir, f"{original_files[index][:-5]}_out.log")
@@ -229,39 +313,213 @@ def warp_file(index):
     print(f"Log file: {log_file}")
     print(f"Error file: {err_file}")
 
-    # warp data using ANTs
-    os.system(f"WarpImageMultiTransform 3 {original_file} {warped_file} -R {upsampled_template_file} {warp_file} {affine_file} > {log_file} 2> {err_file}")
+    volumes = []
+    if engine == 'native':
+        # warp data in-process (the warped file is only written if it is kept)
+        transforms = [(transform_file, False) for transform_file in transform_files]
+        if args.transform_cache != "":
+            # look up the composed transform of this brain on every target grid (composed and cached on first use)
+            grid_transforms = [[transform_cache.get_composite_field(args.transform_cache, composite_keys[grid][index], transforms, *target_geometries[grid])] for grid in grids]
+        else:
+            # the transforms are read once for all target grids
+            steps = load_transforms(transforms)
+            grid_transforms = [steps for grid in grids]
+        # the brain and its channels are read once; on every grid all channels are sampled at the same points
+        warped = warp_images_to_grids([original_file] + channel_files[original_files[index]], upsampled_template_files, [[None if args.no_warped else get_warped_file(index, grid)] + get_warped_channel_files(index, grid) for grid in grids], grid_transforms)
+        volumes = [(outputs[0], RAS_TO_LPS @ affine) for outputs, affine in warped]
+    else:
+        # warp data using ANTs (once per target grid)
+        for grid in grids:
+            warped_file = get_warped_file(index, grid)
+            os.system(f"WarpImageMultiTransform 3 {original_file} {warped_file} -R {upsampled_template_files[grid]} {transform_files[0]} {transform_files[1]} {'>' if grid == 0 else '>>'} {log_file} {'2>' if grid == 0 else '2>>'} {err_file}")
+            for channel_file, warped_channel_file in zip(channel_files[original_files[index]], get_warped_channel_files(index, grid)):
+                os.system(f"WarpImageMultiTransform 3 {channel_file} {warped_channel_file} -R {upsampled_template_files[grid]} {transform_files[0]} {transform_files[1]} >> {log_file} 2>> {err_file}")
+            if averaging == 'ants':
+                continue
+            # load the warped file here (in the worker)
+            assert os.path.isfile(warped_file), f"Warped file {warped_file} was not generated. Please check log and error files."
+            volumes.append(load_volume(warped_file))
+            if args.no_warped:
+                os.remove(warped_file)
+    if averaging == 'ants':
+        return [get_warped_file(index, grid) for grid in grids]
+
+    # hand the warped brain to the reducer through shared memory (robust averages keep all brains on disk)
+    # normalize every brain by its mean intensity (as AverageImages with normalization does)
+    results = []
+    for grid, (volume, affine) in zip(grids, volumes):
+        shared_file = get_normalized_file(index, grid)
+        shape = write_shared_volume(shared_file, normalize_by_mean(volume))
+        results.append((shared_file, shape, affine))
+    return results
 
     
-if args.num_workers == 1:
-    # resample each file sequentially
+# estimate the memory needed to warp each file (original stack and warp field in, upsampled template grids out)
+output_voxels = [get_resampled_voxels(complete_template_file, target_resolution) for target_resolution in target_resolutions]
+# (the native engine holds all channels of a brain on all grids at once)
+estimates = [estimate_memory([get_original_path(original_files[index]), get_transform_files(original_files[index])[0]] + channel_files[original_files[index]], sum(output_voxels) * (1 + len(channel_files[original_files[index]])), 'linear') for index in range(len(original_files))]
+
+# find the composed transform of every brain on every target grid in the transform cache
+if args.transform_cache != "":
+    os.makedirs(args.transform_cache, exist_ok=True)
+    print(f"Transform cache: {args.transform_cache}")
+    target_geometries = [read_geometry(upsampled_template_file) for upsampled_template_file in upsampled_template_files]
+    composite_keys = [[] for grid in grids]
     for index in range(len(original_files)):
-        warp_file(index)
-else:
-    assert args.num_workers > 1, "Number of workers must be greater than 1."
-    assert args.num_workers <= len(original_files), "Number of workers must be less than or equal to number of files."
-    assert args.num_workers <= os.cpu_count(), "Number of workers must be less than or equal to number of CPUs."
-    # resample each file in parallel using joblib
-    Parallel(n_jobs=args.num_workers)(delayed(warp_file)(index) for index in range(len(original_files)))
+        transform_hashes = transform_cache.get_transform_hashes(args.transform_cache, get_transform_files(original_files[index]))
+        for grid in grids:
+            composite_keys[grid].append(transform_cache.get_composite_key(transform_hashes, [False, False], *target_geometries[grid]))
+
+# running average of the warped files on every target grid (float64 sum, or mean and variance)
+averages = [RunningAverage(welford=args.variance) for grid in grids]
+average_affines = [None for grid in grids]
+# names of the brains in every running average (saved with its checkpoints)
+averaged_files = [[] for grid in grids]
+normalized_dirs = [os.path.join(grid_dir, "normalized") for grid_dir in grid_dirs]
+if averaging in ROBUST_METHODS:
+    # normalized brains are kept until all are warped
+    for normalized_dir in normalized_dirs:
+        os.makedirs(normalized_dir, exist_ok=True)
+    normalized_files = [{} for grid in grids]
+
+# find the brains a previous run of this job already finished (inputs unchanged and outputs verified)
+finished = set()
+if args.resume:
+    print("Checking the journal of the job...")
+    brain_inputs = [get_input_hashes(temp_dir, [get_original_path(original_files[index])] + channel_files[original_files[index]] + get_transform_files(original_files[index]) + upsampled_template_files) for index in range(len(original_files))]
+    finished = set(index for index in range(len(original_files)) if is_done(journal.get(original_files[index]), brain_inputs[index]))
+    if averaging == 'stream':
+        # only brains in the checkpointed running averages of all grids are finished
+        verified_files = set(original_files[index] for index in finished)
+        for grid in grids:
+            checkpoint = load_checkpoint(grid_dirs[grid], averages[grid])
+            if checkpoint is not None and not set(checkpoint[0]) <= verified_files:
+                print("WARNING: The checkpointed average contains brains that have to be warped again. Starting a new average.")
+                averages[grid] = RunningAverage(welford=args.variance)
+                remove_checkpoint(grid_dirs[grid])
+                checkpoint = None
+            if checkpoint is None:
+                finished = set()
+            else:
+                averaged_files[grid], average_affines[grid] = checkpoint
+                finished = set(index for index in finished if original_files[index] in averaged_files[grid])
+    elif averaging in ROBUST_METHODS:
+        for index in finished:
+            entry = journal[original_files[index]]
+            for grid in grids:
+                normalized_files[grid][index] = (get_normalized_file(index, grid), entry['shape'][grid])
+                average_affines[grid] = np.array(entry['affine'][grid])
+    for index in sorted(finished):
+        print(f"Skipping {original_files[index]} (already finished).")
+pending = [index for index in range(len(original_files)) if index not in finished]
+
+# define a function to note that a brain was added to a running average
+last_checkpoints = [time.time() for grid in grids]
+def on_added(grid, name):
+    averaged_files[grid].append(name)
+    print(f"Added {name} to the average{'' if len(grids) == 1 else ' at ' + target_voxel_sizes[grid]} ({averages[grid].count} of {len(original_files)}).")
+    # runs in the reducer thread between two additions, so the checkpoint is consistent
+    if args.resume and time.time() - last_checkpoints[grid] >= args.checkpoint_interval * 60:
+        save_checkpoint(grid_dirs[grid], averages[grid], averaged_files[grid], average_affines[grid])
+        last_checkpoints[grid] = time.time()
+
+if averaging == 'stream':
+    # warped brains are folded into the averages in background threads while the workers go on warping
+    shared_dir = get_shared_dir(temp_dir)
+    reducers = [AverageReducer(averages[grid], args.queue_size, lambda name, grid=grid: on_added(grid, name)) for grid in grids]
+
+# define a function to record a finished brain in the journal and hand it to the averaging
+def finish_file(index, results):
+    if args.resume:
+        info = {} if averaging == 'ants' else {'shape': [[int(n) for n in result[1]] for result in results], 'affine': [np.asarray(result[2], dtype=float).tolist() for result in results]}
+        record_step(temp_dir, original_files[index], brain_inputs[index], get_output_files(index), **info)
+    if averaging != 'ants':
+        for grid, result in zip(grids, results):
+            add_to_average(index, grid, result)
+
+# define a function to hand a warped file to the reducer of its grid as soon as it is ready
+def add_to_average(index, grid, result):
+    shared_file, shape, affine = result
+    if average_affines[grid] is None:
+        average_affines[grid] = affine
+    if averaging in ROBUST_METHODS:
+        normalized_files[grid][index] = (shared_file, shape)
+        return
+    if original_files[index] in averaged_files[grid]:
+        # already in the checkpointed average of this grid
+        os.remove(shared_file)
+        return
+    # blocks while the queue of the reducer is full, which holds back new warps
+    reducers[grid].put(shared_file, shape, original_files[index])
+
+# keep memory for the accumulators (one or two float64 volumes per grid) and the volumes in shared memory
+# (tmpfs counts against RAM) out of the budget of the workers: the queued ones and one written by every
+# worker that waits for a place in the queue
+mem_budget = parse_memory(args.mem_budget)
+if averaging == 'stream' and mem_budget > 0:
+    max_workers = max(1, min(args.num_workers if args.num_workers > 0 else os.cpu_count() or 1, len(pending)))
+    mem_budget = max(1, mem_budget - sum(output_voxels) * (8 * (2 if args.variance else 1) + 4 * (args.queue_size + max_workers)))
+
+# warp the largest files first, running as many files in parallel as the memory budget allows
+try:
+    run_jobs(warp_file, pending, [estimates[index] for index in pending], args.num_workers, mem_budget, args.threads, args.pin_threads, (lambda position, results: finish_file(pending[position], results)) if args.resume or averaging != 'ants' else None, tune=args.auto_tune)
+    if averaging == 'stream':
+        # wait for the last warped brains to be added
+        for grid in grids:
+            reducers[grid].close()
+            if args.resume:
+                save_checkpoint(grid_dirs[grid], averages[grid], averaged_files[grid], average_affines[grid])
+except BaseException:
+    # keep the brains averaged so far for the next run of the job
+    if averaging == 'stream' and args.resume:
+        for grid in grids:
+            if reducers[grid].error is None:
+                reducers[grid].close()
+                save_checkpoint(grid_dirs[grid], averages[grid], averaged_files[grid], average_affines[grid])
+    raise
+finally:
+    # never leave volumes behind in shared memory
+    if averaging == 'stream':
+        os.system(f"rm -rf {shared_dir}")
 
 ## AVERAGING
 
-# define a function to average all warped files using ANTs
-print("Averaging all warped files to generate high quality upsampled template...")
-log_file = os.path.join(temp_dir, "average_out.log")
-err_file = os.path.join(temp_dir, "average_err.log")
-print(f"Log file: {log_file}")
-print(f"Error file: {err_file}")
-
-final_template_file = os.path.join(output_dir, f"obiroi_template_{timestamp}_{original_target_voxel_size}.nrrd")
-
-regex = os.path.join(temp_dir, "*_warped.nii.gz")
-
-# run AverageImages from ANTs
-os.system(f"AverageImages 3 {final_template_file} 1 {regex} > {log_file} 2> {err_file}")
+# average all warped files on every target grid (running average, robust average or AverageImages from ANTs)
+for grid in grids:
+    print(f"Averaging all warped files to generate high quality upsampled template ({target_voxel_sizes[grid]})...")
+    log_file = os.path.join(grid_dirs[grid], "average_out.log")
+    err_file = os.path.join(grid_dirs[grid], "average_err.log")
+    print(f"Log file: {log_file}")
+    print(f"Error file: {err_file}")
 
-# verify that final template file exists
-assert os.path.isfile(final_template_file), "Final template file was not generated. Please check log and error files."
+    final_template_file = os.path.join(output_dir, f"obiroi_template_{timestamp}_{target_voxel_sizes[grid]}.nrrd")
+
+    regex = os.path.join(grid_dirs[grid], "*_warped.nii.gz")
+
+    if averaging in ROBUST_METHODS:
+        # reduce the normalized brains block by block
+        print(f"Computing the {averaging} of {len(normalized_files[grid])} brains block by block...")
+        files = [normalized_files[grid][index][0] for index in sorted(normalized_files[grid])]
+        template, weights = robust_average(files, normalized_files[grid][min(normalized_files[grid])][1], averaging, args.trim, parse_memory(args.mem_budget))
+        if weights is not None:
+            for index, weight in zip(sorted(normalized_files[grid]), weights):
+                print(f"Weight of {original_files[index]}: {weight:.3f}")
+
+    if averaging != 'ants':
+        # write the average and sharpen it like AverageImages does
+        average_file = os.path.join(grid_dirs[grid], "average.nii.gz")
+        save_volume(average_file, averages[grid].get_mean() if averaging == 'stream' else template, average_affines[grid])
+        os.system(f"ImageMath 3 {final_template_file} Sharpen {average_file} > {log_file} 2> {err_file}")
+        if args.variance:
+            variance_file = final_template_file[:-5] + "_variance.nrrd"
+            save_volume_nrrd(variance_file, averages[grid].get_variance(), average_affines[grid])
+            print(f"Variance map: {variance_file}")
+    else:
+        # run AverageImages from ANTs
+        os.system(f"AverageImages 3 {final_template_file} 1 {regex} > {log_file} 2> {err_file}")
+
+    # verify that final template file exists
+    assert os.path.isfile(final_template_file), "Final template file was not generated. Please check log and error files."
     
 # clear output
 os.system('cls' if os.name == 'nt' else 'clear')
@@ -272,7 +530,3 @@ if not args.keep_temp:
     os.system(f"rm -rf {temp_dir}")
 
 print("Done with generating high resolution brain template. Exiting...")
-
-
-
-
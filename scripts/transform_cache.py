@@ -0,0 +1,101 @@
+# helper functions for a cache of composed transforms
+
+## IMPLEMENTATION DETAILS
+# Warping a brain onto a reference grid maps every grid point through the same chain of
+# transforms (e.g. Warp.nii.gz followed by Affine.txt) each time the brain is warped again:
+# for another channel, or when a template is regenerated on the same grid. Here the chain
+# is composed once into a single displacement field on the reference grid (see
+# native_warp.compose_field) and stored uncompressed as <key>.npy, so later warps map it
+# into memory and look up the displacement of every grid point without interpolation.
+# The key is a hash of (content hashes of the transform files and their inversion flags,
+# reference grid shape and geometry, engine version). Content hashes are remembered in
+# index.json with the size and modification time of each file (as in resample_cache.py),
+# so unchanged transform files are only hashed once. <key>.json records the grid and the
+# transforms a field was composed from.
+
+import os # file handling
+import json # sidecar files
+import hashlib # cache keys
+import numpy as np # linear algebra
+import resample_cache # content hashes and hash index
+from native_resample import ENGINE_VERSION # version of the native engines
+from native_warp import DisplacementField, compose_field, load_transforms # composed transforms
+
+# version of the cache layout (bump to invalidate all entries)
+CACHE_VERSION = 1
+
+
+# function to get the content hashes of transform files
+def get_transform_hashes(cache_dir, transform_files):
+    """
+    Return the content hashes of transform files, hashing only the files that changed since
+    they were last hashed, and update the hash index of the cache directory.
+    """
+    index = resample_cache.load_index(cache_dir)
+    hashes = []
+    changed = False
+    for transform_file in transform_files:
+        content_hash = resample_cache.get_indexed_hash(transform_file, index)
+        if content_hash is None:
+            content_hash = resample_cache.hash_file(transform_file)
+            resample_cache.set_indexed_hash(transform_file, index, content_hash)
+            changed = True
+        hashes.append(content_hash)
+    if changed:
+        resample_cache.save_index(cache_dir, index)
+    return hashes
+
+
+# function to build the cache key of a composed transform
+def get_composite_key(transform_hashes, inverts, reference_shape, reference_affine):
+    """
+    Return the cache key of a chain of transforms composed on a reference grid.
+    """
+    description = json.dumps([CACHE_VERSION, ENGINE_VERSION, [[h, bool(i)] for h, i in zip(transform_hashes, inverts)], [int(n) for n in reference_shape[:3]], np.round(np.asarray(reference_affine, dtype=float), 6).tolist()])
+    return hashlib.blake2b(description.encode('utf-8'), digest_size=20).hexdigest()
+
+
+# function to load a composed transform from the cache
+def fetch(cache_dir, key):
+    """
+    Return the cached composed transform for key as a memory-mapped DisplacementField, or None.
+    """
+    field_file = os.path.join(cache_dir, key + '.npy')
+    info_file = os.path.join(cache_dir, key + '.json')
+    if not os.path.isfile(field_file) or not os.path.isfile(info_file):
+        return None
+    with open(info_file, 'r') as f:
+        info = json.load(f)
+    return DisplacementField(np.load(field_file, mmap_mode='r'), np.array(info['affine']))
+
+
+# function to compose a chain of transforms into the cache
+def store(cache_dir, key, transforms, reference_shape, reference_affine, num_threads=0):
+    """
+    Compose a list of (path, invert) transforms on the reference grid, store the field in the
+    cache under key and return it as a memory-mapped DisplacementField.
+    """
+    field_file = os.path.join(cache_dir, key + '.npy')
+    info_file = os.path.join(cache_dir, key + '.json')
+    # compose into a temporary file that is renamed when complete
+    temp_file = '{}.tmp-{}.npy'.format(os.path.join(cache_dir, key), os.getpid())
+    output = np.lib.format.open_memmap(temp_file, mode='w+', dtype=np.float32, shape=tuple(reference_shape[:3]) + (3,))
+    compose_field(load_transforms(transforms), reference_shape, reference_affine, output, num_threads)
+    output.flush()
+    del output
+    with open(info_file + '.tmp', 'w') as f:
+        json.dump({'shape': [int(n) for n in reference_shape[:3]], 'affine': np.asarray(reference_affine, dtype=float).tolist(), 'transforms': [[os.path.abspath(path), bool(invert)] for path, invert in transforms], 'engine_version': ENGINE_VERSION}, f, indent=1)
+    os.replace(temp_file, field_file)
+    os.replace(info_file + '.tmp', info_file)
+    return fetch(cache_dir, key)
+
+
+# function to get a composed transform
+def get_composite_field(cache_dir, key, transforms, reference_shape, reference_affine, num_threads=0):
+    """
+    Return the composed transform for key from the cache, composing and storing it first if it is missing.
+    """
+    field = fetch(cache_dir, key)
+    if field is None:
+        field = store(cache_dir, key, transforms, reference_shape, reference_affine, num_threads)
+    return field
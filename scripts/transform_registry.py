@@ -0,0 +1,126 @@
+# helper functions to index the transforms of a template construction run
+
+## IMPLEMENTATION DETAILS
+# The syn directory of a results run holds thousands of files per run (Warp, InverseWarp,
+# affine, deformed and repaired images, logs). Both template construction scripts name
+# them after the resampled input brain:
+#   - btp (antsMultivariateTemplateConstruction.sh):
+#       complete_<brain>_resampled_<voxel size>[...]Warp.nii.gz / InverseWarp.nii.gz /
+#       Affine.txt(.gz) / deformed.nii.gz / repaired.nii.gz
+#   - mtc (antsMultivariateTemplateConstruction2.sh):
+#       complete_<brain>_resampled_<voxel size>.nrrd<...>Warp.nii.gz / InverseWarp.nii.gz /
+#       GenericAffine.mat
+# The directory is scanned once and every file is sorted by its suffix into an index
+# brain (<brain>.nrrd) -> kind (affine, warp, inverse_warp, deformed, repaired) -> files.
+# The index is saved as transform_index.json in the run directory together with the
+# modification time of the syn directory, which changes whenever a file is added, removed
+# or renamed, so a changed directory is rescanned. An index is not saved if the directory
+# changed within the last few seconds (its modification time may not have caught up yet).
+
+import os # file handling
+import json # index file
+import time # timestamps
+
+# version of the index layout (bump to invalidate all indices)
+REGISTRY_VERSION = 1
+
+# name of the index file in the run directory
+INDEX_FILE = 'transform_index.json'
+
+# file suffixes of every kind of file (checked in this order, longer suffixes first)
+TRANSFORM_SUFFIXES = [
+    ('InverseWarp.nii.gz', 'inverse_warp'),
+    ('Warp.nii.gz', 'warp'),
+    ('GenericAffine.mat', 'affine'),
+    ('Affine.txt.gz', 'affine'),
+    ('Affine.txt', 'affine'),
+    ('deformed.nii.gz', 'deformed'),
+    ('repaired.nii.gz', 'repaired'),
+]
+
+# an index is only saved if the directory did not change for this long (in seconds)
+MIN_STAMP_AGE = 2
+
+
+# function to parse the name of a file in the syn directory
+def parse_transform_name(filename):
+    """
+    Return (brain, basefile, kind, naming) for a file written by the template construction,
+    or None if it is not a transform or image of an input brain.
+    """
+    if not filename.startswith('complete_') or filename.startswith('complete_template') or '_resampled' not in filename:
+        return None
+    for suffix, kind in TRANSFORM_SUFFIXES:
+        if filename.endswith(suffix):
+            break
+    else:
+        return None
+    brain = filename[len('complete_'):].split('_resampled')[0] + '.nrrd'
+    if '.nrrd' in filename:
+        # mtc: everything after the resampled input file name is added by the script
+        return brain, filename.split('.nrrd')[0] + '.nrrd', kind, 'mtc'
+    return brain, filename[:-len(suffix)], kind, 'btp'
+
+
+# function to scan the syn directory
+def scan_transforms(syn_dir):
+    """
+    Return the index of all transforms in syn_dir: brain -> {'basefile', 'naming', kind: [files]}.
+    """
+    index = {}
+    with os.scandir(syn_dir) as entries:
+        for entry in entries:
+            parsed = parse_transform_name(entry.name)
+            if parsed is None:
+                continue
+            brain, basefile, kind, naming = parsed
+            record = index.setdefault(brain, {'basefile': basefile, 'naming': naming})
+            record.setdefault(kind, []).append(entry.name)
+            # the Warp file names the basefile of a brain
+            if kind == 'warp':
+                record['basefile'] = basefile
+    for record in index.values():
+        for kind in set(kind for _, kind in TRANSFORM_SUFFIXES):
+            record[kind] = sorted(record.get(kind, []))
+    return index
+
+
+# function to load the transform index of a run
+def load_registry(run_dir, persist=True):
+    """
+    Return the transform index of a results run (see scan_transforms), read from transform_index.json
+    if the syn directory did not change since it was written, else scanned (and saved if persist).
+    """
+    syn_dir = os.path.join(run_dir, 'syn')
+    index_file = os.path.join(run_dir, INDEX_FILE)
+    stamp = os.stat(syn_dir).st_mtime_ns
+    if os.path.isfile(index_file):
+        try:
+            with open(index_file, 'r') as f:
+                saved = json.load(f)
+            if saved.get('version') == REGISTRY_VERSION and saved.get('stamp') == stamp:
+                return saved['brains']
+        except (OSError, ValueError, KeyError):
+            print("WARNING: Could not read transform index {}. Rescanning.".format(index_file))
+
+    index = scan_transforms(syn_dir)
+    # do not save an index of a directory that may still be changing
+    if persist and time.time_ns() - stamp > MIN_STAMP_AGE * 1e9:
+        try:
+            with open(index_file + '.tmp', 'w') as f:
+                json.dump({'version': REGISTRY_VERSION, 'stamp': stamp, 'brains': index}, f, indent=1)
+            os.replace(index_file + '.tmp', index_file)
+        except OSError:
+            print("WARNING: Could not save transform index {}.".format(index_file))
+    return index
+
+
+# function to get the single file of a kind for a brain
+def get_transform_file(index, brain, kind):
+    """
+    Return the name of the only file of a kind (e.g. 'warp', 'affine') of a brain in the index.
+    """
+    assert brain in index, "No transforms found for {}.".format(brain)
+    files = index[brain].get(kind, [])
+    assert len(files) == 1, "Expected exactly one {} file for {}, found {}.".format(kind, brain, len(files))
+    return files[0]
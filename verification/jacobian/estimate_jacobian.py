@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 from joblib import Parallel, delayed
 import numpy as np
 import nrrd
 import matplotlib.pyplot as plt
 
+# the decompression cache of the template scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'scripts'))
+from decompression_cache import get_decompressed_files
+
 results_dir = '../../results/obiroi_brain_20231205_1133/syn'
+# cache directory for uncompressed copies of the warp files, shared with template_resample.py -dc (empty: read the compressed files)
+decompression_cache_dir = ''
 # get all the files in the results directory
 files = os.listdir(results_dir)
 # keep only warp files
@@ -28,8 +35,15 @@ else:
 n_cpus = os.cpu_count()
 print('Using {} cpus'.format(n_cpus))
 
+# read the warp files still to process from their uncompressed copies (decompressed once, several files at a time)
+warp_files = {f: os.path.join(results_dir, f) for f in files}
+if decompression_cache_dir != '':
+    pending = [f for f in files if not os.path.exists(os.path.join(processed_data_dir, f[:-7] + '_logjacobian.nrrd'))]
+    print('Decompressing {} warp files into {}'.format(len(pending), decompression_cache_dir))
+    warp_files.update(zip(pending, get_decompressed_files([warp_files[f] for f in pending], decompression_cache_dir)))
+
 def get_jacobian(f):
-    file_to_process = os.path.join(results_dir, f)
+    file_to_process = warp_files[f]
     processed_file = os.path.join(processed_data_dir, os.path.basename(f)[:-7] + '_logjacobian.nrrd')
     
     # if the file already exists, skip it